@@ -0,0 +1,181 @@
+from typing import List, Tuple
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from algorithms.mappo.algorithms.r_mappo.algorithm.r_actor_critic import split_actor_state_dict, split_head_state_dict, \
+    _sub_state_dict
+
+"""Frozen, evaluation-only actors for deployment, exported as TorchScript."""
+
+
+def _stack(state_dicts, key, transpose=False):
+    params = [sd[key].t() if transpose else sd[key] for sd in state_dicts]
+    return torch.stack(params).detach().clone()
+
+
+class _GroupedLinearNorm(nn.Module):
+    """Linear -> activation -> LayerNorm of an MLPLayer, for every group at once."""
+    def __init__(self, weight, bias, norm_weight, norm_bias, use_ReLU: bool):
+        super(_GroupedLinearNorm, self).__init__()
+        self.use_ReLU = use_ReLU
+        self.register_buffer('weight', weight)
+        self.register_buffer('bias', bias.unsqueeze(1))
+        self.register_buffer('norm_weight', norm_weight.unsqueeze(1))
+        self.register_buffer('norm_bias', norm_bias.unsqueeze(1))
+
+    def forward(self, x):
+        x = torch.baddbmm(self.bias, x, self.weight)
+        x = torch.relu(x) if self.use_ReLU else torch.tanh(x)
+        return F.layer_norm(x, [x.size(-1)]) * self.norm_weight + self.norm_bias
+
+
+class _GroupedGRUCell(nn.Module):
+    """One layer of nn.GRU for a single time step, for every group at once."""
+    def __init__(self, weight_ih, weight_hh, bias_ih, bias_hh):
+        super(_GroupedGRUCell, self).__init__()
+        self.register_buffer('weight_ih', weight_ih)
+        self.register_buffer('weight_hh', weight_hh)
+        self.register_buffer('bias_ih', bias_ih.unsqueeze(1))
+        self.register_buffer('bias_hh', bias_hh.unsqueeze(1))
+
+    def forward(self, x, h):
+        gi = torch.baddbmm(self.bias_ih, x, self.weight_ih).chunk(3, -1)
+        gh = torch.baddbmm(self.bias_hh, h, self.weight_hh).chunk(3, -1)
+        r = torch.sigmoid(gi[0] + gh[0])
+        z = torch.sigmoid(gi[1] + gh[1])
+        n = torch.tanh(gi[2] + r * gh[2])
+        return (1 - z) * n + z * h
+
+
+class ExportedActor(nn.Module):
+    """
+    Deterministic R_Actor for all agents of a team. The control and communication trunks of every agent are stacked
+    along a leading group dimension (agent major) and run as batched matmuls, and the control (DiagGaussian mean) and
+    communication (Categorical mode) heads are fused into one block diagonal matmul per agent. Build it with
+    from_state_dicts and save it with export_actor.
+    :param state_dicts: (list) one R_Actor state dict per agent, in the separate trunk layout.
+    :param layer_N: (int) number of hidden layers after the first one.
+    :param use_feature_normalization: (bool) whether the trunks normalize their inputs.
+    :param use_ReLU: (bool) ReLU (True) or Tanh (False) activations.
+    :param recurrent_N: (int) number of GRU layers, 0 for MLP actors.
+    """
+    def __init__(self, state_dicts, layer_N, use_feature_normalization, use_ReLU, recurrent_N):
+        super(ExportedActor, self).__init__()
+        trunks = [_sub_state_dict(sd, prefix) for sd in state_dicts for prefix in ('base_ctrl.', 'base_com.')]
+        rnns = [_sub_state_dict(sd, prefix) for sd in state_dicts for prefix in ('ctrl_rnn.', 'com_rnn.')]
+
+        self.num_agents = len(state_dicts)
+        self.obs_dim = trunks[0]['mlp.fc1.0.weight'].size(1)
+        self.hidden_size = trunks[0]['mlp.fc1.0.weight'].size(0)
+        self.recurrent_N = recurrent_N
+        self.use_feature_normalization = use_feature_normalization
+
+        if use_feature_normalization:
+            self.register_buffer('feature_norm_weight', _stack(trunks, 'feature_norm.weight').unsqueeze(1))
+            self.register_buffer('feature_norm_bias', _stack(trunks, 'feature_norm.bias').unsqueeze(1))
+        else:
+            self.register_buffer('feature_norm_weight', torch.ones(1, 1, self.obs_dim))
+            self.register_buffer('feature_norm_bias', torch.zeros(1, 1, self.obs_dim))
+
+        prefixes = ['mlp.fc1.'] + ['mlp.fc2.{}.'.format(i) for i in range(layer_N)]
+        self.layers = nn.ModuleList([_GroupedLinearNorm(_stack(trunks, p + '0.weight', transpose=True),
+                                                        _stack(trunks, p + '0.bias'),
+                                                        _stack(trunks, p + '2.weight'),
+                                                        _stack(trunks, p + '2.bias'),
+                                                        use_ReLU)
+                                     for p in prefixes])
+
+        self.cells = nn.ModuleList([_GroupedGRUCell(_stack(rnns, 'rnn.weight_ih_l{}'.format(l), transpose=True),
+                                                    _stack(rnns, 'rnn.weight_hh_l{}'.format(l), transpose=True),
+                                                    _stack(rnns, 'rnn.bias_ih_l{}'.format(l)),
+                                                    _stack(rnns, 'rnn.bias_hh_l{}'.format(l)))
+                                    for l in range(recurrent_N)])
+        if recurrent_N > 0:
+            self.register_buffer('rnn_norm_weight', _stack(rnns, 'norm.weight').unsqueeze(1))
+            self.register_buffer('rnn_norm_bias', _stack(rnns, 'norm.bias').unsqueeze(1))
+        else:
+            self.register_buffer('rnn_norm_weight', torch.ones(1, 1, self.hidden_size))
+            self.register_buffer('rnn_norm_bias', torch.zeros(1, 1, self.hidden_size))
+
+        # fused heads: [control features | communication features] @ block diagonal [fc_mean, 0; 0, linear]
+        ctrl_weight = _stack(state_dicts, 'act_ctrl.action_out.fc_mean.weight', transpose=True)
+        com_weight = _stack(state_dicts, 'act_com.action_out.linear.weight', transpose=True)
+        self.ctrl_dim = ctrl_weight.size(-1)
+        head_weight = ctrl_weight.new_zeros(self.num_agents, 2 * self.hidden_size,
+                                            self.ctrl_dim + com_weight.size(-1))
+        head_weight[:, :self.hidden_size, :self.ctrl_dim] = ctrl_weight
+        head_weight[:, self.hidden_size:, self.ctrl_dim:] = com_weight
+        self.register_buffer('head_weight', head_weight)
+        self.register_buffer('head_bias', torch.cat([_stack(state_dicts, 'act_ctrl.action_out.fc_mean.bias'),
+                                                     _stack(state_dicts, 'act_com.action_out.linear.bias')],
+                                                    -1).unsqueeze(1))
+
+    @classmethod
+    def from_state_dicts(cls, state_dicts, args, num_agents=None):
+        """
+        Build an ExportedActor from saved R_Actor checkpoints.
+        :param state_dicts: (list) R_Actor state dicts, one per agent or a single shared one. Both trunk and both
+                            action head layouts are accepted.
+        :param args: (argparse.Namespace) arguments the actors were trained with, e.g. the pickled init.pt.
+        :param num_agents: (int) number of agents, a single shared state dict is used for all of them.
+
+        :return actor: (ExportedActor) exported actor.
+        """
+        state_dicts = [split_actor_state_dict(sd) if 'base.weights.0' in sd else sd for sd in state_dicts]
+        state_dicts = [split_head_state_dict(sd) if 'act.linear.weight' in sd else sd for sd in state_dicts]
+        if num_agents is not None and len(state_dicts) == 1:
+            state_dicts = state_dicts * num_agents
+        recurrent = args.use_recurrent_policy or args.use_naive_recurrent_policy
+        return cls(state_dicts, args.layer_N, args.use_feature_normalization, args.use_ReLU,
+                   args.recurrent_N if recurrent else 0)
+
+    def forward(self, obs, rnn_states, masks) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Compute the deterministic actions of all agents.
+        :param obs: (torch.Tensor) observations of shape (num_agents, batch, obs_dim).
+        :param rnn_states: (torch.Tensor) RNN states of shape (num_agents, batch, recurrent_N, 2 * hidden_size),
+                           returned unchanged by MLP actors.
+        :param masks: (torch.Tensor) masks of shape (num_agents, batch, 1), zero resets the RNN states.
+
+        :return actions: (torch.Tensor) actions of shape (num_agents, batch, action_dim).
+        :return rnn_states: (torch.Tensor) updated RNN states.
+        """
+        A, B, H = obs.size(0), obs.size(1), self.hidden_size
+        x = obs.unsqueeze(1).expand(A, 2, B, self.obs_dim).reshape(2 * A, B, self.obs_dim)
+        if self.use_feature_normalization:
+            x = F.layer_norm(x, [self.obs_dim]) * self.feature_norm_weight + self.feature_norm_bias
+        for layer in self.layers:
+            x = layer(x)
+
+        if self.recurrent_N > 0:
+            L = self.recurrent_N
+            hxs = rnn_states.view(A, B, L, 2, H).permute(0, 3, 2, 1, 4).reshape(2 * A, L, B, H)
+            hxs = hxs * masks.unsqueeze(1).expand(A, 2, B, 1).reshape(2 * A, 1, B, 1)
+            new_hxs: List[torch.Tensor] = []
+            for l, cell in enumerate(self.cells):
+                x = cell(x, hxs[:, l])
+                new_hxs.append(x)
+            x = F.layer_norm(x, [H]) * self.rnn_norm_weight + self.rnn_norm_bias
+            rnn_states = torch.stack(new_hxs, 1).view(A, 2, L, B, H).permute(0, 3, 2, 1, 4).reshape(A, B, L, 2 * H)
+
+        features = x.view(A, 2, B, H).transpose(1, 2).reshape(A, B, 2 * H)
+        out = torch.baddbmm(self.head_bias, features, self.head_weight)
+        com_actions = out[..., self.ctrl_dim:].argmax(-1, keepdim=True).to(out.dtype)
+        return torch.cat([out[..., :self.ctrl_dim], com_actions], -1), rnn_states
+
+
+def export_actor(actor, path):
+    """
+    Script an ExportedActor and save it to path, it can be loaded without this repository by torch.jit.load.
+    :param actor: (ExportedActor) actor to export.
+    :param path: (str) output file.
+    """
+    torch.jit.save(torch.jit.script(actor.eval()), path)
+
+
+def load_exported_actor(path, device=torch.device("cpu")):
+    """
+    Load an actor saved by export_actor. Calling it with observations of all agents, shaped
+    (num_agents, batch, obs_dim), returns the actions of all agents in one call.
+    """
+    return torch.jit.load(path, map_location=device).eval()
@@ -0,0 +1,253 @@
+import torch
+import torch.nn.functional as F
+from algorithms.mappo.algorithms.utils.act import MixedACTLayer
+from algorithms.mappo.algorithms.utils.distributions import Categorical, DiagGaussian
+
+"""
+Forward passes of R_Actor and R_Critic for the separate policies of several agents at once. The parameters of all
+agents are stacked along a leading agent dimension and every layer runs as one grouped matmul (torch.baddbmm), so the
+number of kernels does not grow with the number of agents. The computation is differentiable, gradients flow back to
+the stacked tensors.
+"""
+
+
+def stack_parameters(modules):
+    """
+    Stack the parameters of identically built modules along a new leading agent dimension.
+    :param modules: (list) one nn.Module per agent.
+
+    :return params: (dict) parameter name -> tensor of shape (num_agents, *parameter shape).
+    """
+    named = [dict(module.named_parameters()) for module in modules]
+    return {name: torch.stack([params[name] for params in named]) for name in named[0]}
+
+
+def supports_actor(actor):
+    """Whether the action heads of the R_Actor can be grouped, only Tuple(Box, Discrete) action spaces can."""
+    if actor._use_fused_action_head:
+        return True
+    return type(actor.act_ctrl.action_out) is DiagGaussian and type(actor.act_com.action_out) is Categorical
+
+
+def _mlp(x, layers, use_ReLU):
+    for weight, bias, norm_weight, norm_bias in layers:
+        x = torch.baddbmm(bias, x, weight)
+        x = torch.relu(x) if use_ReLU else torch.tanh(x)
+        x = torch.addcmul(norm_bias, F.layer_norm(x, x.shape[-1:]), norm_weight)
+    return x
+
+
+def _gru(x, hxs, masks, layers):
+    """
+    nn.GRU over a (T, N) sequence flattened to T * N rows, for every group at once.
+    :param x: (torch.Tensor) inputs of shape (groups, T * N, hidden_size).
+    :param hxs: (torch.Tensor) hidden states of shape (groups, recurrent_N, N, hidden_size).
+    :param masks: (torch.Tensor) masks of shape (groups, T * N, 1), zero resets the hidden states before that step.
+    :param layers: (list) (weight_ih, weight_hh, bias_ih, bias_hh) of every GRU layer, weights transposed.
+
+    :return x: (torch.Tensor) outputs of the last layer.
+    :return hxs: (torch.Tensor) hidden states after the last step.
+    """
+    G, N, H = hxs.size(0), hxs.size(2), hxs.size(3)
+    T = x.size(1) // N
+    masks = masks.view(G, T, N, 1)
+    new_hxs = []
+    for l, (weight_ih, weight_hh, bias_ih, bias_hh) in enumerate(layers):
+        # the input projections of all steps are one matmul, only the recurrent one runs per step
+        gi = torch.baddbmm(bias_ih, x, weight_ih).view(G, T, N, 3 * H)
+        h = hxs[:, l]
+        outputs = []
+        for t in range(T):
+            h = h * masks[:, t]
+            gh = torch.baddbmm(bias_hh, h, weight_hh)
+            r, z = torch.sigmoid(gi[:, t, :, :2 * H] + gh[..., :2 * H]).chunk(2, -1)
+            n = torch.tanh(gi[:, t, :, 2 * H:] + r * gh[..., 2 * H:])
+            h = n + z * (h - n)
+            outputs.append(h)
+        x = torch.stack(outputs, 1).view(G, T * N, H)
+        new_hxs.append(h)
+    return x, torch.stack(new_hxs, 1)
+
+
+def _rnn_layers(params, prefix, recurrent_N):
+    return [(params[prefix + 'rnn.weight_ih_l%d' % l].transpose(-1, -2),
+             params[prefix + 'rnn.weight_hh_l%d' % l].transpose(-1, -2),
+             params[prefix + 'rnn.bias_ih_l%d' % l].unsqueeze(-2),
+             params[prefix + 'rnn.bias_hh_l%d' % l].unsqueeze(-2)) for l in range(recurrent_N)]
+
+
+def _mlp_layers(params, prefix, layer_N):
+    return [(params[p + '0.weight'].transpose(-1, -2), params[p + '0.bias'].unsqueeze(-2),
+             params[p + '2.weight'].unsqueeze(-2), params[p + '2.bias'].unsqueeze(-2))
+            for p in [prefix + 'mlp.fc1.'] + [prefix + 'mlp.fc2.%d.' % i for i in range(layer_N)]]
+
+
+class GroupedActor:
+    """
+    R_Actor of every agent as one grouped computation. The control and communication trunks and GRUs of all agents
+    form 2 * num_agents groups (agent major), the heads num_agents groups. Actions are sampled and scored like
+    MixedACTLayer does.
+    :param params: (dict) R_Actor parameters stacked along a leading agent dimension (see stack_parameters), in
+                   either trunk and either action head layout.
+    :param actor: (R_Actor) one of the actors, only its configuration is read.
+    """
+    def __init__(self, params, actor):
+        self.num_agents = next(iter(params.values())).size(0)
+        self.hidden_size = actor.hidden_size
+        self._use_recurrent = actor._use_recurrent_policy or actor._use_naive_recurrent_policy
+        self._recurrent_N = actor._recurrent_N
+        self._use_policy_active_masks = actor._use_policy_active_masks
+        base = actor.base if actor._use_fused_actor_trunk else actor.base_ctrl
+        self._use_ReLU = base._use_ReLU
+        self._use_feature_normalization = base._use_feature_normalization
+
+        def groups(per_trunk):
+            # (num_agents, ...) control and communication tensors -> (2 * num_agents, ...), agent major
+            return [torch.stack(pair, 1).flatten(0, 1) for pair in zip(*per_trunk)]
+
+        if actor._use_fused_actor_trunk:
+            def trunk(key):
+                return params['base.' + key].flatten(0, 1)
+            if self._use_feature_normalization:
+                self.feature_norm = (trunk('feature_norm_weight'), trunk('feature_norm_bias'))
+            self.layers = [(trunk('weights.%d' % i), trunk('biases.%d' % i), trunk('norm_weights.%d' % i),
+                            trunk('norm_biases.%d' % i)) for i in range(base._layer_N + 1)]
+        else:
+            if self._use_feature_normalization:
+                self.feature_norm = tuple(x.unsqueeze(1) for x in groups(
+                    [(params[prefix + 'feature_norm.weight'], params[prefix + 'feature_norm.bias'])
+                     for prefix in ('base_ctrl.', 'base_com.')]))
+            self.layers = [tuple(groups(layer)) for layer in zip(_mlp_layers(params, 'base_ctrl.', base._layer_N),
+                                                                 _mlp_layers(params, 'base_com.', base._layer_N))]
+
+        if self._use_recurrent:
+            L = self._recurrent_N
+            self.rnn_layers = [tuple(groups(layer)) for layer in zip(_rnn_layers(params, 'ctrl_rnn.', L),
+                                                                     _rnn_layers(params, 'com_rnn.', L))]
+            self.rnn_norm = tuple(x.unsqueeze(1) for x in groups(
+                [(params[prefix + 'norm.weight'], params[prefix + 'norm.bias'])
+                 for prefix in ('ctrl_rnn.', 'com_rnn.')]))
+
+        if actor._use_fused_action_head:
+            c = actor.act.continuous_dim
+            weight, bias = params['act.linear.weight'], params['act.linear.bias']
+        else:
+            c = actor.act_ctrl.action_out.fc_mean.out_features
+            weight, bias = [torch.cat([params['act_ctrl.action_out.fc_mean.' + p],
+                                       params['act_ctrl.action_out.logstd.' + p],
+                                       params['act_com.action_out.linear.' + p]], 1) for p in ('weight', 'bias')]
+        # rows [mean | logstd | logits], the first 2 * c read the control features, the rest the communication ones
+        weight, bias = weight.transpose(1, 2), bias.unsqueeze(1)
+        self.ctrl_head = (weight[..., :2 * c], bias[..., :2 * c])
+        self.com_head = (weight[..., 2 * c:], bias[..., 2 * c:])
+
+    def features(self, obs, rnn_states, masks):
+        """
+        Control and communication features of every agent, in float32 like R_Actor._trunk.
+        :param obs: (torch.Tensor) observations of shape (num_agents, T * N, obs_dim).
+        :param rnn_states: (torch.Tensor) RNN states of shape (num_agents, N, recurrent_N, 2 * hidden_size).
+        :param masks: (torch.Tensor) masks of shape (num_agents, T * N, 1).
+
+        :return control_features: (torch.Tensor) shape (num_agents, T * N, hidden_size).
+        :return communication_features: (torch.Tensor) shape (num_agents, T * N, hidden_size).
+        :return rnn_states: (torch.Tensor) updated RNN states, returned unchanged by MLP actors.
+        """
+        A, M, H = self.num_agents, obs.size(1), self.hidden_size
+        if self._use_feature_normalization:
+            weight, bias = self.feature_norm
+            x = torch.addcmul(bias.view(A, 2, 1, -1), F.layer_norm(obs, obs.shape[-1:]).unsqueeze(1),
+                              weight.view(A, 2, 1, -1)).flatten(0, 1)
+        else:
+            x = obs.unsqueeze(1).expand(A, 2, M, obs.size(-1)).flatten(0, 1)
+        x = _mlp(x, self.layers, self._use_ReLU)
+
+        if self._use_recurrent:
+            N, L = rnn_states.size(1), self._recurrent_N
+            hxs = rnn_states.view(A, N, L, 2, H).permute(0, 3, 2, 1, 4).reshape(2 * A, L, N, H)
+            x, hxs = _gru(x, hxs, masks.unsqueeze(1).expand(A, 2, M, 1).flatten(0, 1), self.rnn_layers)
+            x = torch.addcmul(self.rnn_norm[1], F.layer_norm(x, x.shape[-1:]), self.rnn_norm[0])
+            rnn_states = hxs.view(A, 2, L, N, H).permute(0, 3, 2, 1, 4).reshape(A, N, L, 2 * H)
+
+        x = x.float().view(A, 2, M, H)
+        return x[:, 0], x[:, 1], rnn_states
+
+    def heads(self, control_features, communication_features, available_actions=None):
+        """
+        :return action_mean: (torch.Tensor) Gaussian means of shape (num_agents, T * N, continuous_dim).
+        :return action_logstd: (torch.Tensor) clamped Gaussian log stds.
+        :return log_probs: (torch.Tensor) normalized categorical log probabilities.
+        """
+        out = torch.baddbmm(self.ctrl_head[1], control_features, self.ctrl_head[0])
+        logits = torch.baddbmm(self.com_head[1], communication_features, self.com_head[0])
+        if available_actions is not None:
+            logits = logits.masked_fill(available_actions == 0, -1e10)
+        action_mean, action_logstd = out.chunk(2, -1)
+        return action_mean, torch.clamp(action_logstd, min=-6, max=2), F.log_softmax(logits, -1)
+
+    def act(self, obs, rnn_states, masks, available_actions=None, deterministic=False):
+        """
+        R_Actor.forward of every agent, all inputs and outputs carry a leading agent dimension.
+        """
+        control_features, communication_features, rnn_states = self.features(obs, rnn_states, masks)
+        with torch.autocast(device_type=obs.device.type, enabled=False):
+            actions, action_log_probs = MixedACTLayer.sample_actions(
+                *self.heads(control_features, communication_features, available_actions), deterministic)
+        return actions, action_log_probs, rnn_states
+
+    def evaluate_actions(self, obs, rnn_states, action, masks, available_actions=None, active_masks=None):
+        """
+        R_Actor.evaluate_actions of every agent, all inputs and outputs carry a leading agent dimension.
+
+        :return action_log_probs: (torch.Tensor) log probabilities of the input actions.
+        :return dist_entropy: (torch.Tensor) action distribution entropy of every agent, shape (num_agents,).
+        """
+        control_features, communication_features, _ = self.features(obs, rnn_states, masks)
+        with torch.autocast(device_type=obs.device.type, enabled=False):
+            action_log_probs, entropy = MixedACTLayer.score_actions(
+                action, *self.heads(control_features, communication_features, available_actions))
+        if self._use_policy_active_masks and active_masks is not None:
+            dist_entropy = (entropy * active_masks.squeeze(-1)).sum(1) / active_masks.sum((1, 2))
+        else:
+            dist_entropy = entropy.mean(1)
+        return action_log_probs, dist_entropy
+
+
+class GroupedCritic:
+    """
+    R_Critic of every agent as one grouped computation, one group per agent.
+    :param params: (dict) R_Critic parameters stacked along a leading agent dimension (see stack_parameters).
+    :param critic: (R_Critic) one of the critics, only its configuration is read.
+    """
+    def __init__(self, params, critic):
+        self._use_recurrent = critic._use_recurrent_policy or critic._use_naive_recurrent_policy
+        self._use_ReLU = critic.base._use_ReLU
+        self._use_feature_normalization = critic.base._use_feature_normalization
+
+        if self._use_feature_normalization:
+            self.feature_norm = (params['base.feature_norm.weight'].unsqueeze(1),
+                                 params['base.feature_norm.bias'].unsqueeze(1))
+        self.layers = _mlp_layers(params, 'base.', critic.base._layer_N)
+        if self._use_recurrent:
+            self.rnn_layers = _rnn_layers(params, 'rnn.', critic._recurrent_N)
+            self.rnn_norm = (params['rnn.norm.weight'].unsqueeze(1), params['rnn.norm.bias'].unsqueeze(1))
+        self.v_out = (params['v_out.weight'].transpose(1, 2), params['v_out.bias'].unsqueeze(1))
+
+    def __call__(self, cent_obs, rnn_states, masks, normalized_input=False):
+        """
+        R_Critic.forward of every agent, all inputs and outputs carry a leading agent dimension.
+        """
+        x = cent_obs
+        if self._use_feature_normalization:
+            if not normalized_input:
+                x = F.layer_norm(x, x.shape[-1:])
+            x = torch.addcmul(self.feature_norm[1], x, self.feature_norm[0])
+        x = _mlp(x, self.layers, self._use_ReLU)
+
+        if self._use_recurrent:
+            x, hxs = _gru(x, rnn_states.transpose(1, 2), masks, self.rnn_layers)
+            x = torch.addcmul(self.rnn_norm[1], F.layer_norm(x, x.shape[-1:]), self.rnn_norm[0])
+            rnn_states = hxs.transpose(1, 2)
+
+        with torch.autocast(device_type=cent_obs.device.type, enabled=False):
+            values = torch.baddbmm(self.v_out[1], x.float(), self.v_out[0])
+        return values, rnn_states
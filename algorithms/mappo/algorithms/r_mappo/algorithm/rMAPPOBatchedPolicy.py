@@ -0,0 +1,107 @@
+import torch
+from algorithms.mappo.algorithms.utils.util import check
+from algorithms.mappo.algorithms.r_mappo.algorithm.grouped_actor_critic import GroupedActor, GroupedCritic, \
+    stack_parameters, supports_actor
+
+
+class R_MAPPOBatchedPolicy:
+    """
+    Runs the forward passes of several independent R_MAPPOPolicy instances as one batched computation.
+    Parameters of every agent are stacked along a leading agent dimension and every layer, GRUs included, runs as one
+    grouped matmul (see GroupedActor), so each agent keeps its own weights and optimizers. Only used for rollouts and
+    evaluation (no gradients).
+
+    :param args: (argparse.Namespace) arguments containing relevant model and policy information.
+    :param policies: (list) one R_MAPPOPolicy per agent, all built from the same spaces.
+    :param device: (torch.device) specifies the device to run on (cpu/gpu).
+    """
+
+    def __init__(self, args, policies, device=torch.device("cpu")):
+        self.policies = policies
+        self.num_agents = len(policies)
+        self.tpdv = dict(dtype=torch.float32, device=device)
+
+        self._use_grouped = True
+        if policies[0]._use_quantized_rollout:
+            # quantized Linear layers hold packed int8 weights that cannot be stacked
+            print("Batched inference does not support int8 rollout actors, running the agents one after the other.")
+            self._use_grouped = False
+        elif not supports_actor(policies[0].actor):
+            print("Batched inference needs a Tuple(Box, Discrete) action space, "
+                  "running the agents one after the other.")
+            self._use_grouped = False
+        self.refresh()
+
+    @torch.no_grad()
+    def refresh(self):
+        """
+        Re-stack the agent parameters. Must be called after the per-agent policies were updated.
+        """
+        if not self._use_grouped:
+            return
+        self.actor = GroupedActor(stack_parameters([p.actor for p in self.policies]), self.policies[0].actor)
+        self.critic = GroupedCritic(stack_parameters([p.critic for p in self.policies]), self.policies[0].critic)
+
+    def _stack(self, x):
+        return check(x).to(**self.tpdv)
+
+    def _run_actor(self, obs, rnn_states_actor, masks, available_actions, deterministic):
+        if self._use_grouped:
+            return self.actor.act(obs, rnn_states_actor, masks, available_actions, deterministic)
+        outputs = [self.policies[i].rollout_actor(obs[i], rnn_states_actor[i], masks[i],
+                                                  None if available_actions is None else available_actions[i],
+                                                  deterministic)
+                   for i in range(self.num_agents)]
+        return tuple(torch.stack(x) for x in zip(*outputs))
+
+    def _run_critic(self, cent_obs, rnn_states_critic, masks):
+        if self._use_grouped:
+            return self.critic(cent_obs, rnn_states_critic, masks)
+        outputs = [self.policies[i].critic(cent_obs[i], rnn_states_critic[i], masks[i])
+                   for i in range(self.num_agents)]
+        return tuple(torch.stack(x) for x in zip(*outputs))
+
+    @torch.no_grad()
+    def get_actions(self, cent_obs, obs, rnn_states_actor, rnn_states_critic, masks, available_actions=None,
+                    deterministic=False):
+        """
+        Compute actions and value function predictions for all agents at once.
+        All inputs carry a leading agent dimension, e.g. obs has shape (num_agents, batch, obs_dim).
+
+        :return values: (torch.Tensor) value function predictions.
+        :return actions: (torch.Tensor) actions to take.
+        :return action_log_probs: (torch.Tensor) log probabilities of chosen actions.
+        :return rnn_states_actor: (torch.Tensor) updated actor network RNN states.
+        :return rnn_states_critic: (torch.Tensor) updated critic network RNN states.
+        """
+        masks = self._stack(masks)
+        if available_actions is not None:
+            available_actions = self._stack(available_actions)
+        actions, action_log_probs, rnn_states_actor = self._run_actor(self._stack(obs),
+                                                                      self._stack(rnn_states_actor),
+                                                                      masks,
+                                                                      available_actions,
+                                                                      deterministic)
+        values, rnn_states_critic = self._run_critic(self._stack(cent_obs), self._stack(rnn_states_critic), masks)
+        return values, actions, action_log_probs, rnn_states_actor, rnn_states_critic
+
+    @torch.no_grad()
+    def get_values(self, cent_obs, rnn_states_critic, masks):
+        """
+        Get value function predictions for all agents at once.
+
+        :return values: (torch.Tensor) value function predictions.
+        """
+        values, _ = self._run_critic(self._stack(cent_obs), self._stack(rnn_states_critic), self._stack(masks))
+        return values
+
+    @torch.no_grad()
+    def act(self, obs, rnn_states_actor, masks, available_actions=None, deterministic=False):
+        """
+        Compute actions for all agents at once.
+        """
+        if available_actions is not None:
+            available_actions = self._stack(available_actions)
+        actions, _, rnn_states_actor = self._run_actor(self._stack(obs), self._stack(rnn_states_actor),
+                                                       self._stack(masks), available_actions, deterministic)
+        return actions, rnn_states_actor
@@ -1,6 +1,8 @@
 import torch
 from algorithms.mappo.algorithms.r_mappo.algorithm.r_actor_critic import R_Actor, R_Critic
-from algorithms.mappo.utils.util import update_linear_schedule
+from algorithms.mappo.algorithms.utils.util import CompiledFunction
+from algorithms.mappo.utils.util import make_fused_adam, update_linear_schedule
+from utils.misc import quantized_copy
 
 
 class R_MAPPOPolicy:
@@ -29,13 +31,40 @@ class R_MAPPOPolicy:
         self.critic = R_Critic(args, self.share_obs_space, self.device)
         self.init_dict = args
 
-        self.actor_optimizer = torch.optim.Adam(self.actor.parameters(),
-                                                lr=self.lr, eps=self.opti_eps,
-                                                weight_decay=self.weight_decay)
-        self.critic_optimizer = torch.optim.Adam(self.critic.parameters(),
-                                                 lr=self.critic_lr,
-                                                 eps=self.opti_eps,
-                                                 weight_decay=self.weight_decay)
+        self._actor_forward = self.actor
+        self._actor_evaluate_actions = self.actor.evaluate_actions
+        self._critic_forward = self.critic
+        if getattr(args, 'use_compile', False):
+            if args.use_recurrent_policy or args.use_naive_recurrent_policy:
+                # RNNLayer splits sequences on data dependent mask positions, which does not compile well.
+                print("torch.compile is only used with MLP policies, running the recurrent policy eagerly.")
+            else:
+                self._actor_forward = CompiledFunction(self.actor)
+                self._actor_evaluate_actions = CompiledFunction(self.actor.evaluate_actions)
+                self._critic_forward = CompiledFunction(self.critic)
+
+        self._use_quantized_rollout = getattr(args, 'use_quantized_rollout', False)
+        if self._use_quantized_rollout and self.device.type != 'cpu':
+            print("Dynamic int8 quantization only runs on CPU, rollouts use the float actor.")
+            self._use_quantized_rollout = False
+        self.rollout_actor = self.actor
+        self.refresh_rollout_actor()
+
+        self._use_fused_optimizer = getattr(args, 'use_fused_optimizer', False)
+        if self._use_fused_optimizer:
+            # One optimizer for both networks, the actor and critic learning rates are kept as parameter groups.
+            self.optimizer = make_fused_adam([{'params': list(self.actor.parameters()), 'lr': self.lr},
+                                              {'params': list(self.critic.parameters()), 'lr': self.critic_lr}],
+                                             eps=self.opti_eps,
+                                             weight_decay=self.weight_decay)
+        else:
+            self.actor_optimizer = torch.optim.Adam(self.actor.parameters(),
+                                                    lr=self.lr, eps=self.opti_eps,
+                                                    weight_decay=self.weight_decay)
+            self.critic_optimizer = torch.optim.Adam(self.critic.parameters(),
+                                                     lr=self.critic_lr,
+                                                     eps=self.opti_eps,
+                                                     weight_decay=self.weight_decay)
 
     def lr_decay(self, episode, episodes):
         """
@@ -43,8 +72,21 @@ class R_MAPPOPolicy:
         :param episode: (int) current training episode.
         :param episodes: (int) total number of training episodes.
         """
-        update_linear_schedule(self.actor_optimizer, episode, episodes, self.lr)
-        update_linear_schedule(self.critic_optimizer, episode, episodes, self.critic_lr)
+        if self._use_fused_optimizer:
+            for param_group, initial_lr in zip(self.optimizer.param_groups, (self.lr, self.critic_lr)):
+                param_group['lr'] = initial_lr - (initial_lr * (episode / float(episodes)))
+        else:
+            update_linear_schedule(self.actor_optimizer, episode, episodes, self.lr)
+            update_linear_schedule(self.critic_optimizer, episode, episodes, self.critic_lr)
+
+    def refresh_rollout_actor(self):
+        """
+        Rebuild the int8 rollout actor from the float actor. Must be called after the actor was trained or restored,
+        without use_quantized_rollout this does nothing.
+        """
+        if self._use_quantized_rollout:
+            self.rollout_actor = quantized_copy(self.actor)
+            self._actor_forward = self.rollout_actor
 
     def get_actions(self, cent_obs, obs, rnn_states_actor, rnn_states_critic, masks, available_actions=None,
                     deterministic=False):
@@ -65,13 +107,13 @@ class R_MAPPOPolicy:
         :return rnn_states_actor: (torch.Tensor) updated actor network RNN states.
         :return rnn_states_critic: (torch.Tensor) updated critic network RNN states.
         """
-        actions, action_log_probs, rnn_states_actor = self.actor(obs,
-                                                                 rnn_states_actor,
-                                                                 masks,
-                                                                 available_actions,
-                                                                 deterministic)
+        actions, action_log_probs, rnn_states_actor = self._actor_forward(obs,
+                                                                          rnn_states_actor,
+                                                                          masks,
+                                                                          available_actions,
+                                                                          deterministic)
 
-        values, rnn_states_critic = self.critic(cent_obs, rnn_states_critic, masks)
+        values, rnn_states_critic = self._critic_forward(cent_obs, rnn_states_critic, masks)
         return values, actions, action_log_probs, rnn_states_actor, rnn_states_critic
 
     def get_values(self, cent_obs, rnn_states_critic, masks):
@@ -83,11 +125,11 @@ class R_MAPPOPolicy:
 
         :return values: (torch.Tensor) value function predictions.
         """
-        values, _ = self.critic(cent_obs, rnn_states_critic, masks)
+        values, _ = self._critic_forward(cent_obs, rnn_states_critic, masks)
         return values
 
     def evaluate_actions(self, cent_obs, obs, rnn_states_actor, rnn_states_critic, action, masks,
-                         available_actions=None, active_masks=None):
+                         available_actions=None, active_masks=None, normalized_cent_obs=False):
         """
         Get action logprobs / entropy and value function predictions for actor update.
         :param cent_obs (np.ndarray): centralized input to the critic.
@@ -99,19 +141,20 @@ class R_MAPPOPolicy:
         :param available_actions: (np.ndarray) denotes which actions are available to agent
                                   (if None, all actions available)
         :param active_masks: (torch.Tensor) denotes whether an agent is active or dead.
+        :param normalized_cent_obs: (bool) whether cent_obs holds the cached, already standardized critic inputs.
 
         :return values: (torch.Tensor) value function predictions.
         :return action_log_probs: (torch.Tensor) log probabilities of the input actions.
         :return dist_entropy: (torch.Tensor) action distribution entropy for the given inputs.
         """
-        action_log_probs, dist_entropy = self.actor.evaluate_actions(obs,
-                                                                     rnn_states_actor,
-                                                                     action,
-                                                                     masks,
-                                                                     available_actions,
-                                                                     active_masks)
-
-        values, _ = self.critic(cent_obs, rnn_states_critic, masks)
+        action_log_probs, dist_entropy = self._actor_evaluate_actions(obs,
+                                                                      rnn_states_actor,
+                                                                      action,
+                                                                      masks,
+                                                                      available_actions,
+                                                                      active_masks)
+
+        values, _ = self._critic_forward(cent_obs, rnn_states_critic, masks, normalized_cent_obs)
         return values, action_log_probs, dist_entropy
 
     def act(self, obs, rnn_states_actor, masks, available_actions=None, deterministic=False):
@@ -124,5 +167,6 @@ class R_MAPPOPolicy:
                                   (if None, all actions available)
         :param deterministic: (bool) whether the action should be mode of distribution or should be sampled.
         """
-        actions, _, rnn_states_actor = self.actor(obs, rnn_states_actor, masks, available_actions, deterministic)
+        actions, _, rnn_states_actor = self._actor_forward(obs, rnn_states_actor, masks, available_actions,
+                                                           deterministic)
         return actions, rnn_states_actor
@@ -3,11 +3,71 @@ import torch.nn as nn
 from gymnasium.spaces.utils import flatdim
 from algorithms.mappo.algorithms.utils.util import init, check
 from algorithms.mappo.algorithms.utils.cnn import CNNBase
-from algorithms.mappo.algorithms.utils.mlp import MLPBase
+from algorithms.mappo.algorithms.utils.mlp import MLPBase, FusedMLPBase
 from algorithms.mappo.algorithms.utils.rnn import RNNLayer
-from algorithms.mappo.algorithms.utils.act import ACTLayer
+from algorithms.mappo.algorithms.utils.act import ACTLayer, MixedACTLayer
 from algorithms.mappo.algorithms.utils.popart import PopArt
 
+_TRUNK_PREFIXES = ('base_ctrl.', 'base_com.')
+
+
+def _sub_state_dict(state_dict, prefix):
+    return {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+
+
+def fuse_actor_state_dict(state_dict):
+    """
+    Convert an R_Actor state dict with separate control/communication trunks into the --use_fused_actor_trunk layout.
+    :param state_dict: (dict) R_Actor state dict, e.g. loaded from an existing actor.pt.
+
+    :return state_dict: (dict) state dict for an R_Actor built with use_fused_actor_trunk.
+    """
+    fused = {k: v for k, v in state_dict.items() if not k.startswith(_TRUNK_PREFIXES)}
+    base = FusedMLPBase.fuse_state_dicts([_sub_state_dict(state_dict, 'base_ctrl.'),
+                                          _sub_state_dict(state_dict, 'base_com.')])
+    fused.update({'base.' + k: v for k, v in base.items()})
+    return fused
+
+
+def split_actor_state_dict(state_dict):
+    """
+    Inverse of fuse_actor_state_dict, converts a fused R_Actor state dict back to separate trunks.
+    :param state_dict: (dict) state dict of an R_Actor built with use_fused_actor_trunk.
+
+    :return state_dict: (dict) state dict with base_ctrl/base_com entries.
+    """
+    split = {k: v for k, v in state_dict.items() if not k.startswith('base.')}
+    for prefix, sd in zip(('base_ctrl.', 'base_com.'), FusedMLPBase.split_state_dict(_sub_state_dict(state_dict, 'base.'))):
+        split.update({prefix + k: v for k, v in sd.items()})
+    return split
+
+
+def fuse_head_state_dict(state_dict):
+    """
+    Convert an R_Actor state dict with separate act_ctrl/act_com heads into the --use_fused_action_head layout.
+    :param state_dict: (dict) R_Actor state dict.
+
+    :return state_dict: (dict) state dict for an R_Actor built with use_fused_action_head.
+    """
+    fused = {k: v for k, v in state_dict.items() if not k.startswith(('act_ctrl.', 'act_com.'))}
+    act = MixedACTLayer.fuse_state_dicts(_sub_state_dict(state_dict, 'act_ctrl.'), _sub_state_dict(state_dict, 'act_com.'))
+    fused.update({'act.' + k: v for k, v in act.items()})
+    return fused
+
+
+def split_head_state_dict(state_dict):
+    """
+    Inverse of fuse_head_state_dict, converts a fused head R_Actor state dict back to act_ctrl/act_com.
+    :param state_dict: (dict) state dict of an R_Actor built with use_fused_action_head.
+
+    :return state_dict: (dict) state dict with act_ctrl and act_com entries.
+    """
+    split = {k: v for k, v in state_dict.items() if not k.startswith('act.')}
+    for prefix, sd in zip(('act_ctrl.', 'act_com.'), MixedACTLayer.split_state_dict(_sub_state_dict(state_dict, 'act.'))):
+        split.update({prefix + k: v for k, v in sd.items()})
+    return split
+
+
 class R_Actor(nn.Module):
     """
     Actor network class for MAPPO. Outputs actions given observations.
@@ -26,6 +86,9 @@ class R_Actor(nn.Module):
         self._use_naive_recurrent_policy = args.use_naive_recurrent_policy
         self._use_recurrent_policy = args.use_recurrent_policy
         self._recurrent_N = args.recurrent_N
+        self._use_fused_actor_trunk = getattr(args, 'use_fused_actor_trunk', False)
+        self._use_packed_rnn = getattr(args, 'use_packed_rnn', False)
+        self._use_fused_action_head = getattr(args, 'use_fused_action_head', False)
         self.tpdv = dict(dtype=torch.float32, device=device)
 
         obs_shape = (flatdim(obs_space),)
@@ -37,14 +100,75 @@ class R_Actor(nn.Module):
         self.base_com = base(args, self.hidden_size, obs_shape)
 
         if self._use_naive_recurrent_policy or self._use_recurrent_policy:
-            self.ctrl_rnn = RNNLayer(self.hidden_size, self.hidden_size, self._recurrent_N, self._use_orthogonal)
-            self.com_rnn = RNNLayer(self.hidden_size, self.hidden_size, self._recurrent_N, self._use_orthogonal)
+            self.ctrl_rnn = RNNLayer(self.hidden_size, self.hidden_size, self._recurrent_N, self._use_orthogonal,
+                                     self._use_packed_rnn)
+            self.com_rnn = RNNLayer(self.hidden_size, self.hidden_size, self._recurrent_N, self._use_orthogonal,
+                                    self._use_packed_rnn)
 
         self.act_ctrl = ACTLayer(action_space[0], self.hidden_size, self._use_orthogonal, self._gain)
         self.act_com = ACTLayer(action_space[1], self.hidden_size, self._use_orthogonal, self._gain)
 
+        if self._use_fused_action_head:
+            # Built from the separate heads above so that initialization does not depend on the option.
+            separate_state_dict = self.state_dict()
+            del self.act_ctrl, self.act_com
+            with torch.random.fork_rng(devices=[]):
+                self.act = MixedACTLayer(action_space, self.hidden_size, self._use_orthogonal, self._gain,
+                                         separate_inputs=True)
+            self.load_state_dict(fuse_head_state_dict(separate_state_dict))
+
+        if self._use_fused_actor_trunk:
+            # Built from the separate trunks above so that initialization does not depend on the option.
+            separate_state_dict = self.state_dict()
+            del self.base_ctrl, self.base_com
+            self.base = FusedMLPBase(args, self.hidden_size, obs_shape)
+            self.load_state_dict(fuse_actor_state_dict(separate_state_dict))
+        self._register_load_state_dict_pre_hook(self._convert_state_dict_layout)
+
         self.to(device)
 
+    def _convert_state_dict_layout(self, state_dict, prefix, *args):
+        """Load checkpoints saved with either trunk and either action head layout."""
+        own = _sub_state_dict(state_dict, prefix)
+        converted = False
+        if self._use_fused_actor_trunk and 'base_ctrl.mlp.fc1.0.weight' in own:
+            own, converted = fuse_actor_state_dict(own), True
+        elif not self._use_fused_actor_trunk and 'base.weights.0' in own:
+            own, converted = split_actor_state_dict(own), True
+        if self._use_fused_action_head and 'act_ctrl.action_out.fc_mean.weight' in own:
+            own, converted = fuse_head_state_dict(own), True
+        elif not self._use_fused_action_head and 'act.linear.weight' in own:
+            own, converted = split_head_state_dict(own), True
+        if not converted:
+            return
+        for k in [k for k in state_dict if k.startswith(prefix)]:
+            del state_dict[k]
+        state_dict.update({prefix + k: v for k, v in own.items()})
+
+    def _trunk(self, obs, rnn_states, masks):
+        """
+        Compute the control and communication features. The features are returned in float32 so that the action
+        heads run at full precision under autocast.
+
+        :return control_features: (torch.Tensor) input features of the control head.
+        :return communication_features: (torch.Tensor) input features of the communication head.
+        :return rnn_states: (torch.Tensor) updated RNN hidden states.
+        """
+        rnn_states = rnn_states.split(int(self.hidden_size), dim=-1)
+        if self._use_fused_actor_trunk:
+            control_features, communication_features = self.base(obs)
+        else:
+            control_features = self.base_ctrl(obs)
+            communication_features = self.base_com(obs)
+
+        if self._use_naive_recurrent_policy or self._use_recurrent_policy:
+            control_features, ctrl_rnn_states = self.ctrl_rnn(control_features, rnn_states[0], masks)
+            communication_features, com_rnn_states = self.com_rnn(communication_features, rnn_states[1], masks)
+            rnn_states = torch.cat((ctrl_rnn_states, com_rnn_states), dim=-1)
+        else:
+            rnn_states = torch.cat((rnn_states[0], rnn_states[1]), dim=-1)
+        return control_features.float(), communication_features.float(), rnn_states
+
     def forward(self, obs, rnn_states, masks, available_actions=None, deterministic=False):
         """
         Compute actions from the given inputs.
@@ -61,23 +185,21 @@ class R_Actor(nn.Module):
         """
         obs = check(obs).to(**self.tpdv)
         rnn_states = check(rnn_states).to(**self.tpdv)
-        rnn_states = rnn_states.split(int(self.hidden_size), dim=-1)
         masks = check(masks).to(**self.tpdv)
         if available_actions is not None:
             available_actions = check(available_actions).to(**self.tpdv)
 
-        control_features = self.base_ctrl(obs)
-        communication_features = self.base_com(obs)
+        control_features, communication_features, rnn_states = self._trunk(obs, rnn_states, masks)
 
-        if self._use_naive_recurrent_policy or self._use_recurrent_policy:
-            control_features, ctrl_rnn_states = self.ctrl_rnn(control_features, rnn_states[0], masks)
-            communication_features, com_rnn_states = self.com_rnn(communication_features, rnn_states[1], masks)
-            rnn_states = torch.cat((ctrl_rnn_states, com_rnn_states), dim=-1)
-        else:
-            rnn_states = torch.cat((rnn_states[0], rnn_states[1]), dim=-1)
+        if self._use_fused_action_head:
+            with torch.autocast(device_type=obs.device.type, enabled=False):
+                actions, action_log_probs = self.act((control_features, communication_features),
+                                                     available_actions, deterministic)
+            return actions, action_log_probs, rnn_states
         
-        ctrl_actions, ctrl_action_log_probs = self.act_ctrl(control_features, available_actions, deterministic)
-        com_actions, com_action_log_probs = self.act_com(communication_features, available_actions, deterministic)
+        with torch.autocast(device_type=obs.device.type, enabled=False):
+            ctrl_actions, ctrl_action_log_probs = self.act_ctrl(control_features, available_actions, deterministic)
+            com_actions, com_action_log_probs = self.act_com(communication_features, available_actions, deterministic)
         
         actions = torch.cat((ctrl_actions, com_actions), dim=-1)
         action_log_probs = torch.cat((ctrl_action_log_probs, com_action_log_probs), dim=-1)
@@ -100,7 +222,6 @@ class R_Actor(nn.Module):
         """
         obs = check(obs).to(**self.tpdv)
         rnn_states = check(rnn_states).to(**self.tpdv)
-        rnn_states = rnn_states.split(int(self.hidden_size), dim=-1)
         action = check(action).to(**self.tpdv)
         masks = check(masks).to(**self.tpdv)
         if available_actions is not None:
@@ -109,27 +230,26 @@ class R_Actor(nn.Module):
         if active_masks is not None:
             active_masks = check(active_masks).to(**self.tpdv)
 
-        control_features = self.base_ctrl(obs)
-        communication_features = self.base_com(obs)
+        control_features, communication_features, rnn_states = self._trunk(obs, rnn_states, masks)
 
-        if self._use_naive_recurrent_policy or self._use_recurrent_policy:
-            control_features, ctrl_rnn_states = self.ctrl_rnn(control_features, rnn_states[0], masks)
-            communication_features, com_rnn_states = self.com_rnn(communication_features, rnn_states[1], masks)
-            rnn_states = torch.cat((ctrl_rnn_states, com_rnn_states), dim=-1)
-        else:
-            rnn_states = torch.cat((rnn_states[0], rnn_states[1]), dim=-1)
+        if self._use_fused_action_head:
+            with torch.autocast(device_type=obs.device.type, enabled=False):
+                return self.act.evaluate_actions((control_features, communication_features), action,
+                                                 available_actions,
+                                                 active_masks=active_masks if self._use_policy_active_masks else None)
 
-        control_log_probs, control_dist_entropy = self.act_ctrl.evaluate_actions(control_features,
-                                                                action[:,:2], available_actions,
-                                                                active_masks=
-                                                                active_masks if self._use_policy_active_masks
-                                                                else None)
+        with torch.autocast(device_type=obs.device.type, enabled=False):
+            control_log_probs, control_dist_entropy = self.act_ctrl.evaluate_actions(control_features,
+                                                                    action[:,:2], available_actions,
+                                                                    active_masks=
+                                                                    active_masks if self._use_policy_active_masks
+                                                                    else None)
 
-        communication_log_probs, communication_dist_entropy = self.act_com.evaluate_actions(communication_features,
-                                                                action[:,2:], available_actions,
-                                                                active_masks=
-                                                                active_masks if self._use_policy_active_masks
-                                                                else None)
+            communication_log_probs, communication_dist_entropy = self.act_com.evaluate_actions(communication_features,
+                                                                    action[:,2:], available_actions,
+                                                                    active_masks=
+                                                                    active_masks if self._use_policy_active_masks
+                                                                    else None)
 
         action_log_probs = torch.cat((control_log_probs, communication_log_probs), dim=-1)
         dist_entropy = control_dist_entropy + communication_dist_entropy
@@ -153,6 +273,7 @@ class R_Critic(nn.Module):
         self._use_recurrent_policy = args.use_recurrent_policy
         self._recurrent_N = args.recurrent_N
         self._use_popart = args.use_popart
+        self._use_packed_rnn = getattr(args, 'use_packed_rnn', False)
         self.tpdv = dict(dtype=torch.float32, device=device)
         init_method = [nn.init.xavier_uniform_, nn.init.orthogonal_][self._use_orthogonal]
 
@@ -161,7 +282,8 @@ class R_Critic(nn.Module):
         self.base = base(args, self.hidden_size, cent_obs_shape)
 
         if self._use_naive_recurrent_policy or self._use_recurrent_policy:
-            self.rnn = RNNLayer(self.hidden_size, self.hidden_size, self._recurrent_N, self._use_orthogonal)
+            self.rnn = RNNLayer(self.hidden_size, self.hidden_size, self._recurrent_N, self._use_orthogonal,
+                                self._use_packed_rnn)
 
         def init_(m):
             return init(m, init_method, lambda x: nn.init.constant_(x, 0))
@@ -173,12 +295,14 @@ class R_Critic(nn.Module):
 
         self.to(device)
 
-    def forward(self, cent_obs, rnn_states, masks):
+    def forward(self, cent_obs, rnn_states, masks, normalized_input=False):
         """
         Compute actions from the given inputs.
         :param cent_obs: (np.ndarray / torch.Tensor) observation inputs into network.
         :param rnn_states: (np.ndarray / torch.Tensor) if RNN network, hidden states for RNN.
         :param masks: (np.ndarray / torch.Tensor) mask tensor denoting if RNN states should be reinitialized to zeros.
+        :param normalized_input: (bool) whether cent_obs was already standardized by the buffer
+                                 (see SharedReplayBuffer.cache_critic_inputs).
 
         :return values: (torch.Tensor) value function predictions.
         :return rnn_states: (torch.Tensor) updated RNN hidden states.
@@ -187,9 +311,11 @@ class R_Critic(nn.Module):
         rnn_states = check(rnn_states).to(**self.tpdv)
         masks = check(masks).to(**self.tpdv)
 
-        critic_features = self.base(cent_obs)
+        critic_features = self.base(cent_obs, normalized_input)
         if self._use_naive_recurrent_policy or self._use_recurrent_policy:
             critic_features, rnn_states = self.rnn(critic_features, rnn_states, masks)
-        values = self.v_out(critic_features)
+        # The value head (and PopArt) always runs in float32, also under autocast.
+        with torch.autocast(device_type=cent_obs.device.type, enabled=False):
+            values = self.v_out(critic_features.float())
 
         return values, rnn_states
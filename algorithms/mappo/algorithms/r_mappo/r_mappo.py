@@ -1,10 +1,12 @@
 import numpy as np
 import torch
 import torch.nn as nn
-from algorithms.mappo.utils.util import get_gard_norm, huber_loss, mse_loss
+from algorithms.mappo.utils.util import clip_grad_norms_, get_gard_norm, huber_loss, mse_loss
 from algorithms.mappo.utils.valuenorm import ValueNorm
 from algorithms.mappo.algorithms.utils.util import check
 
+TRAIN_INFO_KEYS = ('value_loss', 'policy_loss', 'dist_entropy', 'actor_grad_norm', 'critic_grad_norm', 'ratio')
+
 class R_MAPPO():
     """
     Trainer class for MAPPO to update policies.
@@ -39,6 +41,10 @@ class R_MAPPO():
         self._use_valuenorm = args.use_valuenorm
         self._use_value_active_masks = args.use_value_active_masks
         self._use_policy_active_masks = args.use_policy_active_masks
+        self._use_bf16_autocast = getattr(args, 'use_bf16_autocast', False)
+        self._use_fused_optimizer = getattr(policy, '_use_fused_optimizer', False)
+        self._use_cached_critic_input = getattr(args, 'use_cached_critic_input', False) \
+                                        and args.use_feature_normalization
         
         assert (self._use_popart and self._use_valuenorm) == False, ("self._use_popart and self._use_valuenorm can not be set True simultaneously")
         
@@ -49,6 +55,13 @@ class R_MAPPO():
         else:
             self.value_normalizer = None
 
+    def autocast(self):
+        """
+        Context for the training forward passes. With use_bf16_autocast the network trunks run in bfloat16, while
+        weights, optimizer state, action/value heads, value normalization and losses stay in float32.
+        """
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self._use_bf16_autocast)
+
     def cal_value_loss(self, values, value_preds_batch, return_batch, active_masks_batch):
         """
         Calculate value function loss.
@@ -88,6 +101,31 @@ class R_MAPPO():
 
         return value_loss
 
+    def cal_policy_loss(self, action_log_probs, old_action_log_probs_batch, adv_targ, active_masks_batch):
+        """
+        Calculate the clipped surrogate policy loss.
+        :param action_log_probs: (torch.Tensor) log probabilities of the batch actions under the current policy.
+        :param old_action_log_probs_batch: (torch.Tensor) log probabilities from the data batch.
+        :param adv_targ: (torch.Tensor) advantage estimates.
+        :param active_masks_batch: (torch.Tensor) denotes if agent is active or dead at a given timesep.
+
+        :return policy_loss: (torch.Tensor) actor(policy) loss value.
+        :return imp_weights: (torch.Tensor) importance sampling weights.
+        """
+        imp_weights = torch.exp(action_log_probs - old_action_log_probs_batch)
+
+        surr1 = imp_weights * adv_targ
+        surr2 = torch.clamp(imp_weights, 1.0 - self.clip_param, 1.0 + self.clip_param) * adv_targ
+
+        if self._use_policy_active_masks:
+            policy_action_loss = (-torch.sum(torch.min(surr1, surr2),
+                                             dim=-1,
+                                             keepdim=True) * active_masks_batch).sum() / active_masks_batch.sum()
+        else:
+            policy_action_loss = -torch.sum(torch.min(surr1, surr2), dim=-1, keepdim=True).mean()
+
+        return policy_action_loss, imp_weights
+
     def ppo_update(self, sample, update_actor=True):
         """
         Update actor and critic networks.
@@ -112,56 +150,89 @@ class R_MAPPO():
         active_masks_batch = check(active_masks_batch).to(**self.tpdv)
 
         # Reshape to do in a single forward pass for all steps
-        values, action_log_probs, dist_entropy = self.policy.evaluate_actions(share_obs_batch,
-                                                                              obs_batch, 
-                                                                              rnn_states_batch, 
-                                                                              rnn_states_critic_batch, 
-                                                                              actions_batch, 
-                                                                              masks_batch, 
-                                                                              available_actions_batch,
-                                                                              active_masks_batch)
+        with self.autocast():
+            values, action_log_probs, dist_entropy = self.policy.evaluate_actions(share_obs_batch,
+                                                                                  obs_batch, 
+                                                                                  rnn_states_batch, 
+                                                                                  rnn_states_critic_batch, 
+                                                                                  actions_batch, 
+                                                                                  masks_batch, 
+                                                                                  available_actions_batch,
+                                                                                  active_masks_batch,
+                                                                                  self._use_cached_critic_input)
         # actor update
-        imp_weights = torch.exp(action_log_probs - old_action_log_probs_batch)
-
-        surr1 = imp_weights * adv_targ
-        surr2 = torch.clamp(imp_weights, 1.0 - self.clip_param, 1.0 + self.clip_param) * adv_targ
+        policy_loss, imp_weights = self.cal_policy_loss(action_log_probs, old_action_log_probs_batch, adv_targ,
+                                                        active_masks_batch)
 
-        if self._use_policy_active_masks:
-            policy_action_loss = (-torch.sum(torch.min(surr1, surr2),
-                                             dim=-1,
-                                             keepdim=True) * active_masks_batch).sum() / active_masks_batch.sum()
-        else:
-            policy_action_loss = -torch.sum(torch.min(surr1, surr2), dim=-1, keepdim=True).mean()
-
-        policy_loss = policy_action_loss
+        value_loss = self.cal_value_loss(values, value_preds_batch, return_batch, active_masks_batch)
 
-        self.policy.actor_optimizer.zero_grad()
+        self.zero_grad()
 
+        # the actor and critic share no parameters, one backward pass of the summed loss gives both their gradients
+        loss = value_loss * self.value_loss_coef
         if update_actor:
-            (policy_loss - dist_entropy * self.entropy_coef).backward()
+            loss = loss + policy_loss - dist_entropy * self.entropy_coef
+        loss.backward()
 
-        if self._use_max_grad_norm:
-            actor_grad_norm = nn.utils.clip_grad_norm_(self.policy.actor.parameters(), self.max_grad_norm)
-        else:
-            actor_grad_norm = get_gard_norm(self.policy.actor.parameters())
+        actor_grad_norm, critic_grad_norm = self.optimizer_step()
 
-        self.policy.actor_optimizer.step()
+        return value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm, imp_weights
 
-        # critic update
-        value_loss = self.cal_value_loss(values, value_preds_batch, return_batch, active_masks_batch)
+    def zero_grad(self):
+        """
+        Reset the gradients of the actor and critic.
+        """
+        if self._use_fused_optimizer:
+            self.policy.optimizer.zero_grad()
+        else:
+            self.policy.actor_optimizer.zero_grad()
+            self.policy.critic_optimizer.zero_grad()
 
-        self.policy.critic_optimizer.zero_grad()
+    def optimizer_step(self):
+        """
+        Clip (or only measure) the actor and critic gradients and update both networks.
 
-        (value_loss * self.value_loss_coef).backward()
+        :return actor_grad_norm: (torch.Tensor) gradient norm of the actor.
+        :return critic_grad_norm: (torch.Tensor) gradient norm of the critic.
+        """
+        if self._use_fused_optimizer:
+            actor_grad_norm, critic_grad_norm = clip_grad_norms_(
+                [self.policy.actor.parameters(), self.policy.critic.parameters()],
+                self.max_grad_norm if self._use_max_grad_norm else None)
+            self.policy.optimizer.step()
+            return actor_grad_norm, critic_grad_norm
 
         if self._use_max_grad_norm:
+            actor_grad_norm = nn.utils.clip_grad_norm_(self.policy.actor.parameters(), self.max_grad_norm)
             critic_grad_norm = nn.utils.clip_grad_norm_(self.policy.critic.parameters(), self.max_grad_norm)
         else:
+            actor_grad_norm = get_gard_norm(self.policy.actor.parameters())
             critic_grad_norm = get_gard_norm(self.policy.critic.parameters())
 
+        self.policy.actor_optimizer.step()
         self.policy.critic_optimizer.step()
+        return actor_grad_norm, critic_grad_norm
 
-        return value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm, imp_weights
+    def compute_advantages(self, buffer):
+        """
+        Compute advantages normalized over the active entries of the buffer.
+        :param buffer: (SharedReplayBuffer) buffer containing training data.
+
+        :return advantages: (np.ndarray) normalized advantages.
+        """
+        returns = check(buffer.returns[:-1]).to(**self.tpdv)
+        if self._use_popart or self._use_valuenorm:
+            value_preds = check(self.value_normalizer.denormalize(buffer.value_preds[:-1])).to(**self.tpdv)
+        else:
+            value_preds = check(buffer.value_preds[:-1]).to(**self.tpdv)
+        advantages = returns - value_preds
+
+        active = check(buffer.active_masks[:-1]).to(**self.tpdv) != 0.0
+        num_active = active.sum()
+        mean_advantages = torch.where(active, advantages, 0.0).sum() / num_active
+        std_advantages = (torch.where(active, advantages - mean_advantages, 0.0) ** 2).sum().div(num_active).sqrt()
+        advantages = (advantages - mean_advantages) / (std_advantages + 1e-5)
+        return advantages.cpu().numpy()
 
     def train(self, buffer, update_actor=True):
         """
@@ -171,25 +242,12 @@ class R_MAPPO():
 
         :return train_info: (dict) contains information regarding training update (e.g. loss, grad norms, etc).
         """
-        if self._use_popart or self._use_valuenorm:
-            advantages = buffer.returns[:-1] - self.value_normalizer.denormalize(buffer.value_preds[:-1])
-        else:
-            advantages = buffer.returns[:-1] - buffer.value_preds[:-1]
-        advantages_copy = advantages.copy()
-        advantages_copy[buffer.active_masks[:-1] == 0.0] = np.nan
-        mean_advantages = np.nanmean(advantages_copy)
-        std_advantages = np.nanstd(advantages_copy)
-        advantages = (advantages - mean_advantages) / (std_advantages + 1e-5)
-        
-
-        train_info = {}
+        advantages = self.compute_advantages(buffer)
+        if self._use_cached_critic_input and buffer.critic_inputs is None:
+            buffer.cache_critic_inputs()
 
-        train_info['value_loss'] = 0
-        train_info['policy_loss'] = 0
-        train_info['dist_entropy'] = 0
-        train_info['actor_grad_norm'] = 0
-        train_info['critic_grad_norm'] = 0
-        train_info['ratio'] = 0
+        # Statistics stay on the device and are read back once at the end of the update.
+        train_stats = torch.zeros(len(TRAIN_INFO_KEYS), **self.tpdv)
 
         for _ in range(self.ppo_epoch):
             if self._use_recurrent_policy:
@@ -204,19 +262,13 @@ class R_MAPPO():
                 value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm, imp_weights \
                     = self.ppo_update(sample, update_actor)
 
-                train_info['value_loss'] += value_loss.item()
-                train_info['policy_loss'] += policy_loss.item()
-                train_info['dist_entropy'] += dist_entropy.item()
-                train_info['actor_grad_norm'] += actor_grad_norm
-                train_info['critic_grad_norm'] += critic_grad_norm
-                train_info['ratio'] += imp_weights.mean()
+                train_stats += torch.stack([value_loss.detach(), policy_loss.detach(), dist_entropy.detach(),
+                                            actor_grad_norm.to(**self.tpdv), critic_grad_norm.to(**self.tpdv),
+                                            imp_weights.detach().mean()])
 
         num_updates = self.ppo_epoch * self.num_mini_batch
 
-        for k in train_info.keys():
-            train_info[k] /= num_updates
- 
-        return train_info
+        return dict(zip(TRAIN_INFO_KEYS, (train_stats / num_updates).tolist()))
 
     def prep_training(self):
         self.policy.actor.train()
@@ -0,0 +1,201 @@
+import numpy as np
+import torch
+from algorithms.mappo.algorithms.utils.util import check
+from algorithms.mappo.algorithms.r_mappo.r_mappo import TRAIN_INFO_KEYS
+from algorithms.mappo.algorithms.r_mappo.algorithm.grouped_actor_critic import GroupedActor, GroupedCritic, \
+    stack_parameters, supports_actor
+
+
+class R_MAPPOBatched():
+    """
+    Runs the PPO updates of several independent R_MAPPO trainers in lockstep. Every agent is trained on the
+    same minibatch indices, the forward passes of all agents run as one grouped computation (see GroupedActor) and
+    a single backward pass is taken per minibatch. Each agent keeps its own networks, optimizers and value normalizer.
+    :param args: (argparse.Namespace) arguments containing relevant model, policy, and env information.
+    :param trainers: (list) one R_MAPPO trainer per agent.
+    :param device: (torch.device) specifies the device to run on (cpu/gpu).
+    """
+    def __init__(self,
+                 args,
+                 trainers,
+                 device=torch.device("cpu")):
+
+        self.device = device
+        self.tpdv = dict(dtype=torch.float32, device=device)
+        self.trainers = trainers
+        self.num_agents = len(trainers)
+
+        self.ppo_epoch = args.ppo_epoch
+        self.num_mini_batch = args.num_mini_batch
+        self.data_chunk_length = args.data_chunk_length
+        self.value_loss_coef = args.value_loss_coef
+        self.entropy_coef = args.entropy_coef
+
+        self._use_recurrent_policy = args.use_recurrent_policy
+        self._use_naive_recurrent = args.use_naive_recurrent_policy
+
+        assert supports_actor(trainers[0].policy.actor), (
+            "--use_batched_train needs a Tuple(Box, Discrete) action space")
+        self.actor_params = self.critic_params = self._agent_params = None
+
+    def _stack(self, xs):
+        if xs[0] is None:
+            return None
+        return check(np.stack(xs)).to(**self.tpdv)
+
+    @torch.no_grad()
+    def stack_parameters(self):
+        """
+        Stack the actor and critic parameters of all agents into leaf tensors with a leading agent dimension, and
+        make the parameters of every agent views of them. The per-agent optimizers then update the stacked tensors
+        in place and the grouped forward passes need no copies per minibatch.
+        """
+        stacked = []
+        # (parameter, stacked tensor) of every agent, its gradients are set after each backward pass
+        self._agent_params = [[] for _ in self.trainers]
+        for networks in ([tr.policy.actor for tr in self.trainers], [tr.policy.critic for tr in self.trainers]):
+            params = stack_parameters(networks)
+            for name, param in networks[0].named_parameters():
+                params[name].requires_grad_(param.requires_grad)
+            for agent_id, network in enumerate(networks):
+                for name, param in network.named_parameters():
+                    param.data = params[name][agent_id]
+                    self._agent_params[agent_id].append((param, params[name]))
+            stacked.append(params)
+        self.actor_params, self.critic_params = stacked
+
+    @torch.no_grad()
+    def unstack_parameters(self):
+        """
+        Give the parameters of every agent their own storage again, undoing stack_parameters.
+        """
+        for trainer in self.trainers:
+            for network in (trainer.policy.actor, trainer.policy.critic):
+                for param in network.parameters():
+                    param.data = param.data.clone()
+        self.actor_params = self.critic_params = self._agent_params = None
+
+    def _evaluate_actions(self, samples):
+        """
+        Forward pass of every agent on its own minibatch, must run between stack_parameters and unstack_parameters.
+        :param samples: (list) one data batch per agent, as yielded by the buffer generators.
+
+        :return values: (torch.Tensor) value predictions, stacked along a leading agent dimension.
+        :return action_log_probs: (torch.Tensor) log probabilities of the batch actions, stacked along agents.
+        :return dist_entropy: (torch.Tensor) action distribution entropy of every agent.
+        """
+        share_obs, obs, rnn_states, rnn_states_critic, actions, masks, available_actions, active_masks = [
+            self._stack([sample[i] for sample in samples]) for i in (0, 1, 2, 3, 4, 7, 11, 8)]
+
+        policy = self.trainers[0].policy
+        actor = GroupedActor(self.actor_params, policy.actor)
+        critic = GroupedCritic(self.critic_params, policy.critic)
+        action_log_probs, dist_entropy = actor.evaluate_actions(obs, rnn_states, actions, masks, available_actions,
+                                                                active_masks)
+        values, _ = critic(share_obs, rnn_states_critic, masks, self.trainers[0]._use_cached_critic_input)
+        return values, action_log_probs, dist_entropy
+
+    def ppo_update(self, samples, update_actor=True):
+        """
+        Update the actor and critic networks of all agents.
+        :param samples: (list) one data batch per agent, drawn with shared minibatch indices.
+        :update_actor: (bool) whether to update actor networks.
+
+        :return infos: (list) per agent (value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm,
+                       imp_weights), as returned by R_MAPPO.ppo_update.
+        """
+        with self.trainers[0].autocast():
+            values, action_log_probs, dist_entropy = self._evaluate_actions(samples)
+
+        losses = []
+        infos = []
+        for agent_id, (trainer, sample) in enumerate(zip(self.trainers, samples)):
+            value_preds_batch, return_batch, active_masks_batch, old_action_log_probs_batch, adv_targ = [
+                check(sample[i]).to(**self.tpdv) for i in (5, 6, 8, 9, 10)]
+
+            policy_loss, imp_weights = trainer.cal_policy_loss(action_log_probs[agent_id],
+                                                               old_action_log_probs_batch, adv_targ,
+                                                               active_masks_batch)
+            value_loss = trainer.cal_value_loss(values[agent_id], value_preds_batch, return_batch,
+                                                active_masks_batch)
+            if update_actor:
+                losses.append(policy_loss - dist_entropy[agent_id] * self.entropy_coef)
+            losses.append(value_loss * self.value_loss_coef)
+            infos.append((value_loss, policy_loss, dist_entropy[agent_id], imp_weights))
+
+        for stacked in (self.actor_params, self.critic_params):
+            for param in stacked.values():
+                param.grad = None
+        torch.stack(losses).sum().backward()
+
+        results = []
+        for agent_id, trainer in enumerate(self.trainers):
+            # the gradients of an agent are views of the stacked gradients, like its parameters
+            for param, stacked in self._agent_params[agent_id]:
+                param.grad = None if stacked.grad is None else stacked.grad[agent_id]
+
+            actor_grad_norm, critic_grad_norm = trainer.optimizer_step()
+
+            value_loss, policy_loss, agent_entropy, imp_weights = infos[agent_id]
+            results.append((value_loss, critic_grad_norm, policy_loss, agent_entropy, actor_grad_norm, imp_weights))
+
+        return results
+
+    def train(self, buffers, update_actor=True):
+        """
+        Perform a lockstep training update of all agents using minibatch GD.
+        :param buffers: (list) one SeparatedReplayBuffer per agent.
+        :param update_actor: (bool) whether to update actor networks.
+
+        :return train_infos: (list) per agent dicts with the same entries as R_MAPPO.train.
+        """
+        advantages = [trainer.compute_advantages(buffer) for trainer, buffer in zip(self.trainers, buffers)]
+        for trainer, buffer in zip(self.trainers, buffers):
+            if trainer._use_cached_critic_input and buffer.critic_inputs is None:
+                buffer.cache_critic_inputs()
+
+        train_stats = torch.zeros(self.num_agents, len(TRAIN_INFO_KEYS), **self.tpdv)
+
+        self.stack_parameters()
+        try:
+            self._train_epochs(buffers, advantages, train_stats, update_actor)
+        finally:
+            self.unstack_parameters()
+
+        num_updates = self.ppo_epoch * self.num_mini_batch
+
+        return [dict(zip(TRAIN_INFO_KEYS, agent_stats)) for agent_stats in (train_stats / num_updates).tolist()]
+
+    def _train_epochs(self, buffers, advantages, train_stats, update_actor):
+        episode_length, n_rollout_threads = buffers[0].rewards.shape[0:2]
+        for _ in range(self.ppo_epoch):
+            if self._use_recurrent_policy:
+                perm = torch.randperm(episode_length * n_rollout_threads // self.data_chunk_length).numpy()
+                data_generators = [buffer.recurrent_generator(adv, self.num_mini_batch, self.data_chunk_length,
+                                                              perm=perm)
+                                   for buffer, adv in zip(buffers, advantages)]
+            elif self._use_naive_recurrent:
+                perm = torch.randperm(n_rollout_threads).numpy()
+                data_generators = [buffer.naive_recurrent_generator(adv, self.num_mini_batch, perm=perm)
+                                   for buffer, adv in zip(buffers, advantages)]
+            else:
+                perm = torch.randperm(episode_length * n_rollout_threads).numpy()
+                data_generators = [buffer.feed_forward_generator(adv, self.num_mini_batch, perm=perm)
+                                   for buffer, adv in zip(buffers, advantages)]
+
+            for samples in zip(*data_generators):
+                results = self.ppo_update(samples, update_actor)
+
+                train_stats += torch.stack([torch.stack([value_loss.detach(), policy_loss.detach(), dist_entropy.detach(),
+                                                         actor_grad_norm.to(**self.tpdv), critic_grad_norm.to(**self.tpdv),
+                                                         imp_weights.detach().mean()])
+                                            for value_loss, critic_grad_norm, policy_loss, dist_entropy,
+                                                actor_grad_norm, imp_weights in results])
+
+    def prep_training(self):
+        for trainer in self.trainers:
+            trainer.prep_training()
+
+    def prep_rollout(self):
+        for trainer in self.trainers:
+            trainer.prep_rollout()
@@ -1,6 +1,10 @@
+import math
 from .distributions import Bernoulli, Categorical, DiagGaussian, DiagBeta
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+_LOG_SQRT_2PI = 0.5 * math.log(2 * math.pi)
 
 class ACTLayer(nn.Module):
     """
@@ -165,3 +169,163 @@ class ACTLayer(nn.Module):
                 dist_entropy = action_logits.entropy().mean()
         
         return action_log_probs, dist_entropy
+
+
+class MixedACTLayer(nn.Module):
+    """
+    Action head for Tuple(Box, Discrete) action spaces. The Gaussian mean, log std and the categorical logits come
+    out of a single Linear layer, and sampling, log probabilities and entropies are computed with closed form tensor
+    math instead of torch.distributions objects. Log probabilities keep the per dimension layout of the separate
+    DiagGaussian and Categorical heads: (continuous_dim + 1) columns, the categorical log probability last.
+    Parameters are normally filled from the ACTLayer state dicts of the separate heads via fuse_state_dicts.
+    :param action_space: (gym.Space) Tuple(Box, Discrete) action space.
+    :param inputs_dim: (int) dimension of network input.
+    :param use_orthogonal: (bool) whether to use orthogonal initialization.
+    :param gain: (float) gain of the output layer of the network.
+    :param separate_inputs: (bool) if set, the input is a (continuous input, discrete input) pair, the mean and log
+                            std rows of the layer are applied to x[0] and the logit rows to x[1].
+    """
+    def __init__(self, action_space, inputs_dim, use_orthogonal, gain, separate_inputs=False):
+        super(MixedACTLayer, self).__init__()
+        self.continuous_dim = action_space[0].shape[0]
+        self.discrete_dim = action_space[1].n
+        self.separate_inputs = separate_inputs
+
+        # kept in the state dict so that split_state_dict can recover the separate heads
+        self.register_buffer('action_dims', torch.tensor([self.continuous_dim, self.discrete_dim]))
+
+        init_method = [nn.init.xavier_uniform_, nn.init.orthogonal_][use_orthogonal]
+        self.linear = nn.Linear(inputs_dim, 2 * self.continuous_dim + self.discrete_dim)
+        for weight in self.linear.weight.data.split((self.continuous_dim, self.continuous_dim, self.discrete_dim)):
+            init_method(weight, gain=gain)
+        nn.init.constant_(self.linear.bias.data, 0)
+
+    def _head(self, x, available_actions=None):
+        c = self.continuous_dim
+        if not self.separate_inputs:
+            out = self.linear(x)
+            action_mean, action_logstd, logits = out[..., :c], out[..., c:2 * c], out[..., 2 * c:]
+        elif isinstance(self.linear, nn.Linear):
+            weight, bias = self.linear.weight, self.linear.bias
+            action_mean, action_logstd = F.linear(x[0], weight[:2 * c], bias[:2 * c]).chunk(2, -1)
+            logits = F.linear(x[1], weight[2 * c:], bias[2 * c:])
+        else:
+            # int8 rollout copies (utils.misc.quantized_copy) hold packed weights that cannot be sliced by rows
+            out = self.linear(torch.stack(x))
+            action_mean, action_logstd, logits = out[0, ..., :c], out[0, ..., c:2 * c], out[1, ..., 2 * c:]
+        if available_actions is not None:
+            logits = logits.masked_fill(available_actions == 0, -1e10)
+        return action_mean, torch.clamp(action_logstd, min=-6, max=2), F.log_softmax(logits, -1)
+
+    @staticmethod
+    def _normal_log_probs(actions, action_mean, action_logstd):
+        return -((actions - action_mean) ** 2) / (2 * torch.exp(2 * action_logstd)) - action_logstd - _LOG_SQRT_2PI
+
+    @staticmethod
+    def sample_actions(action_mean, action_logstd, log_probs, deterministic=False):
+        """
+        Draw actions from the Gaussian and the categorical given by the head outputs.
+        :param action_mean: (torch.Tensor) Gaussian mean.
+        :param action_logstd: (torch.Tensor) clamped Gaussian log std.
+        :param log_probs: (torch.Tensor) normalized categorical log probabilities.
+        :param deterministic: (bool) whether to sample from action distribution or return the mode.
+
+        :return actions: (torch.Tensor) continuous actions followed by the discrete action.
+        :return action_log_probs: (torch.Tensor) log probabilities of taken actions.
+        """
+        if deterministic:
+            continuous = action_mean
+            discrete = log_probs.argmax(-1, keepdim=True)
+        else:
+            with torch.no_grad():
+                continuous = action_mean + torch.exp(action_logstd) * torch.randn_like(action_mean)
+                # Gumbel-max sampling of the categorical
+                gumbels = -torch.log(-torch.log(torch.rand_like(log_probs).clamp_(min=1e-20)))
+                discrete = (log_probs + gumbels).argmax(-1, keepdim=True)
+
+        actions = torch.cat((continuous, discrete.to(continuous.dtype)), -1)
+        action_log_probs = torch.cat((MixedACTLayer._normal_log_probs(continuous, action_mean, action_logstd),
+                                      log_probs.gather(-1, discrete)), -1)
+        return actions, action_log_probs
+
+    @staticmethod
+    def score_actions(action, action_mean, action_logstd, log_probs):
+        """
+        Log probabilities of given actions and entropies of the distributions given by the head outputs.
+        :param action: (torch.Tensor) continuous actions followed by the discrete action.
+
+        :return action_log_probs: (torch.Tensor) log probabilities of the input actions.
+        :return entropy: (torch.Tensor) summed entropy of both action distributions, per sample.
+        """
+        continuous, discrete = action.split((action_mean.size(-1), 1), -1)
+        action_log_probs = torch.cat((MixedACTLayer._normal_log_probs(continuous, action_mean, action_logstd),
+                                      log_probs.gather(-1, discrete.long())), -1)
+        entropy = (action_logstd + 0.5 + _LOG_SQRT_2PI).sum(-1) - (log_probs.exp() * log_probs).sum(-1)
+        return action_log_probs, entropy
+
+    def forward(self, x, available_actions=None, deterministic=False):
+        """
+        Compute actions and action logprobs from given input.
+        :param x: (torch.Tensor) input to network.
+        :param available_actions: (torch.Tensor) denotes which discrete actions are available to agent
+                                  (if None, all actions available)
+        :param deterministic: (bool) whether to sample from action distribution or return the mode.
+
+        :return actions: (torch.Tensor) continuous actions followed by the discrete action.
+        :return action_log_probs: (torch.Tensor) log probabilities of taken actions.
+        """
+        return self.sample_actions(*self._head(x, available_actions), deterministic)
+
+    def evaluate_actions(self, x, action, available_actions=None, active_masks=None):
+        """
+        Compute log probability and entropy of given actions.
+        :param x: (torch.Tensor) input to network.
+        :param action: (torch.Tensor) continuous actions followed by the discrete action.
+        :param available_actions: (torch.Tensor) denotes which discrete actions are available to agent
+                                  (if None, all actions available)
+        :param active_masks: (torch.Tensor) denotes whether an agent is active or dead.
+
+        :return action_log_probs: (torch.Tensor) log probabilities of the input actions.
+        :return dist_entropy: (torch.Tensor) summed entropy of both action distributions for the given inputs.
+        """
+        action_log_probs, entropy = self.score_actions(action, *self._head(x, available_actions))
+        if active_masks is not None:
+            dist_entropy = (entropy * active_masks.squeeze(-1)).sum() / active_masks.sum()
+        else:
+            dist_entropy = entropy.mean()
+        return action_log_probs, dist_entropy
+
+    @staticmethod
+    def fuse_state_dicts(continuous_state_dict, discrete_state_dict):
+        """
+        Build a MixedACTLayer state dict from the state dicts of a Box and a Discrete ACTLayer.
+        :param continuous_state_dict: (dict) state dict of the ACTLayer with a DiagGaussian head.
+        :param discrete_state_dict: (dict) state dict of the ACTLayer with a Categorical head.
+
+        :return state_dict: (dict) state dict in the fused layout.
+        """
+        fused = {'linear.' + p: torch.cat([continuous_state_dict['action_out.fc_mean.' + p],
+                                           continuous_state_dict['action_out.logstd.' + p],
+                                           discrete_state_dict['action_out.linear.' + p]])
+                 for p in ('weight', 'bias')}
+        fused['action_dims'] = torch.tensor([continuous_state_dict['action_out.fc_mean.bias'].size(0),
+                                             discrete_state_dict['action_out.linear.bias'].size(0)])
+        return fused
+
+    @staticmethod
+    def split_state_dict(state_dict):
+        """
+        Inverse of fuse_state_dicts.
+        :param state_dict: (dict) MixedACTLayer state dict.
+
+        :return continuous_state_dict: (dict) state dict of the ACTLayer with a DiagGaussian head.
+        :return discrete_state_dict: (dict) state dict of the ACTLayer with a Categorical head.
+        """
+        continuous_dim, discrete_dim = state_dict['action_dims'].tolist()
+        continuous, discrete = {}, {}
+        for p in ('weight', 'bias'):
+            mean, logstd, linear = state_dict['linear.' + p].split((continuous_dim, continuous_dim, discrete_dim))
+            continuous['action_out.fc_mean.' + p] = mean
+            continuous['action_out.logstd.' + p] = logstd
+            discrete['action_out.linear.' + p] = linear
+        return continuous, discrete
@@ -1,9 +1,15 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from .util import init, get_clones
 
 """MLP modules."""
 
+# With autograd, FusedMLPBase only runs the grouped kernels up to this many rows * hidden_size elements per trunk.
+# Their backward reduces the (groups, 1, hidden_size) norm parameters over the whole batch and falls behind one
+# matmul per trunk above it (see scripts/benchmarks/fused_trunk.py).
+_GROUPED_BACKWARD_MAX_ELEMENTS = 32768
+
 class MLPLayer(nn.Module):
     def __init__(self, input_dim, hidden_size, layer_N, use_orthogonal, use_ReLU):
         super(MLPLayer, self).__init__()
@@ -48,10 +54,145 @@ class MLPBase(nn.Module):
         self.mlp = MLPLayer(obs_dim, self.hidden_size,
                               self._layer_N, self._use_orthogonal, self._use_ReLU)
 
-    def forward(self, x):
+    def forward(self, x, normalized_input=False):
         if self._use_feature_normalization:
-            x = self.feature_norm(x)
+            if normalized_input:
+                # x is already standardized (see standardize_features), only the affine part of the norm is left
+                x = x * self.feature_norm.weight + self.feature_norm.bias
+            else:
+                x = self.feature_norm(x)
 
         x = self.mlp(x)
 
-        return x
\ No newline at end of file
+        return x
+
+
+class FusedMLPBase(nn.Module):
+    """
+    Several MLPBase trunks fed with the same input, evaluated as one grouped computation.
+    Every layer holds the weights of all trunks stacked along a leading group dimension and runs as a single batched
+    matmul. With autograd and large batches (training minibatches) the trunks run one after the other on their
+    slices instead, which is faster there.
+    Parameters are normally filled from separate MLPBase state dicts via fuse_state_dicts.
+    :param args: (argparse.Namespace) arguments containing relevant model information.
+    :param hidden_size: (int) hidden size of every trunk.
+    :param obs_shape: (tuple) input shape.
+    :param num_groups: (int) number of fused trunks.
+    """
+    def __init__(self, args, hidden_size, obs_shape, num_groups=2):
+        super(FusedMLPBase, self).__init__()
+
+        self._use_feature_normalization = args.use_feature_normalization
+        self._use_ReLU = args.use_ReLU
+        self._layer_N = args.layer_N
+        self.hidden_size = hidden_size
+        self.num_groups = num_groups
+
+        obs_dim = obs_shape[0]
+
+        if self._use_feature_normalization:
+            self.feature_norm_weight = nn.Parameter(torch.ones(num_groups, 1, obs_dim))
+            self.feature_norm_bias = nn.Parameter(torch.zeros(num_groups, 1, obs_dim))
+
+        dims = [obs_dim] + [hidden_size] * (self._layer_N + 1)
+        self.weights = nn.ParameterList(
+            [nn.Parameter(torch.zeros(num_groups, dims[i], dims[i + 1])) for i in range(self._layer_N + 1)])
+        self.biases = nn.ParameterList(
+            [nn.Parameter(torch.zeros(num_groups, 1, hidden_size)) for _ in range(self._layer_N + 1)])
+        self.norm_weights = nn.ParameterList(
+            [nn.Parameter(torch.ones(num_groups, 1, hidden_size)) for _ in range(self._layer_N + 1)])
+        self.norm_biases = nn.ParameterList(
+            [nn.Parameter(torch.zeros(num_groups, 1, hidden_size)) for _ in range(self._layer_N + 1)])
+
+    def forward(self, x):
+        """
+        :param x: (torch.Tensor) input of shape (batch, obs_dim).
+
+        :return features: (tuple) features of every trunk, each of shape (batch, hidden_size).
+        """
+        if torch.is_grad_enabled() and x.size(0) * self.hidden_size > _GROUPED_BACKWARD_MAX_ELEMENTS:
+            # every parameter is unbound once, indexing it per trunk zero fills its gradient
+            layers = [list(zip(*[p.unbind(0) for p in params])) for params in
+                      zip(self.weights, self.biases, self.norm_weights, self.norm_biases)]
+            feature_norms = zip(self.feature_norm_weight.unbind(0), self.feature_norm_bias.unbind(0)) \
+                if self._use_feature_normalization else [None] * self.num_groups
+            return tuple(self._group_forward(x, feature_norm, [layer[g] for layer in layers])
+                         for g, feature_norm in enumerate(feature_norms))
+
+        if self._use_feature_normalization:
+            x = torch.addcmul(self.feature_norm_bias, F.layer_norm(x, x.shape[-1:]), self.feature_norm_weight)
+        else:
+            x = x.expand(self.num_groups, *x.shape)
+
+        for weight, bias, norm_weight, norm_bias in zip(self.weights, self.biases,
+                                                        self.norm_weights, self.norm_biases):
+            x = torch.baddbmm(bias, x, weight)
+            x = torch.relu(x) if self._use_ReLU else torch.tanh(x)
+            x = torch.addcmul(norm_bias, F.layer_norm(x, x.shape[-1:]), norm_weight)
+        return x.unbind(0)
+
+    def _group_forward(self, x, feature_norm, layers):
+        if feature_norm is not None:
+            x = F.layer_norm(x, x.shape[-1:], feature_norm[0][0], feature_norm[1][0])
+
+        for weight, bias, norm_weight, norm_bias in layers:
+            x = torch.addmm(bias, x, weight)
+            x = torch.relu(x) if self._use_ReLU else torch.tanh(x)
+            x = F.layer_norm(x, x.shape[-1:], norm_weight[0], norm_bias[0])
+        return x
+
+    @staticmethod
+    def fuse_state_dicts(state_dicts):
+        """
+        Build a FusedMLPBase state dict from the state dicts of separate MLPBase trunks.
+        :param state_dicts: (list) one MLPBase state dict per group.
+
+        :return state_dict: (dict) state dict in the fused layout.
+        """
+        first = state_dicts[0]
+        layers = ['mlp.fc1'] + ['mlp.fc2.%d' % i for i in range(len(first)) if 'mlp.fc2.%d.0.weight' % i in first]
+
+        fused = {}
+        if 'feature_norm.weight' in first:
+            fused['feature_norm_weight'] = torch.stack([sd['feature_norm.weight'].unsqueeze(0) for sd in state_dicts])
+            fused['feature_norm_bias'] = torch.stack([sd['feature_norm.bias'].unsqueeze(0) for sd in state_dicts])
+        for i, layer in enumerate(layers):
+            fused['weights.%d' % i] = torch.stack([sd[layer + '.0.weight'].t() for sd in state_dicts])
+            fused['biases.%d' % i] = torch.stack([sd[layer + '.0.bias'].unsqueeze(0) for sd in state_dicts])
+            fused['norm_weights.%d' % i] = torch.stack([sd[layer + '.2.weight'].unsqueeze(0) for sd in state_dicts])
+            fused['norm_biases.%d' % i] = torch.stack([sd[layer + '.2.bias'].unsqueeze(0) for sd in state_dicts])
+        return fused
+
+    @staticmethod
+    def split_state_dict(state_dict):
+        """
+        Inverse of fuse_state_dicts. MLPLayer.fc_h is not used in the forward pass and is restored from the
+        first hidden layer (or zeros when layer_N is 0).
+        :param state_dict: (dict) FusedMLPBase state dict.
+
+        :return state_dicts: (list) one MLPBase state dict per group.
+        """
+        num_groups = state_dict['weights.0'].size(0)
+        num_layers = len([k for k in state_dict if k.startswith('weights.')])
+        layers = ['mlp.fc1'] + ['mlp.fc2.%d' % i for i in range(num_layers - 1)]
+
+        state_dicts = [{} for _ in range(num_groups)]
+        for g, sd in enumerate(state_dicts):
+            if 'feature_norm_weight' in state_dict:
+                sd['feature_norm.weight'] = state_dict['feature_norm_weight'][g, 0]
+                sd['feature_norm.bias'] = state_dict['feature_norm_bias'][g, 0]
+            for i, layer in enumerate(layers):
+                sd[layer + '.0.weight'] = state_dict['weights.%d' % i][g].t()
+                sd[layer + '.0.bias'] = state_dict['biases.%d' % i][g, 0]
+                sd[layer + '.2.weight'] = state_dict['norm_weights.%d' % i][g, 0]
+                sd[layer + '.2.bias'] = state_dict['norm_biases.%d' % i][g, 0]
+            hidden_size = sd['mlp.fc1.0.bias'].size(0)
+            if num_layers > 1:
+                for suffix in ('.0.weight', '.0.bias', '.2.weight', '.2.bias'):
+                    sd['mlp.fc_h' + suffix] = sd['mlp.fc2.0' + suffix]
+            else:
+                sd['mlp.fc_h.0.weight'] = torch.zeros(hidden_size, hidden_size)
+                sd['mlp.fc_h.0.bias'] = torch.zeros(hidden_size)
+                sd['mlp.fc_h.2.weight'] = torch.ones(hidden_size)
+                sd['mlp.fc_h.2.bias'] = torch.zeros(hidden_size)
+        return state_dicts
@@ -5,10 +5,11 @@ import torch.nn as nn
 
 
 class RNNLayer(nn.Module):
-    def __init__(self, inputs_dim, outputs_dim, recurrent_N, use_orthogonal):
+    def __init__(self, inputs_dim, outputs_dim, recurrent_N, use_orthogonal, use_packed_sequences=False):
         super(RNNLayer, self).__init__()
         self._recurrent_N = recurrent_N
         self._use_orthogonal = use_orthogonal
+        self._use_packed_sequences = use_packed_sequences
 
         self.rnn = nn.GRU(inputs_dim, outputs_dim, num_layers=self._recurrent_N)
         for name, param in self.rnn.named_parameters():
@@ -38,6 +39,11 @@ class RNNLayer(nn.Module):
             # Same deal with masks
             masks = masks.view(T, N)
 
+            if self._use_packed_sequences:
+                x, hxs = self._packed_forward(x, hxs, masks)
+                x = self.norm(x.reshape(T * N, -1))
+                return x, hxs
+
             # Let's figure out which steps in the sequence have a zero for any agent
             # We will always assume t=0 has a zero in it as that makes the logic cleaner
             has_zeros = ((masks[1:] == 0.0)
@@ -78,3 +84,54 @@ class RNNLayer(nn.Module):
 
         x = self.norm(x)
         return x, hxs
+
+    def _packed_forward(self, x, hxs, masks):
+        """
+        Run all sequences in a single GRU call. Every column is cut at its own resets and the pieces are fed as one
+        PackedSequence, the first piece of a column continues from hxs and every later one starts from zeros.
+        :param x: (torch.Tensor) inputs of shape (T, N, -1).
+        :param hxs: (torch.Tensor) hidden states of shape (N, recurrent_N, -1).
+        :param masks: (torch.Tensor) masks of shape (T, N).
+
+        :return x: (torch.Tensor) GRU outputs of shape (T, N, -1).
+        :return hxs: (torch.Tensor) hidden states after the last step, shape (N, recurrent_N, -1).
+        """
+        T, N = masks.shape
+        device = x.device
+
+        # column major, so the pieces of a column are consecutive
+        starts = (masks == 0.0).t().contiguous()
+        starts[:, 0] = True
+        starts = starts.view(-1)
+        piece = torch.cumsum(starts, 0) - 1
+        piece_start = starts.nonzero().squeeze(-1)
+        num_pieces = piece_start.size(0)
+        position = torch.arange(N * T, device=device) - piece_start[piece]
+        if num_pieces == N:
+            # no resets after the first step, a plain call avoids the packing overhead
+            x, hxs = self.rnn(x, (hxs * masks[0].view(-1, 1, 1)).transpose(0, 1).contiguous())
+            return x, hxs.transpose(0, 1)
+        lengths = torch.diff(piece_start, append=piece_start.new_tensor([N * T]))
+
+        # PackedSequence layout: time major, pieces sorted by decreasing length inside every time step
+        sorted_indices = torch.sort(lengths, descending=True, stable=True)[1]
+        unsorted_indices = torch.empty_like(sorted_indices)
+        unsorted_indices[sorted_indices] = torch.arange(num_pieces, device=device)
+        batch_sizes = torch.bincount(lengths, minlength=T + 1)[1:].flip(0).cumsum(0).flip(0)
+        batch_sizes = batch_sizes[batch_sizes > 0]
+        offsets = torch.cumsum(batch_sizes, 0) - batch_sizes
+        index = offsets[position] + unsorted_indices[piece]
+
+        data = x.new_empty(N * T, x.size(-1))
+        data[index] = x.transpose(0, 1).reshape(N * T, -1)
+        packed = nn.utils.rnn.PackedSequence(data, batch_sizes.cpu(), sorted_indices, unsorted_indices)
+
+        h0 = hxs.new_zeros(self._recurrent_N, num_pieces, hxs.size(-1))
+        h0[:, piece.view(N, T)[:, 0]] = (hxs * masks[0].view(-1, 1, 1)).transpose(0, 1)
+
+        out, hxs = self.rnn(packed, h0)
+
+        x = out.data[index].view(N, T, -1).transpose(0, 1)
+        hxs = hxs[:, piece.view(N, T)[:, -1]].transpose(0, 1)
+        return x, hxs
+
@@ -1,9 +1,16 @@
 import copy
+import warnings
 import numpy as np
 
 import torch
 import torch.nn as nn
 
+try:
+    from torch._dynamo.exc import BackendCompilerFailed, TorchRuntimeError, Unsupported
+    _COMPILE_ERRORS = (BackendCompilerFailed, TorchRuntimeError, Unsupported)
+except ImportError:
+    _COMPILE_ERRORS = ()
+
 def init(module, weight_init, bias_init, gain=1):
     weight_init(module.weight.data, gain=gain)
     bias_init(module.bias.data)
@@ -15,3 +22,25 @@ def get_clones(module, N):
 def check(input):
     output = torch.from_numpy(input) if type(input) == np.ndarray else input
     return output
+
+class CompiledFunction:
+    """
+    Wraps fn with torch.compile. Numpy inputs are converted to tensors before the call. If torch.compile is not
+    available or compiling fails, a warning is issued and fn runs eagerly from then on. Errors other than compile
+    failures propagate.
+    :param fn: (callable) module or function to compile.
+    """
+    def __init__(self, fn, **compile_kwargs):
+        self.fn = fn
+        self._compiled = torch.compile(fn, **compile_kwargs) if hasattr(torch, 'compile') else None
+        if self._compiled is None:
+            warnings.warn("torch.compile is not available, running {} eagerly.".format(getattr(fn, '__name__', fn)))
+
+    def __call__(self, *args):
+        if self._compiled is not None:
+            try:
+                return self._compiled(*[check(x) for x in args])
+            except _COMPILE_ERRORS as e:
+                warnings.warn("torch.compile failed ({}), running eagerly.".format(e))
+                self._compiled = None
+        return self.fn(*args)
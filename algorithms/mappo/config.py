@@ -42,10 +42,22 @@ def get_config():
     Replay Buffer parameters:
         --episode_length <int>
             the max length of episode in the buffer. 
+        --buffer_dtype <str>
+            storage dtype for observations and RNN states in the buffer, one of `["float32", "float16", "bfloat16"]`.
+            by default float32. Any other choice also stores masks as uint8; returns and advantages stay float32.
     
     Network parameters:
         --share_policy
             by default True, all agents will share the same network; set to make training agents use different policies. 
+        --use_batched_inference
+            by default False. If set, the separated runner stacks the per-agent actor/critic parameters and runs
+            rollout and evaluation forward passes of all agents as one batched computation, recurrent policies
+            included. Needs a Tuple(Box, Discrete) action space and float rollout actors, otherwise the agents run
+            one after the other (see scripts/benchmarks/collect_latency.py --batched).
+        --use_batched_train
+            by default False. If set, the separated runner updates all agents in lockstep on shared minibatch
+            indices with grouped forward passes, recurrent policies included, and a single backward pass per
+            minibatch. Needs a Tuple(Box, Discrete) action space (see scripts/benchmarks/ppo_train.py --batched).
         --use_centralized_V
             by default True, use centralized training mode; or else will decentralized training mode.
         --stacked_frames <int>
@@ -66,6 +78,29 @@ def get_config():
             by default True, use Orthogonal initialization for weights and 0 initialization for biases. or else, will use xavier uniform inilialization.
         --gain
             by default 0.01, use the gain # of last action layer
+        --use_bf16_autocast
+            by default False. If set, the PPO update runs the actor and critic trunks under bfloat16 autocast. Weights,
+            Adam state, action/value heads, value normalization and the losses stay in float32.
+        --use_cached_critic_input
+            by default False. If set (with feature normalization), the critic inputs are standardized once per env step
+            before each training update, shared between agents with a centralized value function, and reused by all
+            PPO epochs and minibatches.
+        --use_quantized_rollout
+            by default False. If set, rollouts and evaluation on CPU use a dynamic int8 quantized copy of the actor's
+            Linear layers, rebuilt from the float actor after every training update.
+        --use_compile
+            by default False. If set, the actor and critic forward passes of MLP policies run through torch.compile,
+            falling back to eager execution when compiling is unsupported.
+        --use_fused_actor_trunk
+            by default False. If set, the actor computes the MLPs of its control and communication trunks as one
+            grouped pass, the GRUs stay separate. This pays off for batches of up to a few hundred rows, in rollouts
+            and in training. Larger training minibatches run the trunks one after the other and are a few percent
+            slower than with separate trunks (see scripts/benchmarks/fused_trunk.py). Checkpoints of either layout
+            load into both.
+        --use_fused_action_head
+            by default False. If set, the actor computes the control and communication action heads with one Linear
+            layer and samples/scores them with closed form tensor math instead of torch.distributions objects.
+            Checkpoints of either layout load into both.
         --use_naive_recurrent_policy
             by default False, use the whole trajectory to calculate hidden states.
         --use_recurrent_policy
@@ -74,6 +109,15 @@ def get_config():
             The number of recurrent layers ( default 1).
         --data_chunk_length <int>
             Time length of chunks used to train a recurrent_policy, default 10.
+        --use_chunk_rnn_states
+            by default False. If set, the buffer only keeps the RNN states of every
+            gcd(episode_length, data_chunk_length)-th step, the steps a data chunk can start on, and the RNN
+            recomputes the states inside each chunk during training. The RNN state memory shrinks by that stride,
+            e.g. 5x for episode_length 25 and data_chunk_length 10, and by data_chunk_length when it divides
+            episode_length.
+        --use_packed_rnn
+            by default False. If set, RNN layers cut every sequence at its own resets and run all pieces in a single
+            packed GRU call instead of one call per segment between resets.
     
     Optimizer parameters:
         --lr <float>
@@ -84,6 +128,9 @@ def get_config():
             RMSprop optimizer epsilon (default: 1e-5)
         --weight_decay <float>
             coefficience of weight decay (default: 0)
+        --use_fused_optimizer
+            by default False. If set, actor and critic share one Adam optimizer (fused/foreach kernels) with a parameter
+            group each, and every minibatch takes a single backward pass over the combined loss.
     
     PPO parameters:
         --ppo_epoch <int>
@@ -128,6 +175,12 @@ def get_config():
     Save & Log parameters:
         --save_interval <int>
             time duration between contiunous twice models saving.
+        --use_async_checkpoint
+            by default False. If set, models are saved from a background thread as one checkpoint_<episode>.pt file
+            per save (written atomically), keeping the last --keep_checkpoints ones and checkpoint_best.pt, the one
+            with the highest mean rollout reward. --model_dir accepts such a file.
+        --keep_checkpoints <int>
+            by default 3. number of recent checkpoints kept with --use_async_checkpoint.
         --log_interval <int>
             time duration between contiunous twice log printing.
     
@@ -191,10 +244,16 @@ def get_config():
                         default=25, help="Max length for any episode")
     parser.add_argument("--n_trajectories", type=int,
                         default=1, help="Number of trajectories to sample per thread")
+    parser.add_argument("--buffer_dtype", type=str, default='float32', choices=["float32", "float16", "bfloat16"],
+                        help="Storage dtype for observations and RNN states in the rollout buffer")
 
     # network parameters
     parser.add_argument("--share_policy", action='store_false',
                         default=True, help='Whether agent share the same policy')
+    parser.add_argument("--use_batched_inference", action='store_true',
+                        default=False, help="Batch the forward passes of all agents when policies are not shared")
+    parser.add_argument("--use_batched_train", action='store_true',
+                        default=False, help="Update all agents in lockstep when policies are not shared")
     parser.add_argument("--use_centralized_V", action='store_false',
                         default=True, help="Whether to use centralized V function")
     parser.add_argument("--stacked_frames", type=int, default=1,
@@ -217,6 +276,18 @@ def get_config():
                         help="Whether to use Orthogonal initialization for weights and 0 initialization for biases")
     parser.add_argument("--gain", type=float, default=0.01,
                         help="The gain # of last action layer")
+    parser.add_argument("--use_bf16_autocast", action='store_true', default=False,
+                        help="Run the PPO update under bfloat16 autocast with float32 master weights")
+    parser.add_argument("--use_cached_critic_input", action='store_true', default=False,
+                        help="Standardize the critic inputs once per training update instead of every minibatch")
+    parser.add_argument("--use_quantized_rollout", action='store_true', default=False,
+                        help="Act with a dynamic int8 quantized copy of the actor during rollouts and evaluation")
+    parser.add_argument("--use_compile", action='store_true', default=False,
+                        help="Run the actor and critic of MLP policies through torch.compile")
+    parser.add_argument("--use_fused_actor_trunk", action='store_true', default=False,
+                        help="Compute the control and communication MLP trunks of the actor as one grouped pass")
+    parser.add_argument("--use_fused_action_head", action='store_true', default=False,
+                        help="Compute both action heads of the actor with one Linear layer, without distributions")
 
     # recurrent parameters
     parser.add_argument("--use_naive_recurrent_policy", action='store_true',
@@ -226,6 +297,10 @@ def get_config():
     parser.add_argument("--recurrent_N", type=int, default=1, help="The number of recurrent layers.")
     parser.add_argument("--data_chunk_length", type=int, default=10,
                         help="Time length of chunks used to train a recurrent_policy")
+    parser.add_argument("--use_chunk_rnn_states", action='store_true', default=False,
+                        help="Only store RNN states on the steps data chunks can start on and recompute the rest")
+    parser.add_argument("--use_packed_rnn", action='store_true', default=False,
+                        help="Run RNN sequences with per-sequence resets as one packed GRU call")
 
     # optimizer parameters
     parser.add_argument("--lr", type=float, default=5e-4,
@@ -235,6 +310,8 @@ def get_config():
     parser.add_argument("--opti_eps", type=float, default=1e-5,
                         help='RMSprop optimizer epsilon (default: 1e-5)')
     parser.add_argument("--weight_decay", type=float, default=0)
+    parser.add_argument("--use_fused_optimizer", action='store_true', default=False,
+                        help="Update actor and critic with one fused Adam step per minibatch")
 
     # ppo parameters
     parser.add_argument("--ppo_epoch", type=int, default=15,
@@ -273,6 +350,10 @@ def get_config():
                         default=False, help='use a linear schedule on the learning rate')
     # save parameters
     parser.add_argument("--save_interval", type=int, default=1, help="time duration between contiunous twice models saving.")
+    parser.add_argument("--use_async_checkpoint", action='store_true', default=False,
+                        help="Write consolidated checkpoints atomically from a background thread")
+    parser.add_argument("--keep_checkpoints", type=int, default=3,
+                        help="Number of recent checkpoints kept with --use_async_checkpoint")
 
     # log parameters
     parser.add_argument("--log_interval", type=int, default=5, help="time duration between contiunous twice log printing.")
@@ -7,7 +7,8 @@ import torch
 from tensorboardX import SummaryWriter
 
 from algorithms.mappo.utils.separated_buffer import SeparatedReplayBuffer
-from algorithms.mappo.utils.util import update_linear_schedule
+from algorithms.mappo.utils.util import update_linear_schedule, from_storage
+from algorithms.mappo.utils.checkpoint import AsyncCheckpointWriter, load_checkpoint
 
 def _t2n(x):
     return x.detach().cpu().numpy()
@@ -38,6 +39,8 @@ class Runner(object):
         self.use_wandb = self.all_args.use_wandb
         self.use_render = self.all_args.use_render
         self.recurrent_N = self.all_args.recurrent_N
+        self.use_batched_inference = self.all_args.use_batched_inference
+        self.use_batched_train = self.all_args.use_batched_train
 
         # interval
         self.save_interval = self.all_args.save_interval
@@ -67,6 +70,11 @@ class Runner(object):
                 if not os.path.exists(self.save_dir):
                     os.makedirs(self.save_dir)
 
+        self.checkpoint_writer = None
+        if self.all_args.use_async_checkpoint and not self.use_render:
+            self.checkpoint_writer = AsyncCheckpointWriter(self.save_dir, self.all_args.keep_checkpoints)
+        self._num_saves = 0
+
 
         from algorithms.mappo.algorithms.r_mappo.r_mappo import R_MAPPO as TrainAlgo
         from algorithms.mappo.algorithms.r_mappo.algorithm.rMAPPOPolicy import R_MAPPOPolicy as Policy
@@ -98,8 +106,16 @@ class Runner(object):
             self.buffer.append(bu)
             self.trainer.append(tr)
 
+        if self.use_batched_train:
+            from algorithms.mappo.algorithms.r_mappo.r_mappo_batched import R_MAPPOBatched
+            self.batched_trainer = R_MAPPOBatched(self.all_args, self.trainer, device = self.device)
+
         if self.model_dir is not None:
             self.restore()
+
+        if self.use_batched_inference:
+            from algorithms.mappo.algorithms.r_mappo.algorithm.rMAPPOBatchedPolicy import R_MAPPOBatchedPolicy
+            self.batched_policy = R_MAPPOBatchedPolicy(self.all_args, self.policy, device = self.device)
             
     def run(self):
         raise NotImplementedError
@@ -115,29 +131,71 @@ class Runner(object):
     
     @torch.no_grad()
     def compute(self):
+        if self.use_batched_inference:
+            for agent_id in range(self.num_agents):
+                self.trainer[agent_id].prep_rollout()
+            next_values = self.batched_policy.get_values(
+                np.stack([from_storage(self.buffer[agent_id].share_obs[-1]) for agent_id in range(self.num_agents)]),
+                np.stack([from_storage(self.buffer[agent_id].rnn_states_critic[-1]) for agent_id in range(self.num_agents)]),
+                np.stack([self.buffer[agent_id].masks[-1] for agent_id in range(self.num_agents)]))
+            next_values = _t2n(next_values)
+            for agent_id in range(self.num_agents):
+                self.buffer[agent_id].compute_returns(next_values[agent_id], self.trainer[agent_id].value_normalizer)
+            return
+
         for agent_id in range(self.num_agents):
             self.trainer[agent_id].prep_rollout()
-            next_value = self.trainer[agent_id].policy.get_values(self.buffer[agent_id].share_obs[-1], 
-                                                                self.buffer[agent_id].rnn_states_critic[-1],
+            next_value = self.trainer[agent_id].policy.get_values(from_storage(self.buffer[agent_id].share_obs[-1]),
+                                                                from_storage(self.buffer[agent_id].rnn_states_critic[-1]),
                                                                 self.buffer[agent_id].masks[-1])
             next_value = _t2n(next_value)
             self.buffer[agent_id].compute_returns(next_value, self.trainer[agent_id].value_normalizer)
 
     def train(self):
-        train_infos = []
-        for agent_id in range(self.num_agents):
-            self.trainer[agent_id].prep_training()
-            train_info = self.trainer[agent_id].train(self.buffer[agent_id])
-            train_infos.append(train_info)       
-            self.buffer[agent_id].after_update()
+        if self.trainer[0]._use_cached_critic_input and self.use_centralized_V:
+            # every agent's critic sees the same joint observation, normalize it once for all of them
+            self.buffer[0].cache_critic_inputs()
+            for agent_id in range(1, self.num_agents):
+                self.buffer[agent_id].cache_critic_inputs(self.buffer[0].critic_inputs)
+
+        if self.use_batched_train:
+            self.batched_trainer.prep_training()
+            train_infos = self.batched_trainer.train(self.buffer)
+            for agent_id in range(self.num_agents):
+                self.buffer[agent_id].after_update()
+        else:
+            train_infos = []
+            for agent_id in range(self.num_agents):
+                self.trainer[agent_id].prep_training()
+                train_info = self.trainer[agent_id].train(self.buffer[agent_id])
+                train_infos.append(train_info)       
+                self.buffer[agent_id].after_update()
 
+        for agent_id in range(self.num_agents):
+            self.policy[agent_id].refresh_rollout_actor()
+        if self.use_batched_inference:
+            self.batched_policy.refresh()
         return train_infos
 
-    def save(self):
+    def save(self, episode=None):
+        if self.checkpoint_writer is not None:
+            agents = []
+            for agent_id in range(self.num_agents):
+                agent = {'actor': self.trainer[agent_id].policy.actor.state_dict(),
+                         'critic': self.trainer[agent_id].policy.critic.state_dict()}
+                if self.trainer[agent_id]._use_valuenorm:
+                    agent['vnrom'] = self.trainer[agent_id].value_normalizer.state_dict()
+                agents.append(agent)
+            metric = float(np.mean([np.mean(buffer.rewards) for buffer in self.buffer]))
+            self.checkpoint_writer.save({'init': self.trainer[0].policy.init_dict, 'agents': agents},
+                                        self._num_saves if episode is None else episode, metric=metric)
+            self._num_saves += 1
+            return
+
+        torch.save(self.trainer[0].policy.init_dict, str(self.save_dir) + "/init.pt")
         for agent_id in range(self.num_agents):
             policy_actor = self.trainer[agent_id].policy.actor
             torch.save(policy_actor.state_dict(), str(self.save_dir) + "/actor_agent" + str(agent_id) + ".pt")
-            torch.save(self.trainer[0].policy.init_dict, str(self.save_dir) + "/init.pt")
             policy_critic = self.trainer[agent_id].policy.critic
             torch.save(policy_critic.state_dict(), str(self.save_dir) + "/critic_agent" + str(agent_id) + ".pt")
             if self.trainer[agent_id]._use_valuenorm:
@@ -145,14 +203,24 @@ class Runner(object):
                 torch.save(policy_vnrom.state_dict(), str(self.save_dir) + "/vnrom_agent" + str(agent_id) + ".pt")
 
     def restore(self):
+        if os.path.isfile(str(self.model_dir)):
+            checkpoint = load_checkpoint(str(self.model_dir))
+            load = lambda name, agent_id: checkpoint['agents'][agent_id][name]
+        else:
+            load = lambda name, agent_id: torch.load(str(self.model_dir) + '/' + name + '_agent' + str(agent_id) + '.pt')
         for agent_id in range(self.num_agents):
-            policy_actor_state_dict = torch.load(str(self.model_dir) + '/actor_agent' + str(agent_id) + '.pt')
+            policy_actor_state_dict = load('actor', agent_id)
             self.policy[agent_id].actor.load_state_dict(policy_actor_state_dict)
-            policy_critic_state_dict = torch.load(str(self.model_dir) + '/critic_agent' + str(agent_id) + '.pt')
+            policy_critic_state_dict = load('critic', agent_id)
             self.policy[agent_id].critic.load_state_dict(policy_critic_state_dict)
             if self.trainer[agent_id]._use_valuenorm:
-                policy_vnrom_state_dict = torch.load(str(self.model_dir) + '/vnrom_agent' + str(agent_id) + '.pt')
+                policy_vnrom_state_dict = load('vnrom', agent_id)
                 self.trainer[agent_id].value_normalizer.load_state_dict(policy_vnrom_state_dict)
+            self.policy[agent_id].refresh_rollout_actor()
+
+    def close(self):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
 
     def log_train(self, train_infos, total_num_steps): 
         infos = {k:{} for k in train_infos[0].keys()}
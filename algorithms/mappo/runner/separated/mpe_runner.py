@@ -6,7 +6,7 @@ import torch
 from itertools import chain
 from gymnasium.spaces.utils import flatdim
 
-from algorithms.mappo.utils.util import update_linear_schedule
+from algorithms.mappo.utils.util import update_linear_schedule, to_storage, from_storage
 from algorithms.mappo.runner.separated.base_runner import Runner
 import imageio
 
@@ -74,7 +74,7 @@ class MPERunner(Runner):
 
             # save model
             if (episode % self.save_interval == 0 or episode == episodes - 1):
-                self.save()
+                self.save(episode)
 
             # log information
             if episode % self.log_interval == 0:
@@ -125,9 +125,9 @@ class MPERunner(Runner):
         for agent_id in range(self.num_agents):
             if not self.use_centralized_V:
                 share_obs = np.array(list(obs[:, agent_id]))
-            self.buffer[agent_id].share_obs[0] = share_obs.copy()
-            self.buffer[agent_id].obs[0] = np.array(
-                list(obs[:, agent_id])).copy()
+            self.buffer[agent_id].share_obs[0] = to_storage(share_obs, self.buffer[agent_id].share_obs.dtype)
+            self.buffer[agent_id].obs[0] = to_storage(np.array(
+                list(obs[:, agent_id])), self.buffer[agent_id].obs.dtype)
 
     @torch.no_grad()
     def collect(self, step):
@@ -138,14 +138,29 @@ class MPERunner(Runner):
         rnn_states = []
         rnn_states_critic = []
 
+        if self.use_batched_inference:
+            for agent_id in range(self.num_agents):
+                self.trainer[agent_id].prep_rollout()
+            agent_rnn_states = [self.buffer[agent_id].get_rnn_states(step) for agent_id in range(self.num_agents)]
+            batched_outputs = self.batched_policy.get_actions(
+                np.stack([from_storage(self.buffer[agent_id].share_obs[step]) for agent_id in range(self.num_agents)]),
+                np.stack([from_storage(self.buffer[agent_id].obs[step]) for agent_id in range(self.num_agents)]),
+                np.stack([from_storage(rnn_state) for rnn_state, _ in agent_rnn_states]),
+                np.stack([from_storage(rnn_state_critic) for _, rnn_state_critic in agent_rnn_states]),
+                np.stack([self.buffer[agent_id].masks[step] for agent_id in range(self.num_agents)]))
+
         for agent_id in range(self.num_agents):
-            self.trainer[agent_id].prep_rollout()
-            value, action, action_log_prob, rnn_state, rnn_state_critic \
-                = self.trainer[agent_id].policy.get_actions(self.buffer[agent_id].share_obs[step],
-                                                            self.buffer[agent_id].obs[step],
-                                                            self.buffer[agent_id].rnn_states[step],
-                                                            self.buffer[agent_id].rnn_states_critic[step],
-                                                            self.buffer[agent_id].masks[step])
+            if self.use_batched_inference:
+                value, action, action_log_prob, rnn_state, rnn_state_critic = [x[agent_id] for x in batched_outputs]
+            else:
+                self.trainer[agent_id].prep_rollout()
+                rnn_state, rnn_state_critic = self.buffer[agent_id].get_rnn_states(step)
+                value, action, action_log_prob, rnn_state, rnn_state_critic \
+                    = self.trainer[agent_id].policy.get_actions(from_storage(self.buffer[agent_id].share_obs[step]),
+                                                                from_storage(self.buffer[agent_id].obs[step]),
+                                                                from_storage(rnn_state),
+                                                                from_storage(rnn_state_critic),
+                                                                self.buffer[agent_id].masks[step])
             # [agents, envs, dim]
             values.append(_t2n(value))
             action = _t2n(action)
@@ -232,14 +247,25 @@ class MPERunner(Runner):
 
         for eval_step in range(self.episode_length):
             eval_temp_actions_env = []
+            if self.use_batched_inference:
+                for agent_id in range(self.num_agents):
+                    self.trainer[agent_id].prep_rollout()
+                eval_batched_actions, eval_batched_rnn_states = self.batched_policy.act(
+                    np.stack([np.array(list(eval_obs[:, agent_id])) for agent_id in range(self.num_agents)]),
+                    eval_rnn_states.swapaxes(0, 1),
+                    eval_masks.swapaxes(0, 1),
+                    deterministic=True)
             for agent_id in range(self.num_agents):
-                self.trainer[agent_id].prep_rollout()
-                eval_action, eval_rnn_state = self.trainer[agent_id].policy.act(np.array(list(eval_obs[:, agent_id])),
-                                                                                eval_rnn_states[:,
-                                                                                                agent_id],
-                                                                                eval_masks[:,
-                                                                                           agent_id],
-                                                                                deterministic=True)
+                if self.use_batched_inference:
+                    eval_action, eval_rnn_state = eval_batched_actions[agent_id], eval_batched_rnn_states[agent_id]
+                else:
+                    self.trainer[agent_id].prep_rollout()
+                    eval_action, eval_rnn_state = self.trainer[agent_id].policy.act(np.array(list(eval_obs[:, agent_id])),
+                                                                                    eval_rnn_states[:,
+                                                                                                    agent_id],
+                                                                                    eval_masks[:,
+                                                                                               agent_id],
+                                                                                    deterministic=True)
 
                 eval_action = eval_action.detach().cpu().numpy()
                 # rearrange action
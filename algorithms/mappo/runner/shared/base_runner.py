@@ -4,6 +4,8 @@ import numpy as np
 import torch
 from tensorboardX import SummaryWriter
 from algorithms.mappo.utils.shared_buffer import SharedReplayBuffer
+from algorithms.mappo.utils.util import from_storage
+from algorithms.mappo.utils.checkpoint import AsyncCheckpointWriter, load_checkpoint
 
 def _t2n(x):
     """Convert torch tensor to a numpy array."""
@@ -65,6 +67,11 @@ class Runner(object):
             if not os.path.exists(self.save_dir):
                 os.makedirs(self.save_dir)
 
+        self.checkpoint_writer = None
+        if self.all_args.use_async_checkpoint and not self.use_render:
+            self.checkpoint_writer = AsyncCheckpointWriter(self.save_dir, self.all_args.keep_checkpoints)
+        self._num_saves = 0
+
         from algorithms.mappo.algorithms.r_mappo.r_mappo import R_MAPPO as TrainAlgo
         from algorithms.mappo.algorithms.r_mappo.algorithm.rMAPPOPolicy import R_MAPPOPolicy as Policy
 
@@ -113,8 +120,8 @@ class Runner(object):
     def compute(self):
         """Calculate returns for the collected data."""
         self.trainer.prep_rollout()
-        next_values = self.trainer.policy.get_values(np.concatenate(self.buffer.share_obs[-1]),
-                                                np.concatenate(self.buffer.rnn_states_critic[-1]),
+        next_values = self.trainer.policy.get_values(np.concatenate(from_storage(self.buffer.share_obs[-1])),
+                                                np.concatenate(from_storage(self.buffer.rnn_states_critic[-1])),
                                                 np.concatenate(self.buffer.masks[-1]))
         next_values = np.array(np.split(_t2n(next_values), self.n_rollout_threads))
         self.buffer.compute_returns(next_values, self.trainer.value_normalizer)
@@ -124,10 +131,26 @@ class Runner(object):
         self.trainer.prep_training()
         train_infos = self.trainer.train(self.buffer)      
         self.buffer.after_update()
+        self.policy.refresh_rollout_actor()
         return train_infos
 
-    def save(self):
-        """Save policy's actor and critic networks."""
+    def save(self, episode=None):
+        """
+        Save policy's actor and critic networks. With --use_async_checkpoint they are written to a single
+        checkpoint file in the background, the best one by mean rollout reward is kept as well.
+        :param episode: (int) episode of the checkpoint, used in its file name.
+        """
+        if self.checkpoint_writer is not None:
+            checkpoint = {'init': self.trainer.policy.init_dict,
+                          'actor': self.trainer.policy.actor.state_dict(),
+                          'critic': self.trainer.policy.critic.state_dict()}
+            if self.trainer._use_valuenorm:
+                checkpoint['vnorm'] = self.trainer.value_normalizer.state_dict()
+            self.checkpoint_writer.save(checkpoint, self._num_saves if episode is None else episode,
+                                        metric=float(np.mean(self.buffer.rewards)))
+            self._num_saves += 1
+            return
+
         policy_actor = self.trainer.policy.actor
         torch.save(policy_actor.state_dict(), str(self.save_dir) + "/actor.pt")
         torch.save(self.trainer.policy.init_dict, str(self.save_dir) + "/init.pt")
@@ -138,15 +161,26 @@ class Runner(object):
             torch.save(policy_vnorm.state_dict(), str(self.save_dir) + "/vnorm.pt")
 
     def restore(self):
-        """Restore policy's networks from a saved model."""
-        policy_actor_state_dict = torch.load(str(self.model_dir) + '/actor.pt')
+        """Restore policy's networks from a saved model folder or a checkpoint file of --use_async_checkpoint."""
+        if os.path.isfile(str(self.model_dir)):
+            checkpoint = load_checkpoint(str(self.model_dir))
+            load = lambda name: checkpoint[name]
+        else:
+            load = lambda name: torch.load(str(self.model_dir) + '/' + name + '.pt')
+        policy_actor_state_dict = load('actor')
         self.policy.actor.load_state_dict(policy_actor_state_dict)
         if not self.all_args.use_render:
-            policy_critic_state_dict = torch.load(str(self.model_dir) + '/critic.pt')
+            policy_critic_state_dict = load('critic')
             self.policy.critic.load_state_dict(policy_critic_state_dict)
             if self.trainer._use_valuenorm:
-                policy_vnorm_state_dict = torch.load(str(self.model_dir) + '/vnorm.pt')
+                policy_vnorm_state_dict = load('vnorm')
                 self.trainer.value_normalizer.load_state_dict(policy_vnorm_state_dict)
+        self.policy.refresh_rollout_actor()
+
+    def close(self):
+        """Wait for pending checkpoints to be written."""
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
  
     def log_train(self, train_infos, total_num_steps):
         """
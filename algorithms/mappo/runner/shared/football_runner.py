@@ -8,7 +8,7 @@ import numpy as np
 import torch
 import wandb
 
-from algorithms.mappo.utils.util import update_linear_schedule
+from algorithms.mappo.utils.util import update_linear_schedule, to_storage, from_storage
 from algorithms.mappo.runner.shared.base_runner import Runner
 
 
@@ -81,19 +81,20 @@ class FootballRunner(Runner):
         obs = self.envs.reset()
 
         # insert obs to buffer
-        self.buffer.share_obs[0] = obs.copy()
-        self.buffer.obs[0] = obs.copy()
+        self.buffer.share_obs[0] = to_storage(obs, self.buffer.share_obs.dtype)
+        self.buffer.obs[0] = to_storage(obs, self.buffer.obs.dtype)
 
     @torch.no_grad()
     def collect(self, step):
         self.trainer.prep_rollout()
 
         # [n_envs, n_agents, ...] -> [n_envs*n_agents, ...]
+        rnn_states, rnn_states_critic = self.buffer.get_rnn_states(step)
         values, actions, action_log_probs, rnn_states, rnn_states_critic = self.trainer.policy.get_actions(
-            np.concatenate(self.buffer.share_obs[step]),
-            np.concatenate(self.buffer.obs[step]),
-            np.concatenate(self.buffer.rnn_states[step]),
-            np.concatenate(self.buffer.rnn_states_critic[step]),
+            np.concatenate(from_storage(self.buffer.share_obs[step])),
+            np.concatenate(from_storage(self.buffer.obs[step])),
+            np.concatenate(from_storage(rnn_states)),
+            np.concatenate(from_storage(rnn_states_critic)),
             np.concatenate(self.buffer.masks[step])
         )
 
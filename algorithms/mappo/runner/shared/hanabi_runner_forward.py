@@ -6,7 +6,7 @@ import numpy as np
 from itertools import chain
 import torch
 
-from algorithms.mappo.utils.util import update_linear_schedule
+from algorithms.mappo.utils.util import update_linear_schedule, to_storage
 from algorithms.mappo.runner.shared.base_runner import Runner
 
 def _t2n(x):
@@ -51,8 +51,8 @@ class HanabiRunner(Runner):
 
                 if step == 0 and episode > 0:
                     # deal with the data of the last index in buffer
-                    self.buffer.share_obs[-1] = self.turn_share_obs.copy()
-                    self.buffer.obs[-1] = self.turn_obs.copy()
+                    self.buffer.share_obs[-1] = to_storage(self.turn_share_obs, self.buffer.share_obs.dtype)
+                    self.buffer.obs[-1] = to_storage(self.turn_obs, self.buffer.obs.dtype)
                     self.buffer.available_actions[-1] = self.turn_available_actions.copy()
                     self.buffer.active_masks[-1] = self.turn_active_masks.copy()
 
@@ -2,6 +2,7 @@ import time
 import numpy as np
 import torch
 from algorithms.mappo.runner.shared.base_runner import Runner
+from algorithms.mappo.utils.util import to_storage, from_storage
 import wandb
 import imageio
 from gymnasium.spaces.utils import flatdim
@@ -74,7 +75,7 @@ class MPERunner(Runner):
 
             # save model
         if (episode % self.save_interval == 0 or episode == episodes - 1):
-            self.save()
+            self.save(episode)
 
         # log information
         if episode % self.log_interval == 0:
@@ -133,20 +134,21 @@ class MPERunner(Runner):
 
       #share_obs = np.concatenate([share_obs, last_actions], -1)
 
-      self.buffer.share_obs[0] = share_obs.copy()
-      self.buffer.obs[0] = obs.copy()
+      self.buffer.share_obs[0] = to_storage(share_obs, self.buffer.share_obs.dtype)
+      self.buffer.obs[0] = to_storage(obs, self.buffer.obs.dtype)
 
   @torch.no_grad()
   def collect(self, step):
       self.trainer.prep_rollout()
+      rnn_states, rnn_states_critic = self.buffer.get_rnn_states(step)
       value, action, action_log_prob, rnn_states, rnn_states_critic \
-           = self.trainer.policy.get_actions(np.concatenate(self.buffer.share_obs[step]),
+           = self.trainer.policy.get_actions(np.concatenate(from_storage(self.buffer.share_obs[step])),
                                               np.concatenate(
-                                                  self.buffer.obs[step,]),
+                                                  from_storage(self.buffer.obs[step,])),
                                               np.concatenate(
-                                                  self.buffer.rnn_states[step]),
+                                                  from_storage(rnn_states)),
                                               np.concatenate(
-                                                  self.buffer.rnn_states_critic[step]),
+                                                  from_storage(rnn_states_critic)),
                                               np.concatenate(self.buffer.masks[step]))
        # [self.envs, agents, dim]
       values = np.array(np.split(_t2n(value), self.n_rollout_threads))
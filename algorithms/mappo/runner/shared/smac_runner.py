@@ -3,6 +3,7 @@ import wandb
 import numpy as np
 from functools import reduce
 import torch
+from algorithms.mappo.utils.util import to_storage, from_storage
 from algorithms.mappo.runner.shared.base_runner import Runner
 
 def _t2n(x):
@@ -103,18 +104,19 @@ class SMACRunner(Runner):
         if not self.use_centralized_V:
             share_obs = obs
 
-        self.buffer.share_obs[0] = share_obs.copy()
-        self.buffer.obs[0] = obs.copy()
+        self.buffer.share_obs[0] = to_storage(share_obs, self.buffer.share_obs.dtype)
+        self.buffer.obs[0] = to_storage(obs, self.buffer.obs.dtype)
         self.buffer.available_actions[0] = available_actions.copy()
 
     @torch.no_grad()
     def collect(self, step):
         self.trainer.prep_rollout()
+        rnn_states, rnn_states_critic = self.buffer.get_rnn_states(step)
         value, action, action_log_prob, rnn_state, rnn_state_critic \
-            = self.trainer.policy.get_actions(np.concatenate(self.buffer.share_obs[step]),
-                                            np.concatenate(self.buffer.obs[step]),
-                                            np.concatenate(self.buffer.rnn_states[step]),
-                                            np.concatenate(self.buffer.rnn_states_critic[step]),
+            = self.trainer.policy.get_actions(np.concatenate(from_storage(self.buffer.share_obs[step])),
+                                            np.concatenate(from_storage(self.buffer.obs[step])),
+                                            np.concatenate(from_storage(rnn_states)),
+                                            np.concatenate(from_storage(rnn_states_critic)),
                                             np.concatenate(self.buffer.masks[step]),
                                             np.concatenate(self.buffer.available_actions[step]))
         # [self.envs, agents, dim]
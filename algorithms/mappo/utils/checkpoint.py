@@ -0,0 +1,106 @@
+import os
+import queue
+import shutil
+import atexit
+import threading
+from collections import deque
+import torch
+
+
+def snapshot(state):
+    """Copy of a (nested) checkpoint with every tensor cloned, so training can go on while it is written."""
+    if isinstance(state, torch.Tensor):
+        return state.detach().clone()
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread. save() only clones the tensors, the file is written to a temporary
+    name and renamed into place, so a checkpoint on disk is always complete. The last keep_last checkpoints are kept
+    as checkpoint_<step>.pt, and the one with the highest metric so far additionally as checkpoint_best.pt.
+    :param save_dir: (str) folder the checkpoints are written to.
+    :param keep_last: (int) number of most recent checkpoints to keep.
+    :param max_pending: (int) number of snapshots that may wait for the writer before save() blocks.
+    """
+    BEST = 'checkpoint_best.pt'
+
+    def __init__(self, save_dir, keep_last=3, max_pending=2):
+        self.save_dir = str(save_dir)
+        self.keep_last = keep_last
+        self.best_metric = None
+        self._recent = deque()
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def path(self, step):
+        return os.path.join(self.save_dir, 'checkpoint_{}.pt'.format(step))
+
+    def save(self, state, step, metric=None):
+        """
+        Queue a checkpoint for writing.
+        :param state: (dict) checkpoint, e.g. state dicts of the networks. Tensors are cloned before returning.
+        :param step: (int) step (or episode) the checkpoint belongs to, used in the file name.
+        :param metric: (float) higher is better, the best checkpoint so far is kept as checkpoint_best.pt.
+        """
+        self._raise_error()
+        is_best = metric is not None and (self.best_metric is None or metric > self.best_metric)
+        if is_best:
+            self.best_metric = metric
+        self._queue.put((snapshot(state), step, is_best))
+
+    def close(self):
+        """Write all pending checkpoints and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint failed") from error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+
+    def _atomic_save(self, state, path):
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _write(self, state, step, is_best):
+        path = self.path(step)
+        self._atomic_save(state, path)
+        if is_best:
+            best_tmp_path = os.path.join(self.save_dir, self.BEST + '.tmp')
+            try:
+                os.link(path, best_tmp_path)
+            except OSError:
+                shutil.copyfile(path, best_tmp_path)
+            os.replace(best_tmp_path, os.path.join(self.save_dir, self.BEST))
+
+        if path in self._recent:
+            self._recent.remove(path)
+        self._recent.append(path)
+        while len(self._recent) > self.keep_last:
+            os.remove(self._recent.popleft())
+
+
+def load_checkpoint(path, map_location=None):
+    """Load a checkpoint written by AsyncCheckpointWriter."""
+    return torch.load(path, map_location=map_location, weights_only=False)
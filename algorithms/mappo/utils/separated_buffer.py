@@ -1,8 +1,10 @@
+import math
 import torch
 import numpy as np
 from collections import defaultdict
 
-from algorithms.mappo.utils.util import check, get_shape_from_obs_space, get_shape_from_act_space
+from algorithms.mappo.utils.util import check, get_shape_from_obs_space, get_shape_from_act_space, get_storage_dtype, \
+    to_storage, from_storage, standardize_features
 
 def _flatten(T, N, x):
     return x.reshape(T * N, *x.shape[2:])
@@ -23,6 +25,14 @@ class SeparatedReplayBuffer(object):
         self._use_popart = args.use_popart
         self._use_valuenorm = args.use_valuenorm
         self._use_proper_time_limits = args.use_proper_time_limits
+        self._storage_dtype = get_storage_dtype(args.buffer_dtype)
+        mask_dtype = np.float32 if args.buffer_dtype == 'float32' else np.uint8
+        # with use_chunk_rnn_states only every rnn_state_stride-th rnn state is kept, the steps chunks of
+        # recurrent_generator can start on. This is every data_chunk_length-th step only when it divides episode_length.
+        if args.use_chunk_rnn_states:
+            self.rnn_state_stride = math.gcd(self.episode_length, args.data_chunk_length)
+        else:
+            self.rnn_state_stride = 1
 
         obs_shape = get_shape_from_obs_space(obs_space)
         share_obs_shape = get_shape_from_obs_space(share_obs_space)
@@ -33,11 +43,16 @@ class SeparatedReplayBuffer(object):
         if type(share_obs_shape[-1]) == list:
             share_obs_shape = share_obs_shape[:1]
 
-        self.share_obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, *share_obs_shape), dtype=np.float32)
-        self.obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, *obs_shape), dtype=np.float32)
+        self.share_obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, *share_obs_shape), dtype=self._storage_dtype)
+        self.obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, *obs_shape), dtype=self._storage_dtype)
+        # normalized share_obs cached by cache_critic_inputs for one training update
+        self.critic_inputs = None
 
-        self.rnn_states = np.zeros((self.episode_length + 1, self.n_rollout_threads, self.recurrent_N, self.rnn_hidden_size * 2), dtype=np.float32)
-        self.rnn_states_critic = np.zeros((self.episode_length + 1, self.n_rollout_threads, self.recurrent_N, self.rnn_critic_hidden_size), dtype=np.float32)
+        rnn_state_steps = self.episode_length // self.rnn_state_stride
+        self.rnn_states = np.zeros((rnn_state_steps + 1, self.n_rollout_threads, self.recurrent_N, self.rnn_hidden_size * 2), dtype=self._storage_dtype)
+        self.rnn_states_critic = np.zeros((rnn_state_steps + 1, self.n_rollout_threads, self.recurrent_N, self.rnn_critic_hidden_size), dtype=self._storage_dtype)
+        self.last_rnn_states = np.zeros(self.rnn_states.shape[1:], dtype=self._storage_dtype)
+        self.last_rnn_states_critic = np.zeros(self.rnn_states_critic.shape[1:], dtype=self._storage_dtype)
 
         self.value_preds = np.zeros((self.episode_length + 1, self.n_rollout_threads, 1), dtype=np.float32)
         self.returns = np.zeros((self.episode_length + 1, self.n_rollout_threads, 1), dtype=np.float32)
@@ -53,7 +68,7 @@ class SeparatedReplayBuffer(object):
         self.action_log_probs = np.zeros((self.episode_length, self.n_rollout_threads, act_shape), dtype=np.float32)
         self.rewards = np.zeros((self.episode_length, self.n_rollout_threads, 1), dtype=np.float32)
         
-        self.masks = np.ones((self.episode_length + 1, self.n_rollout_threads, 1), dtype=np.float32)
+        self.masks = np.ones((self.episode_length + 1, self.n_rollout_threads, 1), dtype=mask_dtype)
         self.bad_masks = np.ones_like(self.masks)
         self.active_masks = np.ones_like(self.masks)
 
@@ -61,10 +76,9 @@ class SeparatedReplayBuffer(object):
 
     def insert(self, share_obs, obs, rnn_states, rnn_states_critic, actions, action_log_probs,
                value_preds, rewards, masks, bad_masks=None, active_masks=None, available_actions=None):
-        self.share_obs[self.step + 1] = share_obs.copy()
-        self.obs[self.step + 1] = obs.copy()
-        self.rnn_states[self.step + 1] = rnn_states.copy()
-        self.rnn_states_critic[self.step + 1] = rnn_states_critic.copy()
+        self.share_obs[self.step + 1] = to_storage(share_obs, self._storage_dtype)
+        self.obs[self.step + 1] = to_storage(obs, self._storage_dtype)
+        self.insert_rnn_states(self.step + 1, rnn_states, rnn_states_critic)
         self.actions[self.step] = actions.copy()
         self.action_log_probs[self.step] = action_log_probs.copy()
         self.value_preds[self.step] = value_preds.copy()
@@ -81,10 +95,9 @@ class SeparatedReplayBuffer(object):
 
     def chooseinsert(self, share_obs, obs, rnn_states, rnn_states_critic, actions, action_log_probs,
                      value_preds, rewards, masks, bad_masks=None, active_masks=None, available_actions=None):
-        self.share_obs[self.step] = share_obs.copy()
-        self.obs[self.step] = obs.copy()
-        self.rnn_states[self.step + 1] = rnn_states.copy()
-        self.rnn_states_critic[self.step + 1] = rnn_states_critic.copy()
+        self.share_obs[self.step] = to_storage(share_obs, self._storage_dtype)
+        self.obs[self.step] = to_storage(obs, self._storage_dtype)
+        self.insert_rnn_states(self.step + 1, rnn_states, rnn_states_critic)
         self.actions[self.step] = actions.copy()
         self.action_log_probs[self.step] = action_log_probs.copy()
         self.value_preds[self.step] = value_preds.copy()
@@ -99,7 +112,31 @@ class SeparatedReplayBuffer(object):
 
         self.step = (self.step + 1) % self.episode_length
     
+    def insert_rnn_states(self, step, rnn_states, rnn_states_critic):
+        self.last_rnn_states = to_storage(rnn_states, self._storage_dtype)
+        self.last_rnn_states_critic = to_storage(rnn_states_critic, self._storage_dtype)
+        if step % self.rnn_state_stride == 0:
+            self.rnn_states[step // self.rnn_state_stride] = self.last_rnn_states
+            self.rnn_states_critic[step // self.rnn_state_stride] = self.last_rnn_states_critic
+
+    def get_rnn_states(self, step):
+        if step % self.rnn_state_stride == 0:
+            return self.rnn_states[step // self.rnn_state_stride], self.rnn_states_critic[step // self.rnn_state_stride]
+        return self.last_rnn_states, self.last_rnn_states_critic
+
+    def cache_critic_inputs(self, critic_inputs=None):
+        """
+        Normalize the stored share_obs for the coming training update, the generators then yield the normalized
+        inputs instead of share_obs. critic_inputs can pass in the cache of another agent's buffer holding the
+        same share_obs. The cache is dropped in after_update.
+        """
+        self.critic_inputs = standardize_features(self.share_obs) if critic_inputs is None else critic_inputs
+
+    def _get_share_obs(self):
+        return self.share_obs if self.critic_inputs is None else self.critic_inputs
+
     def after_update(self):
+        self.critic_inputs = None
         self.share_obs[0] = self.share_obs[-1].copy()
         self.obs[0] = self.obs[-1].copy()
         self.rnn_states[0] = self.rnn_states[-1].copy()
@@ -160,7 +197,7 @@ class SeparatedReplayBuffer(object):
                 for step in reversed(range(self.rewards.shape[0])):
                     self.returns[step] = self.returns[step + 1] * self.gamma * self.masks[step + 1] + self.rewards[step]
 
-    def feed_forward_generator(self, advantages, num_mini_batch=None, mini_batch_size=None):
+    def feed_forward_generator(self, advantages, num_mini_batch=None, mini_batch_size=None, perm=None):
         episode_length, n_rollout_threads = self.rewards.shape[0:2]
         batch_size = n_rollout_threads * episode_length
 
@@ -173,10 +210,10 @@ class SeparatedReplayBuffer(object):
                           num_mini_batch))
             mini_batch_size = batch_size // num_mini_batch
 
-        rand = torch.randperm(batch_size).numpy()
+        rand = torch.randperm(batch_size).numpy() if perm is None else perm
         sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
 
-        share_obs = self.share_obs[:-1].reshape(-1, *self.share_obs.shape[2:])
+        share_obs = self._get_share_obs()[:-1].reshape(-1, *self.share_obs.shape[2:])
         obs = self.obs[:-1].reshape(-1, *self.obs.shape[2:])
         rnn_states = self.rnn_states[:-1].reshape(-1, *self.rnn_states.shape[2:])
         rnn_states_critic = self.rnn_states_critic[:-1].reshape(-1, *self.rnn_states_critic.shape[2:])
@@ -192,10 +229,12 @@ class SeparatedReplayBuffer(object):
 
         for indices in sampler:
             # obs size [T+1 N Dim]-->[T N Dim]-->[T*N,Dim]-->[index,Dim]
-            share_obs_batch = share_obs[indices]
-            obs_batch = obs[indices]
-            rnn_states_batch = rnn_states[indices]
-            rnn_states_critic_batch = rnn_states_critic[indices]
+            share_obs_batch = from_storage(share_obs[indices])
+            obs_batch = from_storage(obs[indices])
+            step, env = np.divmod(indices, n_rollout_threads)
+            rnn_indices = step // self.rnn_state_stride * n_rollout_threads + env
+            rnn_states_batch = from_storage(rnn_states[rnn_indices])
+            rnn_states_critic_batch = from_storage(rnn_states_critic[rnn_indices])
             actions_batch = actions[indices]
             if self.available_actions is not None:
                 available_actions_batch = available_actions[indices]
@@ -203,8 +242,8 @@ class SeparatedReplayBuffer(object):
                 available_actions_batch = None
             value_preds_batch = value_preds[indices]
             return_batch = returns[indices]
-            masks_batch = masks[indices]
-            active_masks_batch = active_masks[indices]
+            masks_batch = from_storage(masks[indices])
+            active_masks_batch = from_storage(active_masks[indices])
             old_action_log_probs_batch = action_log_probs[indices]
             if advantages is None:
                 adv_targ = None
@@ -213,14 +252,16 @@ class SeparatedReplayBuffer(object):
 
             yield share_obs_batch, obs_batch, rnn_states_batch, rnn_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch
 
-    def naive_recurrent_generator(self, advantages, num_mini_batch):
+    def naive_recurrent_generator(self, advantages, num_mini_batch, perm=None):
         n_rollout_threads = self.rewards.shape[1]
         assert n_rollout_threads >= num_mini_batch, (
             "PPO requires the number of processes ({}) "
             "to be greater than or equal to the number of "
             "PPO mini batches ({}).".format(n_rollout_threads, num_mini_batch))
         num_envs_per_batch = n_rollout_threads // num_mini_batch
-        perm = torch.randperm(n_rollout_threads).numpy()
+        if perm is None:
+            perm = torch.randperm(n_rollout_threads).numpy()
+        share_obs = self._get_share_obs()
         for start_ind in range(0, n_rollout_threads, num_envs_per_batch):
             share_obs_batch = []
             obs_batch = []
@@ -237,7 +278,7 @@ class SeparatedReplayBuffer(object):
 
             for offset in range(num_envs_per_batch):
                 ind = perm[start_ind + offset]
-                share_obs_batch.append(self.share_obs[:-1, ind])
+                share_obs_batch.append(share_obs[:-1, ind])
                 obs_batch.append(self.obs[:-1, ind])
                 rnn_states_batch.append(self.rnn_states[0:1, ind])
                 rnn_states_critic_batch.append(self.rnn_states_critic[0:1, ind])
@@ -254,21 +295,21 @@ class SeparatedReplayBuffer(object):
             # [N[T, dim]]
             T, N = self.episode_length, num_envs_per_batch
             # These are all from_numpys of size (T, N, -1)
-            share_obs_batch = np.stack(share_obs_batch, 1)
-            obs_batch = np.stack(obs_batch, 1)
+            share_obs_batch = from_storage(np.stack(share_obs_batch, 1))
+            obs_batch = from_storage(np.stack(obs_batch, 1))
             actions_batch = np.stack(actions_batch, 1)
             if self.available_actions is not None:
                 available_actions_batch = np.stack(available_actions_batch, 1)
             value_preds_batch = np.stack(value_preds_batch, 1)
             return_batch = np.stack(return_batch, 1)
-            masks_batch = np.stack(masks_batch, 1)
-            active_masks_batch = np.stack(active_masks_batch, 1)
+            masks_batch = from_storage(np.stack(masks_batch, 1))
+            active_masks_batch = from_storage(np.stack(active_masks_batch, 1))
             old_action_log_probs_batch = np.stack(old_action_log_probs_batch, 1)
             adv_targ = np.stack(adv_targ, 1)
 
             # States is just a (N, -1) from_numpy [N[1,dim]]
-            rnn_states_batch = np.stack(rnn_states_batch, 1).reshape(N, *self.rnn_states.shape[2:])
-            rnn_states_critic_batch = np.stack(rnn_states_critic_batch, 1).reshape(N, *self.rnn_states_critic.shape[2:])
+            rnn_states_batch = from_storage(np.stack(rnn_states_batch, 1).reshape(N, *self.rnn_states.shape[2:]))
+            rnn_states_critic_batch = from_storage(np.stack(rnn_states_critic_batch, 1).reshape(N, *self.rnn_states_critic.shape[2:]))
 
             # Flatten the (T, N, ...) from_numpys to (T * N, ...)
             share_obs_batch = _flatten(T, N, share_obs_batch)
@@ -287,7 +328,7 @@ class SeparatedReplayBuffer(object):
 
             yield share_obs_batch, obs_batch, rnn_states_batch, rnn_states_critic_batch, actions_batch, value_preds_batch, return_batch, masks_batch, active_masks_batch, old_action_log_probs_batch, adv_targ, available_actions_batch
 
-    def recurrent_generator(self, advantages, num_mini_batch, data_chunk_length):
+    def recurrent_generator(self, advantages, num_mini_batch, data_chunk_length, perm=None):
         episode_length, n_rollout_threads = self.rewards.shape[0:2]
         batch_size = n_rollout_threads * episode_length
         data_chunks = batch_size // data_chunk_length  # [C=r*T/L]
@@ -299,14 +340,14 @@ class SeparatedReplayBuffer(object):
             "data chunk length ({}).".format(n_rollout_threads, episode_length, data_chunk_length))
         assert data_chunks >= 2, ("need larger batch size")
 
-        rand = torch.randperm(data_chunks).numpy()
+        rand = torch.randperm(data_chunks).numpy() if perm is None else perm
         sampler = [rand[i*mini_batch_size:(i+1)*mini_batch_size] for i in range(num_mini_batch)]
 
         if len(self.share_obs.shape) > 3:
-            share_obs = self.share_obs[:-1].transpose(1, 0, 2, 3, 4).reshape(-1, *self.share_obs.shape[2:])
+            share_obs = self._get_share_obs()[:-1].transpose(1, 0, 2, 3, 4).reshape(-1, *self.share_obs.shape[2:])
             obs = self.obs[:-1].transpose(1, 0, 2, 3, 4).reshape(-1, *self.obs.shape[2:])
         else:
-            share_obs = _cast(self.share_obs[:-1])
+            share_obs = _cast(self._get_share_obs()[:-1])
             obs = _cast(self.obs[:-1])
 
         actions = _cast(self.actions)
@@ -352,29 +393,31 @@ class SeparatedReplayBuffer(object):
                 active_masks_batch.append(active_masks[ind:ind+data_chunk_length])
                 old_action_log_probs_batch.append(action_log_probs[ind:ind+data_chunk_length])
                 adv_targ.append(advantages[ind:ind+data_chunk_length])
-                # size [T+1 N Dim]-->[T N Dim]-->[T*N,Dim]-->[1,Dim]
-                rnn_states_batch.append(rnn_states[ind])
-                rnn_states_critic_batch.append(rnn_states_critic[ind])
+                # size [S+1 N Dim]-->[S N Dim]-->[N S Dim]-->[N*S,Dim]-->[1,Dim], S = T / rnn_state_stride
+                sequence, step = divmod(ind, episode_length)
+                rnn_ind = sequence * (episode_length // self.rnn_state_stride) + step // self.rnn_state_stride
+                rnn_states_batch.append(rnn_states[rnn_ind])
+                rnn_states_critic_batch.append(rnn_states_critic[rnn_ind])
 
             L, N = data_chunk_length, mini_batch_size
 
             # These are all from_numpys of size (N, L, Dim)
-            share_obs_batch = np.stack(share_obs_batch)
-            obs_batch = np.stack(obs_batch)
+            share_obs_batch = from_storage(np.stack(share_obs_batch))
+            obs_batch = from_storage(np.stack(obs_batch))
 
             actions_batch = np.stack(actions_batch)
             if self.available_actions is not None:
                 available_actions_batch = np.stack(available_actions_batch)
             value_preds_batch = np.stack(value_preds_batch)
             return_batch = np.stack(return_batch)
-            masks_batch = np.stack(masks_batch)
-            active_masks_batch = np.stack(active_masks_batch)
+            masks_batch = from_storage(np.stack(masks_batch))
+            active_masks_batch = from_storage(np.stack(active_masks_batch))
             old_action_log_probs_batch = np.stack(old_action_log_probs_batch)
             adv_targ = np.stack(adv_targ)
 
             # States is just a (N, -1) from_numpy
-            rnn_states_batch = np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[2:])
-            rnn_states_critic_batch = np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[2:])
+            rnn_states_batch = from_storage(np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[2:]))
+            rnn_states_critic_batch = from_storage(np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[2:]))
 
             # Flatten the (L, N, ...) from_numpys to (L * N, ...)
             share_obs_batch = _flatten(L, N, share_obs_batch)
@@ -1,6 +1,8 @@
+import math
 import torch
 import numpy as np
-from algorithms.mappo.utils.util import get_shape_from_obs_space, get_shape_from_act_space
+from algorithms.mappo.utils.util import get_shape_from_obs_space, get_shape_from_act_space, get_storage_dtype, \
+    to_storage, from_storage, standardize_features
 
 
 def _flatten(T, N, x):
@@ -32,6 +34,16 @@ class SharedReplayBuffer(object):
         self._use_popart = args.use_popart
         self._use_valuenorm = args.use_valuenorm
         self._use_proper_time_limits = args.use_proper_time_limits
+        # observations and rnn states are kept in the storage dtype and only upcast in the minibatch generators
+        self._storage_dtype = get_storage_dtype(args.buffer_dtype)
+        mask_dtype = np.float32 if args.buffer_dtype == 'float32' else np.uint8
+        # with use_chunk_rnn_states only every rnn_state_stride-th rnn state is kept. Every chunk of
+        # recurrent_generator starts on such a step and the RNN recomputes the rest of the chunk. The stride is
+        # data_chunk_length only when it divides episode_length, e.g. it is 5 for the MPE defaults (25, 10).
+        if args.use_chunk_rnn_states:
+            self.rnn_state_stride = math.gcd(self.episode_length, args.data_chunk_length)
+        else:
+            self.rnn_state_stride = 1
 
         obs_shape = get_shape_from_obs_space(obs_space)
         share_obs_shape = get_shape_from_obs_space(cent_obs_space)
@@ -43,15 +55,24 @@ class SharedReplayBuffer(object):
             share_obs_shape = share_obs_shape[:1]
 
         self.share_obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, num_agents, *share_obs_shape),
-                                  dtype=np.float32)
-        self.obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, num_agents, *obs_shape), dtype=np.float32)
-
+                                  dtype=self._storage_dtype)
+        # normalized share_obs cached by cache_critic_inputs for one training update. With a centralized value
+        # function every agent of a thread sees the same share_obs, so it is only normalized once per env step.
+        self.critic_inputs = None
+        self._share_obs_per_agent = not args.use_centralized_V
+        self.obs = np.zeros((self.episode_length + 1, self.n_rollout_threads, num_agents, *obs_shape),
+                            dtype=self._storage_dtype)
+
+        rnn_state_steps = self.episode_length // self.rnn_state_stride
         self.rnn_states = np.zeros(
-            (self.episode_length + 1, self.n_rollout_threads, num_agents, self.recurrent_N, self.hidden_size * 2),
-            dtype=np.float32)
+            (rnn_state_steps + 1, self.n_rollout_threads, num_agents, self.recurrent_N, self.hidden_size * 2),
+            dtype=self._storage_dtype)
         self.rnn_states_critic = np.zeros(
-            (self.episode_length + 1, self.n_rollout_threads, num_agents, self.recurrent_N, self.hidden_size),
-            dtype=np.float32)
+            (rnn_state_steps + 1, self.n_rollout_threads, num_agents, self.recurrent_N, self.hidden_size),
+            dtype=self._storage_dtype)
+        # rnn states of the most recently inserted step, needed to act when that step is not stored
+        self.last_rnn_states = np.zeros(self.rnn_states.shape[1:], dtype=self._storage_dtype)
+        self.last_rnn_states_critic = np.zeros(self.rnn_states_critic.shape[1:], dtype=self._storage_dtype)
 
         self.value_preds = np.zeros(
             (self.episode_length + 1, self.n_rollout_threads, num_agents, 1), dtype=np.float32)
@@ -72,7 +93,7 @@ class SharedReplayBuffer(object):
         self.rewards = np.zeros(
             (self.episode_length, self.n_rollout_threads, num_agents, 1), dtype=np.float32)
 
-        self.masks = np.ones((self.episode_length + 1, self.n_rollout_threads, num_agents, 1), dtype=np.float32)
+        self.masks = np.ones((self.episode_length + 1, self.n_rollout_threads, num_agents, 1), dtype=mask_dtype)
         self.bad_masks = np.ones_like(self.masks)
         self.active_masks = np.ones_like(self.masks)
 
@@ -95,10 +116,9 @@ class SharedReplayBuffer(object):
         :param active_masks: (np.ndarray) denotes whether an agent is active or dead in the env.
         :param available_actions: (np.ndarray) actions available to each agent. If None, all actions are available.
         """
-        self.share_obs[self.step + 1] = share_obs.copy()
-        self.obs[self.step + 1] = obs.copy()
-        self.rnn_states[self.step + 1] = rnn_states_actor.copy()
-        self.rnn_states_critic[self.step + 1] = rnn_states_critic.copy()
+        self.share_obs[self.step + 1] = to_storage(share_obs, self._storage_dtype)
+        self.obs[self.step + 1] = to_storage(obs, self._storage_dtype)
+        self.insert_rnn_states(self.step + 1, rnn_states_actor, rnn_states_critic)
         self.actions[self.step] = actions.copy()
         self.action_log_probs[self.step] = action_log_probs.copy()
         self.value_preds[self.step] = value_preds.copy()
@@ -130,10 +150,9 @@ class SharedReplayBuffer(object):
         :param active_masks: (np.ndarray) denotes whether an agent is active or dead in the env.
         :param available_actions: (np.ndarray) actions available to each agent. If None, all actions are available.
         """
-        self.share_obs[self.step] = share_obs.copy()
-        self.obs[self.step] = obs.copy()
-        self.rnn_states[self.step + 1] = rnn_states.copy()
-        self.rnn_states_critic[self.step + 1] = rnn_states_critic.copy()
+        self.share_obs[self.step] = to_storage(share_obs, self._storage_dtype)
+        self.obs[self.step] = to_storage(obs, self._storage_dtype)
+        self.insert_rnn_states(self.step + 1, rnn_states, rnn_states_critic)
         self.actions[self.step] = actions.copy()
         self.action_log_probs[self.step] = action_log_probs.copy()
         self.value_preds[self.step] = value_preds.copy()
@@ -148,8 +167,47 @@ class SharedReplayBuffer(object):
 
         self.step = (self.step + 1) % self.episode_length
 
+    def insert_rnn_states(self, step, rnn_states_actor, rnn_states_critic):
+        """
+        Store the actor and critic RNN states for a timestep.
+        :param step: (int) timestep the RNN states belong to.
+        :param rnn_states_actor: (np.ndarray) RNN states for actor network.
+        :param rnn_states_critic: (np.ndarray) RNN states for critic network.
+        """
+        self.last_rnn_states = to_storage(rnn_states_actor, self._storage_dtype)
+        self.last_rnn_states_critic = to_storage(rnn_states_critic, self._storage_dtype)
+        if step % self.rnn_state_stride == 0:
+            self.rnn_states[step // self.rnn_state_stride] = self.last_rnn_states
+            self.rnn_states_critic[step // self.rnn_state_stride] = self.last_rnn_states_critic
+
+    def get_rnn_states(self, step):
+        """
+        Get the actor and critic RNN states of a timestep.
+        :param step: (int) either a stored timestep or the most recently inserted one.
+
+        :return rnn_states: (np.ndarray) RNN states for actor network.
+        :return rnn_states_critic: (np.ndarray) RNN states for critic network.
+        """
+        if step % self.rnn_state_stride == 0:
+            return self.rnn_states[step // self.rnn_state_stride], \
+                   self.rnn_states_critic[step // self.rnn_state_stride]
+        return self.last_rnn_states, self.last_rnn_states_critic
+
+    def cache_critic_inputs(self):
+        """
+        Normalize the stored share_obs for the coming training update, the generators then yield the normalized
+        inputs instead of share_obs. The cache is dropped in after_update.
+        """
+        share_obs = self.share_obs if self._share_obs_per_agent else self.share_obs[:, :, :1]
+        self.critic_inputs = np.ascontiguousarray(np.broadcast_to(standardize_features(share_obs),
+                                                                  self.share_obs.shape))
+
+    def _get_share_obs(self):
+        return self.share_obs if self.critic_inputs is None else self.critic_inputs
+
     def after_update(self):
         """Copy last timestep data to first index. Called after update to model."""
+        self.critic_inputs = None
         self.share_obs[0] = self.share_obs[-1].copy()
         self.obs[0] = self.obs[-1].copy()
         self.rnn_states[0] = self.rnn_states[-1].copy()
@@ -248,7 +306,7 @@ class SharedReplayBuffer(object):
         rand = torch.randperm(batch_size).numpy()
         sampler = [rand[i * mini_batch_size:(i + 1) * mini_batch_size] for i in range(num_mini_batch)]
 
-        share_obs = self.share_obs[:-1].reshape(-1, *self.share_obs.shape[3:])
+        share_obs = self._get_share_obs()[:-1].reshape(-1, *self.share_obs.shape[3:])
         obs = self.obs[:-1].reshape(-1, *self.obs.shape[3:])
         rnn_states = self.rnn_states[:-1].reshape(-1, *self.rnn_states.shape[3:])
         rnn_states_critic = self.rnn_states_critic[:-1].reshape(-1, *self.rnn_states_critic.shape[3:])
@@ -264,10 +322,13 @@ class SharedReplayBuffer(object):
 
         for indices in sampler:
             # obs size [T+1 N M Dim]-->[T N M Dim]-->[T*N*M,Dim]-->[index,Dim]
-            share_obs_batch = share_obs[indices]
-            obs_batch = obs[indices]
-            rnn_states_batch = rnn_states[indices]
-            rnn_states_critic_batch = rnn_states_critic[indices]
+            share_obs_batch = from_storage(share_obs[indices])
+            obs_batch = from_storage(obs[indices])
+            # feed-forward policies pass their rnn states through unchanged, the nearest stored step is exact
+            step, env_agent = np.divmod(indices, n_rollout_threads * num_agents)
+            rnn_indices = step // self.rnn_state_stride * n_rollout_threads * num_agents + env_agent
+            rnn_states_batch = from_storage(rnn_states[rnn_indices])
+            rnn_states_critic_batch = from_storage(rnn_states_critic[rnn_indices])
             actions_batch = actions[indices]
             if self.available_actions is not None:
                 available_actions_batch = available_actions[indices]
@@ -275,8 +336,8 @@ class SharedReplayBuffer(object):
                 available_actions_batch = None
             value_preds_batch = value_preds[indices]
             return_batch = returns[indices]
-            masks_batch = masks[indices]
-            active_masks_batch = active_masks[indices]
+            masks_batch = from_storage(masks[indices])
+            active_masks_batch = from_storage(active_masks[indices])
             old_action_log_probs_batch = action_log_probs[indices]
             if advantages is None:
                 adv_targ = None
@@ -302,7 +363,7 @@ class SharedReplayBuffer(object):
         num_envs_per_batch = batch_size // num_mini_batch
         perm = torch.randperm(batch_size).numpy()
 
-        share_obs = self.share_obs.reshape(-1, batch_size, *self.share_obs.shape[3:])
+        share_obs = self._get_share_obs().reshape(-1, batch_size, *self.share_obs.shape[3:])
         obs = self.obs.reshape(-1, batch_size, *self.obs.shape[3:])
         rnn_states = self.rnn_states.reshape(-1, batch_size, *self.rnn_states.shape[3:])
         rnn_states_critic = self.rnn_states_critic.reshape(-1, batch_size, *self.rnn_states_critic.shape[3:])
@@ -349,21 +410,22 @@ class SharedReplayBuffer(object):
             # [N[T, dim]]
             T, N = self.episode_length, num_envs_per_batch
             # These are all from_numpys of size (T, N, -1)
-            share_obs_batch = np.stack(share_obs_batch, 1)
-            obs_batch = np.stack(obs_batch, 1)
+            share_obs_batch = from_storage(np.stack(share_obs_batch, 1))
+            obs_batch = from_storage(np.stack(obs_batch, 1))
             actions_batch = np.stack(actions_batch, 1)
             if self.available_actions is not None:
                 available_actions_batch = np.stack(available_actions_batch, 1)
             value_preds_batch = np.stack(value_preds_batch, 1)
             return_batch = np.stack(return_batch, 1)
-            masks_batch = np.stack(masks_batch, 1)
-            active_masks_batch = np.stack(active_masks_batch, 1)
+            masks_batch = from_storage(np.stack(masks_batch, 1))
+            active_masks_batch = from_storage(np.stack(active_masks_batch, 1))
             old_action_log_probs_batch = np.stack(old_action_log_probs_batch, 1)
             adv_targ = np.stack(adv_targ, 1)
 
             # States is just a (N, dim) from_numpy [N[1,dim]]
-            rnn_states_batch = np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[3:])
-            rnn_states_critic_batch = np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[3:])
+            rnn_states_batch = from_storage(np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[3:]))
+            rnn_states_critic_batch = from_storage(
+                np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[3:]))
 
             # Flatten the (T, N, ...) from_numpys to (T * N, ...)
             share_obs_batch = _flatten(T, N, share_obs_batch)
@@ -400,10 +462,10 @@ class SharedReplayBuffer(object):
         sampler = [rand[i * mini_batch_size:(i + 1) * mini_batch_size] for i in range(num_mini_batch)]
 
         if len(self.share_obs.shape) > 4:
-            share_obs = self.share_obs[:-1].transpose(1, 2, 0, 3, 4, 5).reshape(-1, *self.share_obs.shape[3:])
+            share_obs = self._get_share_obs()[:-1].transpose(1, 2, 0, 3, 4, 5).reshape(-1, *self.share_obs.shape[3:])
             obs = self.obs[:-1].transpose(1, 2, 0, 3, 4, 5).reshape(-1, *self.obs.shape[3:])
         else:
-            share_obs = _cast(self.share_obs[:-1])
+            share_obs = _cast(self._get_share_obs()[:-1])
             obs = _cast(self.obs[:-1])
 
         actions = _cast(self.actions)
@@ -452,29 +514,33 @@ class SharedReplayBuffer(object):
                 active_masks_batch.append(active_masks[ind:ind + data_chunk_length])
                 old_action_log_probs_batch.append(action_log_probs[ind:ind + data_chunk_length])
                 adv_targ.append(advantages[ind:ind + data_chunk_length])
-                # size [T+1 N M Dim]-->[T N M Dim]-->[N M T Dim]-->[N*M*T,Dim]-->[1,Dim]
-                rnn_states_batch.append(rnn_states[ind])
-                rnn_states_critic_batch.append(rnn_states_critic[ind])
+                # size [S+1 N M Dim]-->[S N M Dim]-->[N M S Dim]-->[N*M*S,Dim]-->[1,Dim]
+                # with S = T / rnn_state_stride stored steps per sequence
+                sequence, step = divmod(ind, episode_length)
+                rnn_ind = sequence * (episode_length // self.rnn_state_stride) + step // self.rnn_state_stride
+                rnn_states_batch.append(rnn_states[rnn_ind])
+                rnn_states_critic_batch.append(rnn_states_critic[rnn_ind])
 
             L, N = data_chunk_length, mini_batch_size
 
             # These are all from_numpys of size (L, N, Dim)           
-            share_obs_batch = np.stack(share_obs_batch, axis=1)
-            obs_batch = np.stack(obs_batch, axis=1)
+            share_obs_batch = from_storage(np.stack(share_obs_batch, axis=1))
+            obs_batch = from_storage(np.stack(obs_batch, axis=1))
 
             actions_batch = np.stack(actions_batch, axis=1)
             if self.available_actions is not None:
                 available_actions_batch = np.stack(available_actions_batch, axis=1)
             value_preds_batch = np.stack(value_preds_batch, axis=1)
             return_batch = np.stack(return_batch, axis=1)
-            masks_batch = np.stack(masks_batch, axis=1)
-            active_masks_batch = np.stack(active_masks_batch, axis=1)
+            masks_batch = from_storage(np.stack(masks_batch, axis=1))
+            active_masks_batch = from_storage(np.stack(active_masks_batch, axis=1))
             old_action_log_probs_batch = np.stack(old_action_log_probs_batch, axis=1)
             adv_targ = np.stack(adv_targ, axis=1)
 
             # States is just a (N, -1) from_numpy
-            rnn_states_batch = np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[3:])
-            rnn_states_critic_batch = np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[3:])
+            rnn_states_batch = from_storage(np.stack(rnn_states_batch).reshape(N, *self.rnn_states.shape[3:]))
+            rnn_states_critic_batch = from_storage(
+                np.stack(rnn_states_critic_batch).reshape(N, *self.rnn_states_critic.shape[3:]))
 
             # Flatten the (L, N, ...) from_numpys to (L * N, ...)
             share_obs_batch = _flatten(L, N, share_obs_batch)
@@ -7,12 +7,41 @@ def check(input):
         return torch.from_numpy(input)
         
 def get_gard_norm(it):
-    sum_grad = 0
-    for x in it:
-        if x.grad is None:
+    norms = [x.grad.norm() for x in it if x.grad is not None]
+    if len(norms) == 0:
+        return torch.tensor(0.0)
+    return torch.stack(norms).norm()
+
+def clip_grad_norms_(param_groups, max_norm=None):
+    """
+    Gradient norm of every group of parameters, computed with a single torch._foreach_norm call over all gradients.
+    If max_norm is given, the gradients of each group are clipped to it separately (as clip_grad_norm_ per group).
+    """
+    groups = [[p.grad for p in params if p.grad is not None] for params in param_groups]
+    grads = [g for group in groups for g in group]
+    if len(grads) == 0:
+        return [torch.tensor(0.0) for _ in groups]
+    norms = torch._foreach_norm(grads)
+    total_norms = []
+    start = 0
+    for group in groups:
+        if len(group) == 0:
+            total_norms.append(torch.zeros((), device=grads[0].device))
             continue
-        sum_grad += x.grad.norm() ** 2
-    return math.sqrt(sum_grad)
+        total_norm = torch.linalg.vector_norm(torch.stack(norms[start:start + len(group)]))
+        if max_norm is not None:
+            clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+            torch._foreach_mul_(group, clip_coef)
+        total_norms.append(total_norm)
+        start += len(group)
+    return total_norms
+
+def make_fused_adam(params, **kwargs):
+    """Adam using the fused kernels where the installed torch supports them on the device, else the foreach ones."""
+    try:
+        return torch.optim.Adam(params, fused=True, **kwargs)
+    except (RuntimeError, TypeError, ValueError):
+        return torch.optim.Adam(params, foreach=True, **kwargs)
 
 def update_linear_schedule(optimizer, epoch, total_num_epochs, initial_lr):
     """Decreases the learning rate linearly"""
@@ -50,6 +79,47 @@ def get_shape_from_act_space(act_space):
         act_shape = act_space[0].shape[0] + 1  
     return act_shape
 
+def get_storage_dtype(name):
+    """
+    Numpy dtype used to store observations and RNN states in the rollout buffers.
+    numpy has no bfloat16, so bfloat16 values are kept as their raw uint16 bit patterns.
+    """
+    if name == 'float32':
+        return np.float32
+    elif name == 'float16':
+        return np.float16
+    elif name == 'bfloat16':
+        return np.uint16
+    else:
+        raise NotImplementedError
+
+def to_storage(x, dtype):
+    """Cast a float array into the buffer storage dtype returned by get_storage_dtype."""
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    if dtype == np.uint16:
+        # round to nearest even on the 16 truncated mantissa bits
+        bits = x.view(np.uint32).astype(np.uint64)
+        bits = bits + 0x7FFF + ((bits >> 16) & 1)
+        return (bits >> 16).astype(np.uint16)
+    return x.astype(dtype)
+
+def from_storage(x):
+    """Upcast an array read from the buffer storage back to float32."""
+    if x.dtype == np.uint16:
+        return (x.astype(np.uint32) << 16).view(np.float32)
+    return x.astype(np.float32, copy=False)
+
+
+def standardize_features(x, eps=1e-5):
+    """
+    Parameter free part of nn.LayerNorm over the last dimension: (x - mean) / sqrt(var + eps).
+    Used to normalize critic inputs once per rollout instead of once per minibatch (see MLPBase.feature_norm).
+    """
+    x = from_storage(x)
+    mean = x.mean(-1, keepdims=True)
+    var = x.var(-1, keepdims=True)
+    return ((x - mean) / np.sqrt(var + eps)).astype(np.float32)
+
 
 def tile_images(img_nhwc):
     """
@@ -3,9 +3,10 @@ from torch import Tensor
 from torch.autograd import Variable
 import numpy as np
 import copy
-from utils.neuralnets import MLPNetwork
+from utils.neuralnets import MLPNetwork, StackedMLP
 from utils.noise import OUNoise
-from utils.misc import soft_update, gumbel_softmax, onehot_from_logits
+from utils.normalizer import RunningNormalizer
+from utils.misc import soft_update, gumbel_softmax, onehot_from_logits, quantized_copy
 
 MSELoss = torch.nn.MSELoss()
 
@@ -19,7 +20,7 @@ class RA_MADDPG(object):
                  tau=0.01, lr=0.01, 
                  actor_hidden_dim=128,
                  critic_hidden_dim=128,
-                 discrete_action=False, device='cpu'):
+                 discrete_action=False, device='cpu', quantize_rollouts=False):
         """
         Inputs:
             agent_init_params (list of dict): List of dicts with parameters to
@@ -33,6 +34,7 @@ class RA_MADDPG(object):
             lr (float): Learning rate for policy and critic
             hidden_dim (int): Number of hidden dimensions for networks
             discrete_action (bool): Whether or not to use discrete action space
+            quantize_rollouts (bool): Whether step() uses int8 quantized copies of the policies (CPU only)
         """
         self.n_agents = n_agents
         self.control_actions = out_dim - 2
@@ -77,10 +79,12 @@ class RA_MADDPG(object):
         self.eps_decay = eps_decay
         self.n_iter = 0
 
-        # Normalization
-        self.obs_mean = np.zeros(in_dim)
-        self.obs_M2= np.zeros(in_dim)
-        self.k = 0
+        # step() acts with int8 copies of the policies, refreshed in update_all_targets
+        self.quantize_rollouts = quantize_rollouts and torch.device(device).type == 'cpu'
+        self.refresh_rollout_policies()
+
+        # Normalization, the statistics are updated with the observations of step() only
+        self.obs_norm = RunningNormalizer(in_dim).to(device)
 
         self.init_dict = {"lr": lr, 
                           "in_dim": in_dim,
@@ -98,7 +102,34 @@ class RA_MADDPG(object):
       #control = torch.normal(control_params[..., :-2], torch.abs(control_params[..., -2:]))
       comm = self.options_policies[agent](obs)
       comm = onehot_from_logits(comm)
-      return torch.cat((control, comm), dim=-1)
+      actions = torch.cat((control, comm), dim=-1)
+      return actions
+
+    def refresh_rollout_policies(self):
+      """
+      Rebuild the policies used by step() from the trained ones: int8 quantized copies if quantize_rollouts is set,
+      otherwise the policies of all agents stacked into one network each for control and options
+      """
+      if self.quantize_rollouts:
+        self.rollout_control_policies = [quantized_copy(p) for p in self.control_policies]
+        self.rollout_options_policies = [quantized_copy(p) for p in self.options_policies]
+      else:
+        self.rollout_control_policies = StackedMLP(self.control_policies)
+        self.rollout_options_policies = StackedMLP(self.options_policies)
+
+    @torch.no_grad()
+    def _rollout_outputs(self, obs):
+      """
+      Control outputs and options logits of the rollout policies, for normalized observations of shape
+      (n_agents, in_dim) with one row per agent
+      """
+      obs = obs.unsqueeze(1)
+      if self.quantize_rollouts:
+        # one (1, in_dim) batch per agent, quantized Linear layers need a batch dimension
+        control = torch.cat([p(o) for p, o in zip(self.rollout_control_policies, obs)])
+        comm = torch.cat([p(o) for p, o in zip(self.rollout_options_policies, obs)])
+        return control, comm
+      return self.rollout_control_policies(obs).squeeze(1), self.rollout_options_policies(obs).squeeze(1)
 
     def _get_target_actions(self, obs):
       control_params = self.target_control_policy(obs)
@@ -108,31 +139,11 @@ class RA_MADDPG(object):
       comm = onehot_from_logits(comm)
       return torch.cat((control, comm), dim=-1)
 
-    def _norm_single(self, obs):
-      obs = np.array(obs)
-      self.k += 1
-      delta = obs - self.obs_mean
-      
-      self.obs_mean = self.obs_mean + delta / self.k
-      self.obs_M2 = self.obs_M2 + (delta * (obs - self.obs_mean))
-
-      if self.k < 2:
-        self.variance = np.ones_like(self.obs_M2)
-      else:
-        self.variance = self.obs_M2 / (self.k - 1)
-
-      std = self.variance ** 0.5
-
-      obs = (obs - self.obs_mean) / (std + 1e-6)
-      obs = np.clip(obs, -10, 10)
-      obs = torch.tensor(obs, dtype=torch.float32)
-      return obs
-
     def normalize(self, obs):
-      if len(obs.shape) == 1:
-        return self._norm_single(obs)
-      else:
-        return torch.stack([self._norm_single(o) for o in obs])
+      """
+      Normalize observations of shape (..., in_dim) with the running statistics, without changing them
+      """
+      return self.obs_norm(obs)
       
     def scale_noise(self, scale):
         """
@@ -152,31 +163,25 @@ class RA_MADDPG(object):
       Outputs:
           actions: List of actions for each agent
       """
-      actions = []
       observations = observations.squeeze()
-      for i, obs in enumerate(observations):
-        action = self._get_actions(obs, i).to('cpu')
-        cont = action[:2]
-        discrete = action[2:]
+      self.obs_norm.update(observations)
+      cont, comm = self._rollout_outputs(self.normalize(observations))
+      discrete = onehot_from_logits(comm)
 
-        if explore:
-          if torch.rand(1) <= self.curr_eps:
-            cont = (torch.rand(cont.shape) * 2) - 1
+      if explore:
+        # uniform random control actions for the agents drawing below epsilon
+        random_acs = torch.rand(cont.shape[0], 1, device=cont.device) <= self.curr_eps
+        cont = torch.where(random_acs, (torch.rand(cont.shape, device=cont.device) * 2) - 1, cont)
+        discrete = gumbel_softmax(discrete, hard=True)
 
-          discrete = gumbel_softmax(discrete.unsqueeze(0), hard=True).squeeze()
-        else:
-          discrete = onehot_from_logits(discrete)
-
-        action = torch.cat((cont, discrete), dim=0)
-        action = action.clamp(-1, 1)
-        actions.append(action.detach())
+      actions = torch.cat((cont, discrete), dim=1).clamp(-1, 1).detach().cpu()
       
       if self.curr_eps > 0.01:
         self.curr_eps -= (1 / self.eps_decay)
 
-      return actions
+      return list(actions)
 
-    def update(self, sample, agent_i, parallel=False, logger=None):
+    def update(self, sample, agent_i, parallel=False, logger=None, weights=None):
         """
         Update parameters of agent model based on sample from replay buffer
         Inputs:
@@ -188,6 +193,11 @@ class RA_MADDPG(object):
             parallel (bool): If true, will average gradients across threads
             logger (SummaryWriter from Tensorboard-Pytorch):
                 If passed in, important quantities will be logged
+            weights (np.ndarray): Importance sampling weights of the transitions
+                                  (prioritized replay), weighting the critic loss
+        Outputs:
+            td_errors (np.ndarray): TD errors of the critic on the sample, e.g. the
+                                    new priorities of the transitions
         """
         obs, acs, rews, next_obs, dones = sample
 
@@ -200,44 +210,104 @@ class RA_MADDPG(object):
                         (1 - dones[agent_i].view(-1, 1)))
 
         vf_in = torch.cat((*obs, *acs), dim=1)
+        vf_loss, td_errors = self._critic_step(vf_in, target_value.detach(), weights)
+
+        curr_acs = [None if i == agent_i else self._get_actions(ob, i).detach()
+                    for i, ob in zip(range(self.n_agents), obs)]
+        pol_loss = self._policy_step(obs, agent_i, curr_acs)
+
+        if logger is not None:
+            logger.add_scalars('agent/losses',
+                               {'vf_loss': vf_loss,
+                                'pol_loss': pol_loss},
+                               self.n_iter)
+        return td_errors
+
+    def update_all(self, sample, logger=None, weights=None):
+        """
+        Update the critic and the policies of all agents on one sample from the replay buffer. The target actions
+        of the next observations, the target critic values and the actions of the not updated agents are computed
+        once for the sample, instead of once per agent as in calling update for every agent
+        Inputs:
+            sample: tuple of (observations, actions, rewards, next
+                    observations, and episode end masks), see update
+            logger (SummaryWriter from Tensorboard-Pytorch):
+                If passed in, important quantities will be logged
+            weights (np.ndarray): Importance sampling weights of the transitions
+                                  (prioritized replay), weighting the critic loss
+        Outputs:
+            td_errors (np.ndarray): TD errors of the critic on the sample, (n_agents, batch),
+                                    row i with the rewards of agent i
+        """
+        obs, acs, rews, next_obs, dones = sample
+
+        with torch.no_grad():
+            all_trgt_acs = [self._get_actions(nobs, agent_id) for nobs, agent_id in zip(next_obs, range(self.n_agents))]
+            trgt_value = self.target_critic(torch.cat((*next_obs, *all_trgt_acs), dim=1))
+            curr_acs = [self._get_actions(ob, i) for i, ob in zip(range(self.n_agents), obs)]
+
+        vf_in = torch.cat((*obs, *acs), dim=1)
+        vf_losses, pol_losses, td_errors = [], [], []
+        for agent_i in range(self.n_agents):
+            target_value = rews[agent_i].view(-1, 1) + self.gamma * trgt_value * (1 - dones[agent_i].view(-1, 1))
+            vf_loss, agent_td_errors = self._critic_step(vf_in, target_value, weights)
+            vf_losses.append(vf_loss.item())
+            td_errors.append(agent_td_errors)
+            pol_losses.append(self._policy_step(obs, agent_i, curr_acs).item())
+
+        if logger is not None:
+            logger.add_scalars('agent/losses',
+                               {'vf_loss': np.mean(vf_losses),
+                                'pol_loss': np.mean(pol_losses)},
+                               self.n_iter)
+        return np.stack(td_errors)
+
+    def _critic_step(self, vf_in, target_value, weights=None):
+        """
+        One optimizer step of the critic towards the (detached) target values, returns the loss and the TD errors
+        """
         actual_value = self.critic(vf_in)
-        vf_loss = MSELoss(actual_value, target_value.detach())
+        if weights is None:
+            vf_loss = MSELoss(actual_value, target_value)
+        else:
+            weights = torch.as_tensor(weights, dtype=actual_value.dtype, device=actual_value.device).view(-1, 1)
+            vf_loss = (weights * (actual_value - target_value) ** 2).mean()
+        td_errors = (target_value - actual_value).detach().view(-1).cpu().numpy()
 
         self.critic_optimizer.zero_grad()
         vf_loss.backward()
 
         torch.nn.utils.clip_grad_norm_(self.critic.parameters(), 0.5)
         self.critic_optimizer.step()
+        return vf_loss, td_errors
 
+    def _policy_step(self, obs, agent_i, curr_acs):
+        """
+        One optimizer step of the policies of agent_i, returns the policy loss
+        Inputs:
+            obs (list): Observations of all agents
+            agent_i (int): index of agent to update
+            curr_acs (list): Detached actions of all agents, the entry of agent_i is
+                             replaced by the actions of its policies
+        """
         self.control_optimizers[agent_i].zero_grad()
         self.options_optimizers[agent_i].zero_grad()
 
-        curr_acs= self._get_actions(obs[agent_i], agent_i)
-
-        all_acs = []
-        for i, ob in zip(range(self.n_agents), obs):
-            if i == agent_i:
-                all_acs.append(curr_acs)
-            else:
-                all_acs.append(self._get_actions(ob, i).detach())
+        all_acs = list(curr_acs)
+        all_acs[agent_i] = self._get_actions(obs[agent_i], agent_i)
 
         vf_in = torch.cat((*obs, *all_acs), dim=1)
 
         pol_loss = -self.critic(vf_in).mean()
-        pol_loss += (curr_acs**2).mean() * 1e-3
+        pol_loss += (all_acs[agent_i]**2).mean() * 1e-3
         pol_loss.backward()
 
         torch.nn.utils.clip_grad_norm_(self.control_policies[agent_i].parameters(), 0.5)
         torch.nn.utils.clip_grad_norm_(self.options_policies[agent_i].parameters(), 0.5)
-        
+
         self.control_optimizers[agent_i].step()
         self.options_optimizers[agent_i].step()
-
-        if logger is not None:
-            logger.add_scalars('agent/losses',
-                               {'vf_loss': vf_loss,
-                                'pol_loss': pol_loss},
-                               self.n_iter)
+        return pol_loss
 
     def update_all_targets(self, logger=None):
         """
@@ -249,15 +319,17 @@ class RA_MADDPG(object):
 
         soft_update(self.target_critic, self.critic, self.tau)
         self.n_iter += 1
+        self.refresh_rollout_policies()
 
         if logger:
           logger.add_scalar('agent/epsilon', self.curr_eps, self.n_iter)
-          logger.add_scalar('other/mean', self.obs_mean.mean(), self.n_iter)
-          logger.add_scalar('other/variance', self.variance.mean(), self.n_iter)
+          logger.add_scalar('other/mean', self.obs_norm.mean.mean().item(), self.n_iter)
+          logger.add_scalar('other/variance', self.obs_norm.variance.mean().item(), self.n_iter)
 
     def to_device(self, device):
       self.device = device
       self.critic.to(device)
+      self.obs_norm.to(device)
 
       for i in range(self.n_agents):
         self.control_policies[i].to(device)
@@ -266,6 +338,7 @@ class RA_MADDPG(object):
       #self.target_control_policy.to(device)
       #self.target_options_policy.to(device)
       self.target_critic.to(device)
+      self.refresh_rollout_policies()
 
 
 
@@ -281,6 +354,7 @@ class RA_MADDPG(object):
                     "curr_eps": self.curr_eps,
 
                     "critic_optimizer": self.critic_optimizer.state_dict(),
+                    "obs_norm": self.obs_norm.state_dict(),
                     }
         for i in range(self.n_agents):
             save_dict["control_policy_{}".format(i)] = self.control_policies[i].state_dict()
@@ -308,6 +382,8 @@ class RA_MADDPG(object):
           instance.options_optimizers[i].load_state_dict = save_dict["options_optimizer_{}".format(i)]
 
         instance.critic_optimizer.load_state_dict = save_dict["critic_optimizer"]
+        if "obs_norm" in save_dict:
+          instance.obs_norm.load_state_dict(save_dict["obs_norm"])
         instance.device = device
 
         instance.n_iter = save_dict["n_iter"]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import argparse
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from train_mappo import main as train_main
+
+"""Convergence sanity check of --use_bf16_autocast against float32 training on simple_spread_c."""
+
+RUNS_DIR = Path(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))) / "runs"
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--algorithm_name', type=str, default='mappo')
+    parser.add_argument('--num_agents', type=int, default=3)
+    parser.add_argument('--num_env_steps', type=int, default=200000)
+    parser.add_argument('--n_rollout_threads', type=int, default=8)
+    parser.add_argument('--hidden_size', type=int, default=512)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--window', type=int, default=10, help="Number of last logged episodes to average")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="Allowed relative difference of the final bf16 reward to the float32 reward")
+    return parser.parse_args(args)
+
+
+def final_reward(experiment_name, args):
+    run_dir = RUNS_DIR / args.algorithm_name / experiment_name
+    last_run = max(run_dir.glob('run*'), key=lambda p: int(p.name[len('run'):]))
+    with open(str(last_run / 'logs' / 'summary.json')) as f:
+        summary = json.load(f)
+    key = [k for k in summary if k.endswith('average_episode_rewards/average_episode_rewards')][0]
+    rewards = [value for _, _, value in summary[key]]
+    return np.mean(rewards[-args.window:])
+
+
+def main(args):
+    args = parse_args(args)
+    common = ['--algorithm_name', args.algorithm_name,
+              '--num_agents', str(args.num_agents),
+              '--num_env_steps', str(args.num_env_steps),
+              '--n_rollout_threads', str(args.n_rollout_threads),
+              '--actor_hidden_size', str(args.hidden_size),
+              '--critic_hidden_size', str(args.hidden_size),
+              '--seed', str(args.seed)]
+
+    rewards = {}
+    for mode, flags in (('float32', []), ('bfloat16', ['--use_bf16_autocast'])):
+        experiment_name = 'bf16_check_{}'.format(mode)
+        train_main(common + flags + ['--experiment_name', experiment_name])
+        rewards[mode] = final_reward(experiment_name, args)
+
+    difference = abs(rewards['bfloat16'] - rewards['float32']) / abs(rewards['float32'])
+    print("{:>10} {:>14}".format("mode", "final reward"))
+    for mode, reward in rewards.items():
+        print("{:>10} {:>14.3f}".format(mode, reward))
+    print("relative difference {:.3f} ({})".format(difference, "ok" if difference <= args.tolerance else "FAILED"))
+    return difference <= args.tolerance
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
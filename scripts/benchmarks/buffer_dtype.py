@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import numpy as np
+from gymnasium.spaces import Box, Discrete, Tuple
+from algorithms.mappo.config import get_config
+from algorithms.mappo.utils.shared_buffer import SharedReplayBuffer
+
+"""Memory and minibatch throughput of the MAPPO rollout buffer for each --buffer_dtype."""
+
+BUFFER_FIELDS = ['share_obs', 'obs', 'rnn_states', 'rnn_states_critic', 'value_preds', 'returns', 'actions',
+                 'action_log_probs', 'rewards', 'masks', 'bad_masks', 'active_masks']
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_agents', type=int, default=3)
+    parser.add_argument('--obs_dim', type=int, default=16)
+    parser.add_argument('--n_rollout_threads', type=int, default=32)
+    parser.add_argument('--episode_length', type=int, default=125)
+    parser.add_argument('--actor_hidden_size', type=int, default=2048)
+    parser.add_argument('--num_mini_batch', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=5)
+    return parser.parse_args(args)
+
+
+def make_buffer(args, dtype):
+    all_args = get_config().parse_known_args([])[0]
+    all_args.episode_length = args.episode_length
+    all_args.n_rollout_threads = args.n_rollout_threads
+    all_args.actor_hidden_size = args.actor_hidden_size
+    all_args.buffer_dtype = dtype
+
+    obs_space = Box(-np.inf, np.inf, (args.obs_dim,), np.float32)
+    share_obs_space = Box(-np.inf, np.inf, (args.obs_dim * args.num_agents,), np.float32)
+    act_space = Tuple((Box(-1.0, 1.0, (2,), np.float32), Discrete(2)))
+    return SharedReplayBuffer(all_args, args.num_agents, obs_space, share_obs_space, act_space)
+
+
+def fill(buffer):
+    shape = buffer.rewards.shape[1:3]
+    for _ in range(buffer.episode_length):
+        masks = (np.random.rand(*shape, 1) > 0.05).astype(np.float32)
+        buffer.insert(np.random.randn(*buffer.share_obs.shape[1:]),
+                      np.random.randn(*buffer.obs.shape[1:]),
+                      np.random.randn(*buffer.rnn_states.shape[1:]),
+                      np.random.randn(*buffer.rnn_states_critic.shape[1:]),
+                      np.random.randn(*buffer.actions.shape[1:]),
+                      np.random.randn(*buffer.action_log_probs.shape[1:]),
+                      np.random.randn(*buffer.value_preds.shape[1:]),
+                      np.random.randn(*buffer.rewards.shape[1:]),
+                      masks)
+
+
+def main(args):
+    args = parse_args(args)
+    print("{:>10} {:>12} {:>14} {:>14}".format("dtype", "buffer MB", "ff batches/s", "rnn batches/s"))
+    for dtype in ["float32", "float16", "bfloat16"]:
+        buffer = make_buffer(args, dtype)
+        fill(buffer)
+        nbytes = sum(getattr(buffer, k).nbytes for k in BUFFER_FIELDS)
+        advantages = np.random.randn(*buffer.rewards.shape).astype(np.float32)
+
+        start = time.time()
+        for _ in range(args.repeats):
+            for _ in buffer.feed_forward_generator(advantages, args.num_mini_batch):
+                pass
+        ff_rate = args.repeats * args.num_mini_batch / (time.time() - start)
+
+        start = time.time()
+        for _ in range(args.repeats):
+            for _ in buffer.recurrent_generator(advantages, args.num_mini_batch, 10):
+                pass
+        rnn_rate = args.repeats * args.num_mini_batch / (time.time() - start)
+
+        print("{:>10} {:>12.1f} {:>14.2f} {:>14.2f}".format(dtype, nbytes / 2 ** 20, ff_rate, rnn_rate))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
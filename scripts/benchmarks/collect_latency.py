@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from gymnasium.spaces import Box, Discrete, Tuple
+from algorithms.mappo.config import get_config
+from algorithms.mappo.algorithms.r_mappo.algorithm.rMAPPOPolicy import R_MAPPOPolicy
+from algorithms.mappo.algorithms.r_mappo.algorithm.rMAPPOBatchedPolicy import R_MAPPOBatchedPolicy
+from fused_trunk import timed
+
+"""
+Latency of R_MAPPOPolicy.get_actions (one collect step) in eager mode and with --use_compile. With --batched, the
+separate policies of num_agents agents run one after the other against R_MAPPOBatchedPolicy (--use_batched_inference)
+instead, as median milliseconds per call of the collect (get_actions), compute (get_values) and eval (act) steps of the
+separated runner. There the batch size is the number of rollout threads.
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_agents', type=int, default=3)
+    parser.add_argument('--obs_dim', type=int, default=18)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128, 512, 1024, 4096])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeats', type=int, default=100)
+    parser.add_argument('--batched', action='store_true', default=False,
+                        help="Compare per-agent policies with R_MAPPOBatchedPolicy instead of eager and compiled")
+    parser.add_argument('--recurrent', action='store_true', default=False, help="Use recurrent policies")
+    return parser.parse_args(args)
+
+
+def make_policy(args, use_compile):
+    all_args = get_config().parse_known_args([])[0]
+    all_args.use_compile = use_compile
+    all_args.use_recurrent_policy = args.recurrent
+
+    obs_space = Box(-np.inf, np.inf, (args.obs_dim,), np.float32)
+    share_obs_space = Box(-np.inf, np.inf, (args.obs_dim * args.num_agents,), np.float32)
+    act_space = Tuple((Box(-1.0, 1.0, (2,), np.float32), Discrete(2)))
+    policy = R_MAPPOPolicy(all_args, obs_space, share_obs_space, act_space, device=torch.device(args.device))
+    policy.actor.eval()
+    policy.critic.eval()
+    return policy, all_args
+
+
+@torch.no_grad()
+def measure(policy, all_args, batch_size, args):
+    share_obs = np.random.randn(batch_size, args.obs_dim * args.num_agents).astype(np.float32)
+    obs = np.random.randn(batch_size, args.obs_dim).astype(np.float32)
+    rnn_states = np.zeros((batch_size, all_args.recurrent_N, all_args.actor_hidden_size * 2), dtype=np.float32)
+    rnn_states_critic = np.zeros((batch_size, all_args.recurrent_N, all_args.critic_hidden_size), dtype=np.float32)
+    masks = np.ones((batch_size, 1), dtype=np.float32)
+
+    for _ in range(3):
+        policy.get_actions(share_obs, obs, rnn_states, rnn_states_critic, masks)
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.repeats):
+        outputs = policy.get_actions(share_obs, obs, rnn_states, rnn_states_critic, masks)
+        [x.cpu() for x in outputs]
+    return (time.time() - start) / args.repeats * 1e3
+
+
+@torch.no_grad()
+def measure_batched(policies, batched, all_args, batch_size, args):
+    A = args.num_agents
+    share_obs = np.random.randn(A, batch_size, args.obs_dim * A).astype(np.float32)
+    obs = np.random.randn(A, batch_size, args.obs_dim).astype(np.float32)
+    rnn_states = np.random.randn(A, batch_size, all_args.recurrent_N, all_args.actor_hidden_size * 2).astype(np.float32)
+    rnn_states_critic = np.random.randn(A, batch_size, all_args.recurrent_N,
+                                        all_args.critic_hidden_size).astype(np.float32)
+    masks = np.ones((A, batch_size, 1), dtype=np.float32)
+
+    def per_agent(step):
+        return lambda: [[x.cpu() for x in step(i)] for i in range(A)]
+
+    def collect(i):
+        return policies[i].get_actions(share_obs[i], obs[i], rnn_states[i], rnn_states_critic[i], masks[i])
+
+    def compute(i):
+        return [policies[i].get_values(share_obs[i], rnn_states_critic[i], masks[i])]
+
+    def evaluate(i):
+        return policies[i].act(obs[i], rnn_states[i], masks[i], deterministic=True)
+
+    fns = [per_agent(collect),
+           lambda: [x.cpu() for x in batched.get_actions(share_obs, obs, rnn_states, rnn_states_critic, masks)],
+           per_agent(compute),
+           lambda: batched.get_values(share_obs, rnn_states_critic, masks).cpu(),
+           per_agent(evaluate),
+           lambda: [x.cpu() for x in batched.act(obs, rnn_states, masks, deterministic=True)]]
+    return timed(fns, args.repeats)
+
+
+def main_batched(args):
+    policies = [make_policy(args, False)[0] for _ in range(args.num_agents)]
+    all_args = policies[0].init_dict
+    batched = R_MAPPOBatchedPolicy(all_args, policies, device=torch.device(args.device))
+
+    print("{:>8} {:>22} {:>22} {:>22}".format("batch", "collect loop/batched", "compute loop/batched",
+                                              "eval loop/batched"))
+    for batch_size in args.batch_sizes:
+        ms = measure_batched(policies, batched, all_args, batch_size, args)
+        print("{:>8} {:>22} {:>22} {:>22}".format(batch_size, *["{:.3f}/{:.3f}".format(*ms[i:i + 2])
+                                                                 for i in (0, 2, 4)]))
+
+
+def main(args):
+    args = parse_args(args)
+    if args.batched:
+        return main_batched(args)
+    eager, all_args = make_policy(args, False)
+    compiled, _ = make_policy(args, True)
+
+    print("{:>8} {:>12} {:>14}".format("batch", "eager ms", "compiled ms"))
+    for batch_size in args.batch_sizes:
+        print("{:>8} {:>12.3f} {:>14.3f}".format(batch_size,
+                                               measure(eager, all_args, batch_size, args),
+                                               measure(compiled, all_args, batch_size, args)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
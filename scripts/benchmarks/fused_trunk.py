@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from gymnasium.spaces import Box, Discrete, Tuple
+from algorithms.mappo.config import get_config
+from algorithms.mappo.algorithms.r_mappo.algorithm.r_actor_critic import R_Actor
+
+"""
+Separate against fused (--use_fused_actor_trunk) control and communication trunks of R_Actor on one CPU thread, as
+median milliseconds per call: the MLP trunks alone without autograd (rollout) and with backward (training), and the
+whole actor forward. Both layouts start from the same initialization, the largest difference between their actions
+is reported as well. Rollout batches are n_rollout_threads * num_agents rows, so the small batch sizes are the ones
+the fused trunk is meant for.
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--obs_dim', type=int, default=18)
+    parser.add_argument('--hidden_sizes', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 128, 512, 1024])
+    parser.add_argument('--recurrent', action='store_true', default=False,
+                        help="Benchmark recurrent actors, their GRUs stay separate in both layouts")
+    parser.add_argument('--repeats', type=int, default=200)
+    return parser.parse_args(args)
+
+
+def timed(fns, repeats):
+    """Median milliseconds per call of every function, calls alternate between the functions"""
+    times = np.zeros((repeats, len(fns)))
+    for fn in fns:
+        fn()
+    for i in range(repeats):
+        for j, fn in enumerate(fns):
+            start = time.perf_counter()
+            fn()
+            times[i, j] = time.perf_counter() - start
+    return np.median(times, 0) * 1e3
+
+
+def make_actors(hidden_size, recurrent, obs_space, act_space):
+    actors = []
+    for fused in (False, True):
+        all_args = get_config().parse_known_args([])[0]
+        all_args.actor_hidden_size = hidden_size
+        all_args.use_recurrent_policy = recurrent
+        all_args.use_fused_actor_trunk = fused
+        torch.manual_seed(0)
+        actors.append(R_Actor(all_args, obs_space, act_space))
+    return actors, all_args.recurrent_N
+
+
+def main(args):
+    args = parse_args(args)
+    torch.set_num_threads(1)
+    obs_space = Box(-np.inf, np.inf, (args.obs_dim,), np.float32)
+    act_space = Tuple((Box(-1.0, 1.0, (2,), np.float32), Discrete(2)))
+
+    print("{:>7} {:>6} {:>20} {:>20} {:>20} {:>10}".format(
+        "hidden", "batch", "trunk fwd sep/fused", "trunk bw sep/fused", "actor sep/fused", "max diff"))
+    for hidden_size in args.hidden_sizes:
+        (separate, fused), recurrent_N = make_actors(hidden_size, args.recurrent, obs_space, act_space)
+        for batch_size in args.batch_sizes:
+            obs = torch.randn(batch_size, args.obs_dim)
+            rnn_states = torch.randn(batch_size, recurrent_N, 2 * hidden_size)
+            masks = torch.ones(batch_size, 1)
+
+            def separate_trunk():
+                return separate.base_ctrl(obs), separate.base_com(obs)
+
+            def separate_trunk_backward():
+                control_features, communication_features = separate_trunk()
+                (control_features.sum() + communication_features.sum()).backward()
+
+            def fused_trunk_backward():
+                control_features, communication_features = fused.base(obs)
+                (control_features.sum() + communication_features.sum()).backward()
+
+            def act(actor):
+                return actor(obs, rnn_states, masks, deterministic=True)
+
+            with torch.no_grad():
+                trunk_ms = timed([separate_trunk, lambda: fused.base(obs)], args.repeats)
+                act_ms = timed([lambda: act(separate), lambda: act(fused)], args.repeats)
+                diff = (act(separate)[0] - act(fused)[0]).abs().max().item()
+            backward_ms = timed([separate_trunk_backward, fused_trunk_backward], args.repeats)
+            print("{:>7d} {:>6d} {:>20} {:>20} {:>20} {:>10.1e}".format(
+                hidden_size, batch_size, *["{:.3f}/{:.3f}".format(*ms) for ms in (trunk_ms, backward_ms, act_ms)],
+                diff))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from gymnasium.spaces import Box, Discrete, Tuple
+from algorithms.mappo.config import get_config
+from algorithms.mappo.algorithms.r_mappo.r_mappo import R_MAPPO
+from algorithms.mappo.algorithms.r_mappo.r_mappo_batched import R_MAPPOBatched
+from algorithms.mappo.algorithms.r_mappo.algorithm.rMAPPOPolicy import R_MAPPOPolicy
+from algorithms.mappo.utils.shared_buffer import SharedReplayBuffer
+from algorithms.mappo.utils.separated_buffer import SeparatedReplayBuffer
+from fused_trunk import timed
+
+"""
+PPO updates per second of R_MAPPO.train compared with the previous per-minibatch host sync loop. With --batched, the
+separate policies of num_agents agents are trained one after the other (R_MAPPO.train per agent) against
+R_MAPPOBatched.train (--use_batched_train), as median milliseconds per training update of all agents.
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_agents', type=int, default=3)
+    parser.add_argument('--obs_dim', type=int, default=18)
+    parser.add_argument('--n_rollout_threads', type=int, default=8)
+    parser.add_argument('--episode_length', type=int, default=25)
+    parser.add_argument('--num_mini_batch', type=int, default=4)
+    parser.add_argument('--ppo_epoch', type=int, default=15)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--recurrent', action='store_true')
+    parser.add_argument('--batched', action='store_true', default=False,
+                        help="Compare per-agent trainers with R_MAPPOBatched instead of the legacy loop")
+    parser.add_argument('--repeats', type=int, default=5)
+    return parser.parse_args(args)
+
+
+def legacy_train(trainer, buffer):
+    """R_MAPPO.train before statistics were kept on the device, advantages normalized with NumPy."""
+    advantages = buffer.returns[:-1] - trainer.value_normalizer.denormalize(buffer.value_preds[:-1])
+    advantages_copy = advantages.copy()
+    advantages_copy[buffer.active_masks[:-1] == 0.0] = np.nan
+    advantages = (advantages - np.nanmean(advantages_copy)) / (np.nanstd(advantages_copy) + 1e-5)
+
+    train_info = dict(value_loss=0, policy_loss=0, dist_entropy=0, actor_grad_norm=0, critic_grad_norm=0, ratio=0)
+    for _ in range(trainer.ppo_epoch):
+        if trainer._use_recurrent_policy:
+            data_generator = buffer.recurrent_generator(advantages, trainer.num_mini_batch, trainer.data_chunk_length)
+        else:
+            data_generator = buffer.feed_forward_generator(advantages, trainer.num_mini_batch)
+        for sample in data_generator:
+            value_loss, critic_grad_norm, policy_loss, dist_entropy, actor_grad_norm, imp_weights \
+                = trainer.ppo_update(sample)
+            train_info['value_loss'] += value_loss.item()
+            train_info['policy_loss'] += policy_loss.item()
+            train_info['dist_entropy'] += dist_entropy.item()
+            train_info['actor_grad_norm'] += actor_grad_norm.item()
+            train_info['critic_grad_norm'] += critic_grad_norm.item()
+            train_info['ratio'] += imp_weights.mean().item()
+    return train_info
+
+
+def make_args(args):
+    all_args = get_config().parse_known_args([])[0]
+    all_args.episode_length = args.episode_length
+    all_args.n_rollout_threads = args.n_rollout_threads
+    all_args.num_mini_batch = args.num_mini_batch
+    all_args.ppo_epoch = args.ppo_epoch
+    all_args.use_recurrent_policy = args.recurrent
+    return all_args
+
+
+def fill_buffer(buffer):
+    for name in ['share_obs', 'obs', 'value_preds', 'returns', 'action_log_probs']:
+        array = getattr(buffer, name)
+        array[:] = np.random.randn(*array.shape)
+    buffer.actions[..., :2] = np.random.uniform(-1, 1, buffer.actions[..., :2].shape)
+    buffer.actions[..., 2] = np.random.randint(0, 2, buffer.actions.shape[:-1])
+
+
+def make_trainer(args):
+    all_args = make_args(args)
+
+    obs_space = Box(-np.inf, np.inf, (args.obs_dim,), np.float32)
+    share_obs_space = Box(-np.inf, np.inf, (args.obs_dim * args.num_agents,), np.float32)
+    act_space = Tuple((Box(-1.0, 1.0, (2,), np.float32), Discrete(2)))
+
+    device = torch.device(args.device)
+    policy = R_MAPPOPolicy(all_args, obs_space, share_obs_space, act_space, device=device)
+    trainer = R_MAPPO(all_args, policy, device=device)
+    buffer = SharedReplayBuffer(all_args, args.num_agents, obs_space, share_obs_space, act_space)
+    fill_buffer(buffer)
+    return trainer, buffer
+
+
+def make_separated_trainers(args):
+    all_args = make_args(args)
+
+    obs_space = Box(-np.inf, np.inf, (args.obs_dim,), np.float32)
+    share_obs_space = Box(-np.inf, np.inf, (args.obs_dim * args.num_agents,), np.float32)
+    act_space = Tuple((Box(-1.0, 1.0, (2,), np.float32), Discrete(2)))
+
+    device = torch.device(args.device)
+    trainers, buffers = [], []
+    for _ in range(args.num_agents):
+        policy = R_MAPPOPolicy(all_args, obs_space, share_obs_space, act_space, device=device)
+        trainers.append(R_MAPPO(all_args, policy, device=device))
+        buffers.append(SeparatedReplayBuffer(all_args, obs_space, share_obs_space, act_space))
+        fill_buffer(buffers[-1])
+    return trainers, buffers, R_MAPPOBatched(all_args, trainers, device=device)
+
+
+def measure(train, trainer, buffer, args):
+    train(trainer, buffer)
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.repeats):
+        train(trainer, buffer)
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return args.repeats * trainer.ppo_epoch * trainer.num_mini_batch / (time.time() - start)
+
+
+def main_batched(args):
+    trainers, buffers, batched = make_separated_trainers(args)
+    batched.prep_training()
+
+    def per_agent():
+        for trainer, buffer in zip(trainers, buffers):
+            trainer.train(buffer)
+
+    ms = timed([per_agent, lambda: batched.train(buffers)], args.repeats)
+    print("{:>10} {:>14} {:>14}".format("loop", "ms/train", "updates/s"))
+    for name, t in zip(("per agent", "batched"), ms):
+        print("{:>10} {:>14.1f} {:>14.2f}".format(name, t, args.ppo_epoch * args.num_mini_batch / t * 1e3))
+
+
+def main(args):
+    args = parse_args(args)
+    if args.batched:
+        return main_batched(args)
+    trainer, buffer = make_trainer(args)
+    trainer.prep_training()
+
+    print("{:>10} {:>14}".format("loop", "updates/s"))
+    print("{:>10} {:>14.2f}".format("legacy", measure(legacy_train, trainer, buffer, args)))
+    print("{:>10} {:>14.2f}".format("current", measure(R_MAPPO.train, trainer, buffer, args)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import numpy as np
+from utils.buffer import ReplayBuffer, PrioritizedReplayBuffer
+
+"""
+Cost of drawing a prioritized batch (sample_indices + importance_weights) and of writing back its priorities
+(update_priorities) across capacities, against uniform sample_indices. The index work is independent of the stored
+fields, so the buffers hold one agent with one dimensional observations and actions.
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capacities', type=int, nargs='+', default=[10 ** 4, 10 ** 5, 10 ** 6])
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--repeats', type=int, default=200)
+    return parser.parse_args(args)
+
+
+def timed(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1e6
+
+
+def main(args):
+    args = parse_args(args)
+    print("{:>9} {:>12} {:>12} {:>12} {:>16}".format(
+        "capacity", "uniform us", "sample us", "update us", "us/(B log2 n)"))
+    for capacity in args.capacities:
+        uniform = ReplayBuffer(capacity, 1, [1], [1])
+        uniform.filled_i = capacity
+        buffer = PrioritizedReplayBuffer(capacity, 1, [1], [1])
+        buffer.filled_i = capacity
+        buffer.update_priorities(np.arange(capacity), np.random.rand(capacity))
+
+        def sample():
+            inds = buffer.sample_indices(args.batch_size)
+            return inds, buffer.importance_weights(inds)
+
+        inds, _ = sample()
+        td_errors = np.random.randn(args.batch_size)
+        uniform_us = timed(lambda: uniform.sample_indices(args.batch_size), args.repeats)
+        sample_us = timed(sample, args.repeats)
+        update_us = timed(lambda: buffer.update_priorities(inds, td_errors), args.repeats)
+        per_op = (sample_us + update_us) / (args.batch_size * np.log2(capacity))
+        print("{:>9.0e} {:>12.1f} {:>12.1f} {:>12.1f} {:>16.4f}".format(
+            capacity, uniform_us, sample_us, update_us, per_op))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from gymnasium.spaces import Box, Discrete, Tuple
+from algorithms.mappo.config import get_config
+from algorithms.mappo.algorithms.r_mappo.algorithm.rMAPPOPolicy import R_MAPPOPolicy
+from algorithms.mappo.algorithms.r_mappo.algorithm.r_actor_critic import split_actor_state_dict
+from utils.neuralnets import MLPNetwork
+from utils.misc import quantized_copy
+
+"""
+Accuracy and CPU latency of the dynamic int8 rollout actors (--use_quantized_rollout for MAPPO, quantize_rollouts
+for RA_MADDPG) against the float actors. Accuracy compares the action means and the communication decisions.
+Freshly initialized communication heads (gain 0.01) put most decisions close to a tie, which is the worst case for
+the agreement, pass --model_dir to check a trained MAPPO actor instead.
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--obs_dim', type=int, default=18)
+    parser.add_argument('--hidden_sizes', type=int, nargs='+', default=[64, 256, 1024])
+    parser.add_argument('--batch_size', type=int, default=32, help="Rollout threads acting per call")
+    parser.add_argument('--num_samples', type=int, default=4096, help="Observations for the accuracy check")
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--model_dir', type=str, default=None,
+                        help="Folder with init.pt and actor.pt (or actor_agent0.pt) of a trained MAPPO run")
+    parser.add_argument('--max_mean_error', type=float, default=0.05,
+                        help="Allowed absolute error of the control action means")
+    parser.add_argument('--min_agreement', type=float, default=0.98,
+                        help="Required fraction of identical communication decisions")
+    return parser.parse_args(args)
+
+
+def mappo_actors(args, hidden_size):
+    if args.model_dir is None:
+        all_args = get_config().parse_known_args([])[0]
+        all_args.actor_hidden_size = all_args.critic_hidden_size = hidden_size
+    else:
+        all_args = torch.load(os.path.join(args.model_dir, 'init.pt'), weights_only=False)
+        hidden_size = all_args.actor_hidden_size
+        actor_file = 'actor.pt' if os.path.isfile(os.path.join(args.model_dir, 'actor.pt')) else 'actor_agent0.pt'
+        state_dict = torch.load(os.path.join(args.model_dir, actor_file), map_location='cpu')
+        trunk = split_actor_state_dict(state_dict) if 'base.weights.0' in state_dict else state_dict
+        args.obs_dim = trunk['base_ctrl.mlp.fc1.0.weight'].size(1)
+    all_args.use_quantized_rollout = True
+    obs_space = Box(-np.inf, np.inf, (args.obs_dim,), np.float32)
+    act_space = Tuple((Box(-1.0, 1.0, (2,), np.float32), Discrete(2)))
+    policy = R_MAPPOPolicy(all_args, obs_space, obs_space, act_space)
+    if args.model_dir is not None:
+        policy.actor.load_state_dict(state_dict)
+        policy.refresh_rollout_actor()
+    policy.actor.eval()
+    rnn_states = np.zeros((1, all_args.recurrent_N, hidden_size * 2), dtype=np.float32)
+
+    def run(actor):
+        def act(obs):
+            n = obs.shape[0]
+            actions, _, _ = actor(obs, rnn_states.repeat(n, 0), np.ones((n, 1), dtype=np.float32), None, True)
+            return actions[:, :2], actions[:, 2]
+        return act
+    return run(policy.actor), run(policy.rollout_actor), hidden_size
+
+
+def maddpg_actors(args, hidden_size):
+    control = MLPNetwork(args.obs_dim, 2, hidden_dim=hidden_size, discrete_action=False, constrain_out=False).eval()
+    options = MLPNetwork(args.obs_dim, 2, hidden_dim=hidden_size, discrete_action=True).eval()
+
+    def run(control, options):
+        def act(obs):
+            obs = torch.from_numpy(obs)
+            return control(obs), options(obs).argmax(-1)
+        return act
+    return run(control, options), run(quantized_copy(control), quantized_copy(options)), hidden_size
+
+
+@torch.no_grad()
+def latency(act, args):
+    obs = np.random.randn(args.batch_size, args.obs_dim).astype(np.float32)
+    for _ in range(5):
+        act(obs)
+    start = time.time()
+    for _ in range(args.repeats):
+        act(obs)
+    return (time.time() - start) / args.repeats * 1e3
+
+
+@torch.no_grad()
+def accuracy(float_act, int8_act, args):
+    obs = np.random.randn(args.num_samples, args.obs_dim).astype(np.float32)
+    float_means, float_comm = float_act(obs)
+    int8_means, int8_comm = int8_act(obs)
+    return (float_means - int8_means).abs().max().item(), (float_comm == int8_comm).float().mean().item()
+
+
+def main(args):
+    args = parse_args(args)
+    torch.set_grad_enabled(False)
+    ok = True
+    print("{:>8} {:>7} {:>11} {:>10} {:>11} {:>11}".format(
+        "actor", "hidden", "float ms", "int8 ms", "mean err", "comm agree"))
+    for name, make in (('mappo', mappo_actors), ('maddpg', maddpg_actors)):
+        hidden_sizes = args.hidden_sizes[:1] if name == 'mappo' and args.model_dir is not None else args.hidden_sizes
+        for hidden_size in hidden_sizes:
+            float_act, int8_act, hidden_size = make(args, hidden_size)
+            error, agreement = accuracy(float_act, int8_act, args)
+            ok = ok and error <= args.max_mean_error and agreement >= args.min_agreement
+            print("{:>8} {:>7d} {:>11.3f} {:>10.3f} {:>11.4f} {:>11.4f}".format(
+                name, hidden_size, latency(float_act, args), latency(int8_act, args), error, agreement))
+    print("accuracy check {}".format("ok" if ok else "FAILED"))
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
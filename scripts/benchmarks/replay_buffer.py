@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from utils.buffer import ReplayBuffer, CompactReplayBuffer, MemmapReplayBuffer, TorchReplayBuffer
+
+"""
+Memory, push and sample cost of the (RA_)MADDPG ReplayBuffer at full capacity, including pushes that wrap around.
+--compact benchmarks the CompactReplayBuffer, --buffer_dir the MemmapReplayBuffer (MB is then the size on disk) and
+--torch_device the TorchReplayBuffer.
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buffer_size', type=int, default=int(1e6))
+    parser.add_argument('--num_agents', type=int, default=3)
+    parser.add_argument('--obs_dim', type=int, default=18)
+    parser.add_argument('--action_dim', type=int, default=4)
+    parser.add_argument('--n_rollout_threads', type=int, default=1, help="Transitions per push")
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--pushes', type=int, default=2000)
+    parser.add_argument('--samples', type=int, default=50)
+    parser.add_argument('--episode_length', type=int, default=40)
+    parser.add_argument('--compact', action='store_true')
+    parser.add_argument('--buffer_dir', type=str, default=None)
+    parser.add_argument('--torch_device', type=str, default=None)
+    return parser.parse_args(args)
+
+
+def transitions(args):
+    """Transitions of episodes of episode_length steps, the next observation is the following observation."""
+    n = args.n_rollout_threads
+    obs = torch.randn(n, args.num_agents, args.obs_dim)
+    for t in range(args.pushes):
+        next_obs = torch.randn(n, args.num_agents, args.obs_dim)
+        done = (t + 1) % args.episode_length == 0
+        yield (obs, [torch.randn(n, args.action_dim) for _ in range(args.num_agents)], torch.randn(n, args.num_agents),
+               next_obs, torch.full((n, args.num_agents), float(done)))
+        obs = torch.randn(n, args.num_agents, args.obs_dim) if done else next_obs
+
+
+def nbytes(buffer):
+    arrays = [v for v in vars(buffer).values() if isinstance(v, (np.ndarray, torch.Tensor))]
+    arrays += [a for v in vars(buffer).values() if isinstance(v, list) for a in v]
+    return sum(a.nbytes for a in arrays)
+
+
+def main(args):
+    args = parse_args(args)
+    dims = ([args.obs_dim] * args.num_agents, [args.action_dim] * args.num_agents)
+    if args.buffer_dir is not None:
+        buffer_cls = MemmapReplayBuffer
+        buffer = MemmapReplayBuffer(args.buffer_dir, args.buffer_size, args.num_agents, *dims)
+    elif args.torch_device is not None:
+        buffer_cls = TorchReplayBuffer
+        buffer = TorchReplayBuffer(args.buffer_size, args.num_agents, *dims, device=args.torch_device)
+    else:
+        buffer_cls = CompactReplayBuffer if args.compact else ReplayBuffer
+        buffer = buffer_cls(args.buffer_size, args.num_agents, *dims)
+    if args.compact:
+        buffer.obs[:] = np.random.randn(*buffer.obs.shape)
+        buffer.next_ref[:] = (np.arange(args.buffer_size) + args.n_rollout_threads) % args.buffer_size
+    elif args.torch_device is not None:
+        for buff in (buffer.obs, buffer.acs, buffer.next_obs, buffer.rew_buffs):
+            buff.normal_()
+    else:
+        for buffs in (buffer.obs_buffs, buffer.ac_buffs, buffer.next_obs_buffs):
+            for buff in buffs:
+                buff[:] = np.random.randn(*buff.shape)
+    if args.torch_device is None:
+        buffer.rew_buffs[:] = np.random.randn(*buffer.rew_buffs.shape)
+    # full buffer, the pushes below cross the end of the storage halfway through (split across it if
+    # n_rollout_threads > 1)
+    buffer.filled_i = args.buffer_size
+    buffer.curr_i = args.buffer_size - args.pushes * args.n_rollout_threads // 2 - 1
+
+    times = []
+    for data in list(transitions(args)):
+        start = time.perf_counter()
+        buffer.push(*data)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1e6
+
+    sample_ms = []
+    for norm_rews in (False, True):
+        start = time.perf_counter()
+        for _ in range(args.samples):
+            buffer.sample(args.batch_size, norm_rews=norm_rews)
+        sample_ms.append((time.perf_counter() - start) / args.samples * 1e3)
+
+    print("{}: capacity {:.0e}, {} agents, {} transition(s) per push, {:.0f} MB".format(
+        buffer_cls.__name__, args.buffer_size, args.num_agents, args.n_rollout_threads, nbytes(buffer) / 2 ** 20))
+    print("push   mean {:9.1f} us   max {:9.1f} us".format(times.mean(), times.max()))
+    print("sample batch {} {:9.2f} ms   with norm_rews {:9.2f} ms".format(args.batch_size, *sample_ms))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
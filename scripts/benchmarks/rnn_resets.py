@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+import sys
+import time
+import argparse
+import torch
+from algorithms.mappo.algorithms.utils.rnn import RNNLayer
+
+"""RNNLayer forward + backward time of the segment loop and the packed sequence path across reset frequencies."""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--episode_length', type=int, default=25)
+    parser.add_argument('--batch_size', type=int, default=128, help="Number of sequences (N)")
+    parser.add_argument('--hidden_size', type=int, default=64)
+    parser.add_argument('--recurrent_N', type=int, default=1)
+    parser.add_argument('--reset_probs', type=float, nargs='+', default=[0.0, 0.01, 0.05, 0.2, 0.5, 1.0])
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeats', type=int, default=20)
+    return parser.parse_args(args)
+
+
+def measure(layer, x, hxs, masks, args):
+    def step():
+        out, h = layer(x, hxs, masks)
+        (out.sum() + h.sum()).backward()
+        return out, h
+
+    outputs = step()
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.repeats):
+        step()
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.time() - start) / args.repeats * 1e3, outputs
+
+
+def main(args):
+    args = parse_args(args)
+    device = torch.device(args.device)
+    T, N = args.episode_length, args.batch_size
+
+    loop = RNNLayer(args.hidden_size, args.hidden_size, args.recurrent_N, True).to(device)
+    packed = RNNLayer(args.hidden_size, args.hidden_size, args.recurrent_N, True,
+                      use_packed_sequences=True).to(device)
+    packed.load_state_dict(loop.state_dict())
+
+    print("{:>8} {:>10} {:>10} {:>12} {:>12}".format("p_reset", "segments", "loop ms", "packed ms", "max diff"))
+    for p in args.reset_probs:
+        x = torch.randn(T * N, args.hidden_size, device=device, requires_grad=True)
+        hxs = torch.randn(N, args.recurrent_N, args.hidden_size, device=device)
+        masks = (torch.rand(T * N, 1, device=device) >= p).float()
+        segments = int((masks.view(T, N)[1:] == 0).any(-1).sum()) + 1
+
+        loop_ms, (loop_out, loop_h) = measure(loop, x, hxs, masks, args)
+        packed_ms, (packed_out, packed_h) = measure(packed, x, hxs, masks, args)
+        diff = max((loop_out - packed_out).abs().max().item(), (loop_h - packed_h).abs().max().item())
+        print("{:>8.2f} {:>10d} {:>10.3f} {:>12.3f} {:>12.2e}".format(p, segments, loop_ms, packed_ms, diff))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
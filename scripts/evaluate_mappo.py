@@ -5,6 +5,7 @@ from custom_envs.mpe import simple_spread_c_v2
 import numpy as np
 import torch
 from algorithms.mappo.algorithms.r_mappo.algorithm.r_actor_critic import R_Actor
+from algorithms.mappo.algorithms.r_mappo.algorithm.exported_actor import load_exported_actor
 
 def dict_to_tensor(d):
   d = list(d.values())
@@ -16,12 +17,16 @@ def preprocess_obs(obs):
   obs = dict_to_tensor(obs)
   return obs
 
-def get_logits(obs, policies, rnn_state):
+def get_masks(batch_size, deterministic):
+  # deterministic runs carry the RNN states like --exported does, otherwise they are reset every step
+  return torch.ones(batch_size, 1) if deterministic else torch.tensor(0)
+
+def get_logits(obs, policies, rnn_state, deterministic=False):
   logits = []
   new_rnn_state = []
   for i, p in enumerate(policies):
     o = obs[i].unsqueeze(0)
-    l, _, r = p(o, rnn_state[i], torch.tensor(0))
+    l, _, r = p(o, rnn_state[i], get_masks(1, deterministic), deterministic=deterministic)
     logits.append(l.squeeze(0))
     new_rnn_state.append(r.squeeze(0))
   
@@ -29,12 +34,20 @@ def get_logits(obs, policies, rnn_state):
   new_rnn_state = torch.stack(new_rnn_state)
   return logits, new_rnn_state
 
-def get_actions(obs, env, rnn_state, policies, training=False):
+def get_exported_actions(obs, env, rnn_state, policy):
+  # one call for all agents, obs is (n_agents, 1, obs_dim)
+  logits, rnn_state = policy(obs.float().unsqueeze(1), rnn_state, torch.ones(obs.size(0), 1, 1))
+  logits = np.clip(logits.squeeze(1), -1, 1)
+  actions = {agent: logits[i] for i, agent in enumerate(env.possible_agents)}
+  return actions, logits, rnn_state
+
+def get_actions(obs, env, rnn_state, policies, training=False, deterministic=False):
   actions = {}
   if len(policies) > 1:
-    logits, rnn_state = get_logits(obs, policies, rnn_state)
+    logits, rnn_state = get_logits(obs, policies, rnn_state, deterministic)
   else:
-    logits, _, rnn_state = policies[0](obs, rnn_state, torch.tensor(0))
+    logits, _, rnn_state = policies[0](obs, rnn_state, get_masks(obs.size(0), deterministic),
+                                       deterministic=deterministic)
 
   logits = np.clip(logits, -1, 1)
   for i, agent in enumerate(env.possible_agents):
@@ -44,10 +57,16 @@ def get_actions(obs, env, rnn_state, policies, training=False):
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
-  parser.add_argument('filename', description='Path to folder containing actor.pt files', ntype=str)
+  parser.add_argument('filename', help='Path to folder containing actor.pt files', type=str)
   parser.add_argument('-n', '--n_agents', type=int, default=3)
   parser.add_argument('-r', '--random_actions', action='store_true')
   parser.add_argument('-f', '--full_com', action='store_true')
+  parser.add_argument('-d', '--deterministic', action='store_true',
+                      help='Take the mode actions and carry the RNN states over the episode, as --exported does. '
+                           'By default the checkpoints sample their actions and reset the RNN states every step')
+  parser.add_argument('-e', '--exported', type=str, default=None,
+                      help='Run an actor exported with scripts/export_mappo.py instead of the actor checkpoints. '
+                           'Exported actors are deterministic, compare their rewards with checkpoint runs using -d')
   args = parser.parse_args()
 
   if not hasattr(args, 'hidden_size'):
@@ -75,7 +94,10 @@ if __name__ == '__main__':
                                       continuous_actions=True,
                                       render_mode = 'rgb_array')
 
-  if not args.random_actions:
+  if args.exported is not None:
+    exported_policy = load_exported_actor(args.exported)
+    rnn_state = torch.zeros(args.n_agents, 1, max(exported_policy.recurrent_N, 1), exported_policy.hidden_size * 2)
+  elif not args.random_actions:
     init_dict = torch.load(args.filename + '/init.pt')
     print(init_dict)
     actor_files = [f for f in os.listdir(args.filename) if f.startswith('actor_agent') and f.endswith('.pt')]
@@ -112,8 +134,10 @@ if __name__ == '__main__':
           a = env.action_space('agent_0').sample()
           a = (*a[0], a[1])
           actions['agent_{}'.format(n)] = a
+      elif args.exported is not None:
+        actions, logits, rnn_state = get_exported_actions(obs, env, rnn_state, exported_policy)
       else:
-        actions, logits, rnn_state = get_actions(obs, env, rnn_state, policies, False)
+        actions, logits, rnn_state = get_actions(obs, env, rnn_state, policies, False, args.deterministic)
 
       next_obs, rewards, dones, truncations, infos = env.step(actions)
       next_obs = preprocess_obs(next_obs)
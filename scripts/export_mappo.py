@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+import os
+import sys
+import argparse
+import torch
+from algorithms.mappo.algorithms.r_mappo.algorithm.exported_actor import ExportedActor, export_actor
+
+"""Export trained MAPPO actors as one deterministic, inference-only TorchScript policy for all agents."""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model_dir', type=str, help='Path to folder containing init.pt and actor .pt files')
+    parser.add_argument('-n', '--n_agents', type=int, default=3)
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='Output file, by default actor_exported.pt in model_dir')
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    init_dict = torch.load(os.path.join(args.model_dir, 'init.pt'), weights_only=False)
+
+    actor_files = sorted([f for f in os.listdir(args.model_dir) if f.startswith('actor_agent') and f.endswith('.pt')],
+                         key=lambda f: int(f[len('actor_agent'):-len('.pt')]))
+    if len(actor_files) == 0:
+        actor_files = ['actor.pt']
+    state_dicts = [torch.load(os.path.join(args.model_dir, f), map_location='cpu') for f in actor_files]
+
+    actor = ExportedActor.from_state_dicts(state_dicts, init_dict, num_agents=args.n_agents)
+    output = args.output or os.path.join(args.model_dir, 'actor_exported.pt')
+    export_actor(actor, output)
+    print("Exported {} agent(s) from {} to {}".format(actor.num_agents, ', '.join(actor_files), output))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -7,7 +7,8 @@ from pathlib import Path
 from gymnasium.spaces.utils import flatdim
 from matplotlib import pyplot as plt
 from algorithms.resource_aware_maddpg import RA_MADDPG
-from utils.buffer import ReplayBuffer
+from utils.buffer import ReplayBuffer, CompactReplayBuffer, MemmapReplayBuffer, PrioritizedReplayBuffer, \
+  TorchReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
 
 USE_CUDA = torch.cuda.is_available()
@@ -77,10 +78,29 @@ def run_episode(env, agents, replay_buffer, args, training=True):
 
       if len(replay_buffer) > args.batch_size and training and update_counter > args.update_interval:
         update_counter = 0
-        for j in range(agents.n_agents):
+        # with --shared_sample all agents of this update round train on the same indices, with --update_all
+        # they train together on a single sample
+        inds = replay_buffer.sample_indices(args.batch_size) if args.shared_sample else None
+        # the weights of a shared sample belong to the priorities it was drawn with, its priorities are written
+        # once after all agents, as the mean |TD error| over agents
+        weights = replay_buffer.importance_weights(inds) if args.prioritized and args.shared_sample else None
+        shared_td_errors = []
+        for j in range(1 if args.update_all else agents.n_agents):
+          if args.prioritized and not args.shared_sample:
+            inds = replay_buffer.sample_indices(args.batch_size)
+            weights = replay_buffer.importance_weights(inds)
           sample = replay_buffer.sample(
-              args.batch_size, USE_CUDA, norm_rews=True)
-          agents.update(sample, j, logger=writer)
+              args.batch_size, USE_CUDA, norm_rews=True, inds=inds)
+          if args.update_all:
+            td_errors = np.abs(agents.update_all(sample, logger=writer, weights=weights)).mean(0)
+          else:
+            td_errors = np.abs(agents.update(sample, j, logger=writer, weights=weights))
+          if args.prioritized and args.shared_sample:
+            shared_td_errors.append(td_errors)
+          elif args.prioritized:
+            replay_buffer.update_priorities(inds, td_errors)
+        if shared_td_errors:
+          replay_buffer.update_priorities(inds, np.mean(shared_td_errors, 0))
         agents.update_all_targets(writer)
 
       obs = next_obs
@@ -112,6 +132,19 @@ def parse_args():
   parser.add_argument('-l', '--load', type=str)
   parser.add_argument('-n', '--n_agents', type=int, default=3)
   parser.add_argument('-b', '--buffer_size', type=int, default=1e6)
+  buffer_type = parser.add_mutually_exclusive_group()
+  buffer_type.add_argument('--compact_buffer', action='store_true',
+                           help='Store the replay buffer in float32 without duplicating next observations')
+  buffer_type.add_argument('--buffer_dir', type=str, default=None,
+                           help='Keep the replay buffer in memory-mapped files in this folder, resumed if it already '
+                                'holds one')
+  buffer_type.add_argument('--prioritized', action='store_true',
+                           help='Prioritized replay, sampling transitions by the TD errors of the critic')
+  buffer_type.add_argument('--torch_buffer', action='store_true',
+                           help='Keep the replay buffer as tensors on the training device')
+  parser.add_argument('--per_alpha', type=float, default=0.6, help='Priority exponent of --prioritized')
+  parser.add_argument('--per_beta', type=float, default=0.4,
+                      help='Initial importance weight exponent of --prioritized, annealed to 1 over n_episodes')
   parser.add_argument('-r', '--run_name', type=str, default="default")
   parser.add_argument('-s', '--save', action='store_true')
 
@@ -134,6 +167,10 @@ def parse_args():
   parser.add_argument('--critic_hidden_dim', type=int, default=256)
 
   parser.add_argument('--batch_size', type=int, default=128)
+  parser.add_argument('--shared_sample', action='store_true',
+                      help='Draw one set of sample indices per update round for all agents')
+  parser.add_argument('--update_all', action='store_true',
+                      help='Update all agents on one sample per round, computing the target actions once')
   parser.add_argument('--update_interval', type=int, default=4000)
 
   return parser.parse_args()
@@ -176,9 +213,17 @@ if __name__ == '__main__':
   obs_dim = env.observation_space('agent_0').shape[0]
   action_dim = flatdim(env.action_space('agent_0'))
 
-  replay_buffer = ReplayBuffer(int(args.buffer_size), num_agents=n_agents,
-                               obs_dims=[obs_dim for _ in range(n_agents)],
-                               ac_dims=[action_dim for _ in range(n_agents)])
+  buffer_dims = dict(obs_dims=[obs_dim for _ in range(n_agents)], ac_dims=[action_dim for _ in range(n_agents)])
+  if args.buffer_dir:
+    replay_buffer = MemmapReplayBuffer(args.buffer_dir, int(args.buffer_size), num_agents=n_agents, **buffer_dims)
+  elif args.prioritized:
+    replay_buffer = PrioritizedReplayBuffer(int(args.buffer_size), num_agents=n_agents, **buffer_dims,
+                                            alpha=args.per_alpha, beta=args.per_beta)
+  elif args.torch_buffer:
+    replay_buffer = TorchReplayBuffer(int(args.buffer_size), num_agents=n_agents, **buffer_dims, device=device)
+  else:
+    buffer_cls = CompactReplayBuffer if args.compact_buffer else ReplayBuffer
+    replay_buffer = buffer_cls(int(args.buffer_size), num_agents=n_agents, **buffer_dims)
   if args.load:
     algo = RA_MADDPG.init_from_save(args.load, device=device)
   else:
@@ -195,6 +240,8 @@ if __name__ == '__main__':
   best = float('-inf')
   eval_counter = 0
   for i in range(args.n_episodes):
+    if args.prioritized:
+      replay_buffer.beta = args.per_beta + (1 - args.per_beta) * i / args.n_episodes
     tot_reward, comms, steps = run_episode(
         env, algo, replay_buffer, args, training=True)
 
@@ -211,11 +258,15 @@ if __name__ == '__main__':
       writer.add_scalar('agent/eval_reward', eval_reward, eval_counter)
       writer.add_scalar('agent/eval_comm_savings', eval_comm, eval_counter)
       eval_counter += 1
+      if args.buffer_dir:
+        replay_buffer.flush()
 
       if eval_reward >= best:
         best = eval_reward
         if args.save:
           algo.save(run_dir + '/models/best.pt')
 
+  if args.buffer_dir:
+    replay_buffer.flush()
   writer.close()
   env.close()
@@ -155,6 +155,7 @@ def main(args):
 
     runner = Runner(config)
     runner.run()
+    runner.close()
     
     # post process
     envs.close()
@@ -256,6 +257,7 @@ def simple_train(args):
 
     runner = Runner(config)
     runner.run()
+    runner.close()
     
     # post process
     envs.close()
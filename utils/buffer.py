@@ -1,4 +1,7 @@
+import os
+import json
 import numpy as np
+import torch
 from torch import Tensor
 from torch.autograd import Variable
 
@@ -19,78 +22,521 @@ class ReplayBuffer(object):
         self.num_agents = num_agents
         self.obs_buffs = []
         self.ac_buffs = []
-        self.rew_buffs = []
         self.next_obs_buffs = []
         self.done_buffs = []
         for odim, adim in zip(obs_dims, ac_dims):
             self.obs_buffs.append(np.zeros((max_steps, odim)))
             self.ac_buffs.append(np.zeros((max_steps, adim)))
-            self.rew_buffs.append(np.zeros(max_steps))
             self.next_obs_buffs.append(np.zeros((max_steps, odim)))
             self.done_buffs.append(np.zeros(max_steps))
+        # one row per agent, so that the rewards of all agents can be gathered at once
+        self.rew_buffs = np.zeros((num_agents, max_steps))
 
 
         self.filled_i = 0  # index of first empty location in buffer (last index when full)
         self.curr_i = 0  # current index to write to (ovewrite oldest data)
+        # seeded from the global numpy state so that np.random.seed still makes runs reproducible
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+
+        # running reward statistics of the stored transitions (Welford), per agent
+        self.rew_mean = np.zeros(num_agents)
+        self.rew_M2 = np.zeros(num_agents)
 
     def __len__(self):
         return self.filled_i
 
+    def _write(self, buff, data, nentries):
+        """Write nentries rows starting at curr_i, wrapping around the end of the buffer"""
+        first = min(nentries, self.max_steps - self.curr_i)
+        buff[self.curr_i:self.curr_i + first] = data[:first]
+        if first < nentries:
+            buff[:nentries - first] = data[first:]
+
+    def _update_rew_stats(self, old_rews, rews):
+        """
+        Welford style update of the running reward statistics, every agent at once
+        Inputs:
+            old_rews (np.ndarray): (num_agents, k) rewards of the transitions being overwritten
+            rews (np.ndarray): (num_agents, n) rewards of the new transitions
+        """
+        count = self.filled_i - old_rews.shape[1] + rews.shape[1]
+        mean = self.rew_mean + (rews.sum(1) - old_rews.sum(1) - (rews.shape[1] - old_rews.shape[1]) * self.rew_mean) / count
+        # deviations from the old mean, corrected for the shift of the mean
+        self.rew_M2 = np.maximum(self.rew_M2 + ((rews - self.rew_mean[:, None]) ** 2).sum(1)
+                                 - ((old_rews - self.rew_mean[:, None]) ** 2).sum(1)
+                                 - count * (mean - self.rew_mean) ** 2, 0)
+        self.rew_mean = mean
+
+    def _recompute_rew_stats(self):
+        rews = self.rew_buffs[:, :self.filled_i]
+        self.rew_mean = rews.mean(1)
+        self.rew_M2 = ((rews - self.rew_mean[:, None]) ** 2).sum(1)
+
+    def _overwritten_inds(self, nentries):
+        """Indices of the stored transitions the next nentries transitions overwrite (the oldest ones)"""
+        noverwritten = max(0, self.filled_i + nentries - self.max_steps)
+        return np.arange(self.curr_i + nentries - noverwritten, self.curr_i + nentries) % self.max_steps
+
+    def _push_rews(self, rewards, nentries):
+        rews = np.asarray(rewards, dtype=np.float64).T
+        self._update_rew_stats(self.rew_buffs[:, self._overwritten_inds(nentries)], rews)
+        for agent_i in range(self.num_agents):
+            self._write(self.rew_buffs[agent_i], rews[agent_i], nentries)
+
+    def _advance(self, nentries):
+        wrapped = self.curr_i + nentries >= self.max_steps
+        self.curr_i = (self.curr_i + nentries) % self.max_steps
+        self.filled_i = min(self.filled_i + nentries, self.max_steps)
+        if wrapped:
+            # removing overwritten entries accumulates rounding errors, refresh once per pass over the buffer
+            self._recompute_rew_stats()
+
     def push(self, observations, actions, rewards, next_observations, dones):
         nentries = observations.shape[0]  # handle multiple parallel environments
-        if self.curr_i + nentries > self.max_steps:
-            rollover = self.max_steps - self.curr_i # num of indices to roll over
-            for agent_i in range(self.num_agents):
-                self.obs_buffs[agent_i] = np.roll(self.obs_buffs[agent_i],
-                                                  rollover, axis=0)
-                self.ac_buffs[agent_i] = np.roll(self.ac_buffs[agent_i],
-                                                 rollover, axis=0)
-                self.rew_buffs[agent_i] = np.roll(self.rew_buffs[agent_i],
-                                                  rollover)
-                self.next_obs_buffs[agent_i] = np.roll(
-                    self.next_obs_buffs[agent_i], rollover, axis=0)
-                self.done_buffs[agent_i] = np.roll(self.done_buffs[agent_i],
-                                                   rollover)
-            self.curr_i = 0
-            self.filled_i = self.max_steps
+        self._push_rews(rewards, nentries)
         for agent_i in range(self.num_agents):
-            self.obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = np.vstack(
-                observations[:, agent_i])
+            self._write(self.obs_buffs[agent_i], np.vstack(observations[:, agent_i]), nentries)
             # actions are already batched by agent, so they are indexed differently
-            self.ac_buffs[agent_i][self.curr_i:self.curr_i + nentries] = actions[agent_i]
-            self.rew_buffs[agent_i][self.curr_i:self.curr_i + nentries] = rewards[:, agent_i]
-            self.next_obs_buffs[agent_i][self.curr_i:self.curr_i + nentries] = np.vstack(
-                next_observations[:, agent_i])
-            self.done_buffs[agent_i][self.curr_i:self.curr_i + nentries] = dones[:, agent_i]
-        self.curr_i += nentries
-        if self.filled_i < self.max_steps:
-            self.filled_i += nentries
-        if self.curr_i == self.max_steps:
-            self.curr_i = 0
-
-    def sample(self, N, to_gpu=False, norm_rews=True, eps = 1e-8):
-        inds = np.random.choice(np.arange(self.filled_i), size=N,
-                                replace=False)
-        if to_gpu:
-            cast = lambda x: Variable(Tensor(x), requires_grad=False).cuda()
-        else:
-            cast = lambda x: Variable(Tensor(x), requires_grad=False)
-        if norm_rews:
-            ret_rews = [cast((self.rew_buffs[i][inds] -
-                              self.rew_buffs[i][:self.filled_i].mean()) /
-                             (self.rew_buffs[i][:self.filled_i].std() + eps))
-                        for i in range(self.num_agents)]
-        else:
-            ret_rews = [cast(self.rew_buffs[i][inds]) for i in range(self.num_agents)]
+            self._write(self.ac_buffs[agent_i],
+                        np.broadcast_to(actions[agent_i], (nentries, self.ac_buffs[agent_i].shape[1])), nentries)
+            self._write(self.next_obs_buffs[agent_i], np.vstack(next_observations[:, agent_i]), nentries)
+            self._write(self.done_buffs[agent_i], np.asarray(dones[:, agent_i]), nentries)
+        self._advance(nentries)
+
+    def sample_indices(self, N):
+        """
+        Draw N distinct indices of stored transitions. Generator.choice without replacement uses Floyd's
+        algorithm for small N, so the cost is O(N) instead of permuting all filled_i indices
+        """
+        return self.rng.choice(self.filled_i, size=N, replace=False)
+
+    def sample(self, N, to_gpu=False, norm_rews=True, eps = 1e-8, inds=None):
+        """
+        Sample N transitions of all agents
+        Inputs:
+            N (int): Number of transitions
+            to_gpu (bool): Whether to move the samples to the GPU
+            norm_rews (bool): Whether to standardize the rewards with the buffer statistics
+            inds (np.ndarray): Indices to sample (e.g. from sample_indices), drawn if None
+        """
+        if inds is None:
+            inds = self.sample_indices(N)
+        cast = self._cast(to_gpu)
+        ret_rews = [cast(rews) for rews in self._sample_rews(inds, norm_rews, eps)]
         return ([cast(self.obs_buffs[i][inds]) for i in range(self.num_agents)],
                 [cast(self.ac_buffs[i][inds]) for i in range(self.num_agents)],
                 ret_rews,
                 [cast(self.next_obs_buffs[i][inds]) for i in range(self.num_agents)],
                 [cast(self.done_buffs[i][inds]) for i in range(self.num_agents)])
 
+    @staticmethod
+    def _cast(to_gpu):
+        if to_gpu:
+            return lambda x: Variable(Tensor(x), requires_grad=False).cuda()
+        return lambda x: Variable(Tensor(x), requires_grad=False)
+
+    def _sample_rews(self, inds, norm_rews, eps):
+        rews = self.rew_buffs[:, inds]
+        if norm_rews:
+            rew_std = np.sqrt(self.rew_M2 / self.filled_i)
+            rews = (rews - self.rew_mean[:, None]) / (rew_std[:, None] + eps)
+        return list(rews)
+
     def get_average_rewards(self, N):
         if self.filled_i == self.max_steps:
             inds = np.arange(self.curr_i - N, self.curr_i)  # allow for negative indexing
         else:
             inds = np.arange(max(0, self.curr_i - N), self.curr_i)
         return [self.rew_buffs[i][inds].mean() for i in range(self.num_agents)]
+
+
+class SumMinTree(object):
+    """
+    Array based segment tree holding the sum and the minimum of non-negative leaf values. Node i has the children
+    2i and 2i + 1, the leaves are the last size nodes. Batches of leaves are updated and searched level by level,
+    O(batch log n) with numpy operations per level
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 1
+        while self.size < capacity:
+            self.size *= 2
+        self.sums = np.zeros(2 * self.size)
+        self.mins = np.full(2 * self.size, np.inf)
+
+    @property
+    def total(self):
+        return self.sums[1]
+
+    @property
+    def min(self):
+        return self.mins[1]
+
+    def update(self, inds, values):
+        """Set the leaves inds to values (the last one wins for repeated indices) and refresh their ancestors"""
+        nodes = np.asarray(inds) + self.size
+        self.sums[nodes] = values
+        self.mins[nodes] = values
+        # sorted once, the parents of sorted nodes stay sorted and only neighbours can be duplicates
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.sums[nodes] = self.sums[2 * nodes] + self.sums[2 * nodes + 1]
+            self.mins[nodes] = np.minimum(self.mins[2 * nodes], self.mins[2 * nodes + 1])
+            nodes = nodes // 2
+            nodes = nodes[np.concatenate(([True], nodes[1:] != nodes[:-1]))]
+
+    def find_prefix_sum(self, values):
+        """Leaf index i for every value, such that the sum of the leaves before i is <= value < that sum + leaf i"""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.size:
+            left = self.sums[2 * nodes]
+            right = values >= left
+            values -= left * right
+            nodes = 2 * nodes + right
+        return nodes - self.size
+
+    def __getitem__(self, inds):
+        return self.sums[np.asarray(inds) + self.size]
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer sampling transitions proportionally to priority ** alpha, with the priorities set from the TD errors
+    of the critic (prioritized experience replay, Schaul et al. 2016). New transitions get the highest priority seen
+    so far. The sampling bias is corrected by the importance weights of importance_weights()
+    """
+    def __init__(self, max_steps, num_agents, obs_dims, ac_dims, alpha=0.6, beta=0.4, eps=1e-6):
+        """
+        Inputs:
+            max_steps (int): Maximum number of timepoints to store in buffer
+            num_agents (int): Number of agents in environment
+            obs_dims (list of ints): number of obervation dimensions for each
+                                     agent
+            ac_dims (list of ints): number of action dimensions for each agent
+            alpha (float): How much the priorities shape the sampling, 0 is uniform
+            beta (float): Importance weight exponent, 1 fully corrects the sampling bias
+            eps (float): Added to the absolute TD errors so that every transition can be drawn
+        """
+        super(PrioritizedReplayBuffer, self).__init__(max_steps, num_agents, obs_dims, ac_dims)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+        self.tree = SumMinTree(max_steps)
+
+    def push(self, observations, actions, rewards, next_observations, dones):
+        rows = (self.curr_i + np.arange(observations.shape[0])) % self.max_steps
+        super(PrioritizedReplayBuffer, self).push(observations, actions, rewards, next_observations, dones)
+        self.tree.update(rows, self.max_priority ** self.alpha)
+
+    def sample_indices(self, N):
+        """
+        Draw N indices proportionally to their priorities, one from each of N equal slices of the total priority.
+        Indices can repeat
+        """
+        bounds = (np.arange(N) + self.rng.random(N)) * (self.tree.total / N)
+        return np.minimum(self.tree.find_prefix_sum(bounds), self.filled_i - 1)
+
+    def importance_weights(self, inds, beta=None):
+        """
+        Importance sampling weights (N * P(i)) ** -beta of the transitions inds, divided by the largest possible
+        weight so that they are at most 1
+        """
+        beta = self.beta if beta is None else beta
+        return (self.tree[inds] / self.tree.min) ** -beta
+
+    def update_priorities(self, inds, td_errors):
+        """
+        Set the priorities of the transitions inds from the TD errors of the critic
+        Inputs:
+            inds (np.ndarray): Indices of the sampled transitions
+            td_errors (np.ndarray): TD errors of the transitions
+        """
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)) + self.eps
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.tree.update(inds, priorities ** self.alpha)
+
+
+class CompactReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer storing every field once, as one float32 block for all agents. The next observation of a
+    transition is not stored when the episode goes on: it is the observation of the same environment in the next
+    push. Only next observations that do not reappear as the following observation (episode ends) are kept, in a
+    separate store that grows as needed. Dones are stored as uint8. All agents need the same observation and action
+    dimensions.
+    """
+    def __init__(self, max_steps, num_agents, obs_dims, ac_dims):
+        """
+        Inputs:
+            max_steps (int): Maximum number of timepoints to store in buffer
+            num_agents (int): Number of agents in environment
+            obs_dims (list of ints): number of obervation dimensions for each
+                                     agent
+            ac_dims (list of ints): number of action dimensions for each agent
+        """
+        if len(set(obs_dims)) != 1 or len(set(ac_dims)) != 1:
+            raise ValueError("CompactReplayBuffer needs the same observation and action dimensions for all agents")
+        self.max_steps = max_steps
+        self.num_agents = num_agents
+        self.obs = np.zeros((max_steps, num_agents, obs_dims[0]), dtype=np.float32)
+        self.acs = np.zeros((max_steps, num_agents, ac_dims[0]), dtype=np.float32)
+        self.dones = np.zeros((max_steps, num_agents), dtype=np.uint8)
+        self.rew_buffs = np.zeros((num_agents, max_steps), dtype=np.float32)
+        # >= 0: row holding the next observation, < 0: -(slot + 1) in the terminal observation store
+        self.next_ref = np.zeros(max_steps, dtype=np.int32)
+
+        self.terminal_obs = np.zeros((max(1, max_steps // 32), num_agents, obs_dims[0]), dtype=np.float32)
+        self._free_slots = np.arange(len(self.terminal_obs))[::-1].copy()  # stack of unused terminal slots
+        self._num_free = len(self._free_slots)
+        self._last_rows = None  # rows of the previous push, their next observations are still in the store
+
+        self.filled_i = 0  # index of first empty location in buffer (last index when full)
+        self.curr_i = 0  # current index to write to (ovewrite oldest data)
+        # seeded from the global numpy state so that np.random.seed still makes runs reproducible
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+
+        # running reward statistics of the stored transitions (Welford), per agent
+        self.rew_mean = np.zeros(num_agents)
+        self.rew_M2 = np.zeros(num_agents)
+
+    def _alloc_terminal_slots(self, n):
+        if self._num_free < n:
+            size = len(self.terminal_obs)
+            new_size = max(2 * size, size + n)
+            self.terminal_obs = np.concatenate(
+                [self.terminal_obs, np.zeros((new_size - size,) + self.terminal_obs.shape[1:], dtype=np.float32)])
+            self._free_slots = np.concatenate([self._free_slots, np.zeros(new_size - size, dtype=np.int64)])
+            self._free_terminal_slots(np.arange(size, new_size)[::-1])
+        self._num_free -= n
+        return self._free_slots[self._num_free:self._num_free + n].copy()
+
+    def _free_terminal_slots(self, slots):
+        self._free_slots[self._num_free:self._num_free + len(slots)] = slots
+        self._num_free += len(slots)
+
+    def push(self, observations, actions, rewards, next_observations, dones):
+        nentries = observations.shape[0]  # handle multiple parallel environments
+        obs = np.asarray(observations, dtype=np.float32)
+        next_obs = np.asarray(next_observations, dtype=np.float32)
+        acs = np.stack([np.broadcast_to(np.asarray(ac, dtype=np.float32), (nentries, self.acs.shape[2]))
+                        for ac in actions], 1)
+        rows = (self.curr_i + np.arange(nentries)) % self.max_steps
+
+        overwritten = self._overwritten_inds(nentries)
+        refs = self.next_ref[overwritten]
+        self._free_terminal_slots(-refs[refs < 0] - 1)
+
+        # the environments whose new observation is the stored next observation of the previous push continue
+        # their episode, their previous transitions point to the new rows instead
+        if self._last_rows is not None and len(self._last_rows) == nentries:
+            slots = -self.next_ref[self._last_rows] - 1
+            linked = (self.terminal_obs[slots] == obs).reshape(nentries, -1).all(1)
+            self.next_ref[self._last_rows[linked]] = rows[linked]
+            self._free_terminal_slots(slots[linked])
+
+        self._push_rews(rewards, nentries)
+        self._write(self.obs, obs, nentries)
+        self._write(self.acs, acs, nentries)
+        self._write(self.dones, np.asarray(dones) != 0, nentries)
+        slots = self._alloc_terminal_slots(nentries)
+        self.terminal_obs[slots] = next_obs
+        self.next_ref[rows] = -slots - 1
+        self._last_rows = rows
+        self._advance(nentries)
+
+    def sample(self, N, to_gpu=False, norm_rews=True, eps = 1e-8, inds=None):
+        """
+        Sample N transitions of all agents, see ReplayBuffer.sample
+        """
+        if inds is None:
+            inds = self.sample_indices(N)
+        cast = self._cast(to_gpu)
+        refs = self.next_ref[inds]
+        linked = refs >= 0
+        next_obs = np.empty((len(inds),) + self.obs.shape[1:], dtype=np.float32)
+        next_obs[linked] = self.obs[refs[linked]]
+        next_obs[~linked] = self.terminal_obs[-refs[~linked] - 1]
+        obs, acs, dones = self.obs[inds], self.acs[inds], self.dones[inds]
+        return ([cast(obs[:, i]) for i in range(self.num_agents)],
+                [cast(acs[:, i]) for i in range(self.num_agents)],
+                [cast(rews) for rews in self._sample_rews(inds, norm_rews, eps)],
+                [cast(next_obs[:, i]) for i in range(self.num_agents)],
+                [cast(dones[:, i]) for i in range(self.num_agents)])
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer whose fields are np.memmap files in buffer_dir, so the capacity is not limited by the RAM and the
+    transitions outlive the run. header.json records the layout and how far the buffer is filled, it is written by
+    flush(). Opening a directory that already holds a buffer resumes it, with the layout given here.
+    """
+    HEADER = 'header.json'
+    VERSION = 1
+
+    def __init__(self, buffer_dir, max_steps, num_agents, obs_dims, ac_dims, dtype=np.float32):
+        """
+        Inputs:
+            buffer_dir (str): Directory of the memmap files, created if needed
+            max_steps (int): Maximum number of timepoints to store in buffer
+            num_agents (int): Number of agents in environment
+            obs_dims (list of ints): number of obervation dimensions for each
+                                     agent
+            ac_dims (list of ints): number of action dimensions for each agent
+            dtype (np.dtype): dtype of the stored fields
+        """
+        self.buffer_dir = str(buffer_dir)
+        self.max_steps = max_steps
+        self.num_agents = num_agents
+        self.layout = {'version': self.VERSION, 'max_steps': int(max_steps), 'num_agents': int(num_agents),
+                       'obs_dims': [int(d) for d in obs_dims], 'ac_dims': [int(d) for d in ac_dims],
+                       'dtype': np.dtype(dtype).str}
+        header = self._read_header()
+        if header is not None:
+            layout = {k: header[k] for k in self.layout}
+            if layout != self.layout:
+                raise ValueError("Replay buffer in {} has layout {}, expected {}".format(
+                    self.buffer_dir, layout, self.layout))
+        os.makedirs(self.buffer_dir, exist_ok=True)
+        mode = 'w+' if header is None else 'r+'
+
+        def open_file(name, shape):
+            return np.memmap(os.path.join(self.buffer_dir, name + '.dat'), dtype=dtype, mode=mode, shape=shape)
+
+        self.obs_buffs = [open_file('obs_agent{}'.format(i), (max_steps, d)) for i, d in enumerate(obs_dims)]
+        self.ac_buffs = [open_file('acs_agent{}'.format(i), (max_steps, d)) for i, d in enumerate(ac_dims)]
+        self.next_obs_buffs = [open_file('next_obs_agent{}'.format(i), (max_steps, d))
+                               for i, d in enumerate(obs_dims)]
+        self.done_buffs = [open_file('dones_agent{}'.format(i), (max_steps,)) for i in range(num_agents)]
+        self.rew_buffs = open_file('rews', (num_agents, max_steps))
+
+        self.filled_i = 0 if header is None else header['filled_i']
+        self.curr_i = 0 if header is None else header['curr_i']
+        # seeded from the global numpy state so that np.random.seed still makes runs reproducible
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+
+        # running reward statistics of the stored transitions (Welford), per agent
+        self.rew_mean = np.zeros(num_agents)
+        self.rew_M2 = np.zeros(num_agents)
+        if self.filled_i > 0:
+            self._recompute_rew_stats()
+
+    def _read_header(self):
+        path = os.path.join(self.buffer_dir, self.HEADER)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def flush(self):
+        """Write the stored transitions and the header to disk, the buffer can be resumed from this state"""
+        for buff in self.obs_buffs + self.ac_buffs + self.next_obs_buffs + self.done_buffs + [self.rew_buffs]:
+            buff.flush()
+        header = dict(self.layout, filled_i=int(self.filled_i), curr_i=int(self.curr_i))
+        path = os.path.join(self.buffer_dir, self.HEADER)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(header, f)
+        os.replace(path + '.tmp', path)
+
+    def sample(self, N, to_gpu=False, norm_rews=True, eps = 1e-8, inds=None):
+        """
+        Sample N transitions of all agents, see ReplayBuffer.sample. The indices are gathered in sorted order (the
+        batch is returned in that order), so the pages of the files are read front to back
+        """
+        if inds is None:
+            inds = self.sample_indices(N)
+        return super(MemmapReplayBuffer, self).sample(N, to_gpu, norm_rews, eps, inds=np.sort(inds))
+
+
+class TorchReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer storing all fields as preallocated float32 tensors on device, agent major, e.g. observations as
+    (num_agents, max_steps, obs_dim). push() copies the tensors it is given without going through numpy and sample()
+    gathers every field with one index_select, returning (num_agents, N, dim) tensors (iterating over them gives the
+    per agent batches of ReplayBuffer.sample). All agents need the same observation and action dimensions.
+    """
+    def __init__(self, max_steps, num_agents, obs_dims, ac_dims, device='cpu'):
+        """
+        Inputs:
+            max_steps (int): Maximum number of timepoints to store in buffer
+            num_agents (int): Number of agents in environment
+            obs_dims (list of ints): number of obervation dimensions for each
+                                     agent
+            ac_dims (list of ints): number of action dimensions for each agent
+            device (str or torch.device): Device holding the buffer and the samples
+        """
+        if len(set(obs_dims)) != 1 or len(set(ac_dims)) != 1:
+            raise ValueError("TorchReplayBuffer needs the same observation and action dimensions for all agents")
+        self.max_steps = max_steps
+        self.num_agents = num_agents
+        self.device = torch.device(device)
+        self.obs = torch.zeros(num_agents, max_steps, obs_dims[0], device=self.device)
+        self.acs = torch.zeros(num_agents, max_steps, ac_dims[0], device=self.device)
+        self.next_obs = torch.zeros(num_agents, max_steps, obs_dims[0], device=self.device)
+        self.dones = torch.zeros(num_agents, max_steps, device=self.device)
+        self.rew_buffs = torch.zeros(num_agents, max_steps, device=self.device)
+
+        self.filled_i = 0  # index of first empty location in buffer (last index when full)
+        self.curr_i = 0  # current index to write to (ovewrite oldest data)
+        # seeded from the global numpy state so that np.random.seed still makes runs reproducible
+        self.rng = np.random.default_rng(np.random.randint(2 ** 31 - 1))
+
+        # running reward statistics of the stored transitions (Welford), per agent
+        self.rew_mean = torch.zeros(num_agents, dtype=torch.float64, device=self.device)
+        self.rew_M2 = torch.zeros(num_agents, dtype=torch.float64, device=self.device)
+
+    def _as_tensor(self, x):
+        return torch.as_tensor(x).to(self.device, torch.float32)
+
+    def _update_rew_stats(self, old_rews, rews):
+        """See ReplayBuffer._update_rew_stats, with (num_agents, k) tensors"""
+        old_rews, rews = old_rews.double(), rews.double()
+        count = self.filled_i - old_rews.shape[1] + rews.shape[1]
+        mean = self.rew_mean + (rews.sum(1) - old_rews.sum(1) - (rews.shape[1] - old_rews.shape[1]) * self.rew_mean) / count
+        self.rew_M2 = torch.clamp(self.rew_M2 + ((rews - self.rew_mean[:, None]) ** 2).sum(1)
+                                  - ((old_rews - self.rew_mean[:, None]) ** 2).sum(1)
+                                  - count * (mean - self.rew_mean) ** 2, min=0)
+        self.rew_mean = mean
+
+    def _recompute_rew_stats(self):
+        var, mean = torch.var_mean(self.rew_buffs[:, :self.filled_i], 1, correction=0)
+        self.rew_mean = mean.double()
+        self.rew_M2 = var.double() * self.filled_i
+
+    def push(self, observations, actions, rewards, next_observations, dones):
+        nentries = observations.shape[0]  # handle multiple parallel environments
+        rows = torch.as_tensor((self.curr_i + np.arange(nentries)) % self.max_steps, device=self.device)
+        overwritten = torch.as_tensor(self._overwritten_inds(nentries), device=self.device)
+        rews = self._as_tensor(rewards).t()
+        self._update_rew_stats(self.rew_buffs.index_select(1, overwritten), rews)
+
+        self.rew_buffs.index_copy_(1, rows, rews)
+        self.obs.index_copy_(1, rows, self._as_tensor(observations).transpose(0, 1))
+        # actions are already batched by agent
+        acs = torch.stack([self._as_tensor(ac).expand(nentries, self.acs.shape[2]) for ac in actions])
+        self.acs.index_copy_(1, rows, acs)
+        self.next_obs.index_copy_(1, rows, self._as_tensor(next_observations).transpose(0, 1))
+        self.dones.index_copy_(1, rows, self._as_tensor(dones).t())
+        self._advance(nentries)
+
+    def sample(self, N, to_gpu=False, norm_rews=True, eps = 1e-8, inds=None):
+        """
+        Sample N transitions of all agents as (num_agents, N, dim) tensors on the buffer device, see
+        ReplayBuffer.sample (to_gpu is ignored)
+        """
+        if inds is None:
+            inds = self.sample_indices(N)
+        inds = torch.as_tensor(inds, device=self.device)
+        rews = self.rew_buffs.index_select(1, inds)
+        if norm_rews:
+            rew_std = torch.sqrt(self.rew_M2 / self.filled_i)
+            rews = ((rews - self.rew_mean[:, None]) / (rew_std[:, None] + eps)).float()
+        return (self.obs.index_select(1, inds), self.acs.index_select(1, inds), rews,
+                self.next_obs.index_select(1, inds), self.dones.index_select(1, inds))
+
+    def get_average_rewards(self, N):
+        if self.filled_i == self.max_steps:
+            inds = np.arange(self.curr_i - N, self.curr_i) % self.max_steps
+        else:
+            inds = np.arange(max(0, self.curr_i - N), self.curr_i)
+        return self.rew_buffs[:, torch.as_tensor(inds, device=self.device)].mean(1).tolist()
@@ -1,4 +1,5 @@
 import os
+import copy
 import torch
 import torch.nn.functional as F
 import torch.distributed as dist
@@ -29,6 +30,15 @@ def hard_update(target, source):
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
 
+def quantized_copy(module):
+    """
+    Copy of a network for CPU inference, with every nn.Linear replaced by a dynamic int8 quantized Linear
+    Inputs:
+        module (torch.nn.Module): Net to copy
+    """
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(module).eval(), {torch.nn.Linear},
+                                                  dtype=torch.qint8)
+
 # https://github.com/seba-1511/dist_tuto.pth/blob/gh-pages/train_dist.py
 def average_gradients(model):
     """ Gradient averaging. """
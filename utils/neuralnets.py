@@ -52,6 +52,37 @@ class MLPNetwork(nn.Module):
         out = self.out_fn(self.fc_out(x))
         return out
 
+class StackedMLP(nn.Module):
+    """
+    Inference snapshot of several MLPNetworks of the same shape (e.g. one per agent), evaluated together: the
+    weights are stacked along a leading network dimension and every layer is one batched matmul
+    """
+    def __init__(self, nets):
+        """
+        Inputs:
+            nets (list of MLPNetwork): Networks to stack, without input normalization
+        """
+        super(StackedMLP, self).__init__()
+        if any(isinstance(net.in_fn, nn.Module) for net in nets):
+            raise ValueError("StackedMLP does not support networks with norm_in")
+        self.nonlin = nets[0].nonlin
+        self.out_fn = nets[0].out_fn
+        for name in ('fc_in', 'fc_hidden', 'fc_out'):
+            layers = [getattr(net, name) for net in nets]
+            self.register_buffer(name + '_weight', torch.stack([l.weight.detach().t() for l in layers]))
+            self.register_buffer(name + '_bias', torch.stack([l.bias.detach() for l in layers]).unsqueeze(1))
+
+    def forward(self, X):
+        """
+        Inputs:
+            X (PyTorch Tensor): Batches of observations, (n_nets, batch, input_dim)
+        Outputs:
+            out (PyTorch Tensor): Outputs of the networks, (n_nets, batch, out_dim)
+        """
+        x = self.nonlin(torch.baddbmm(self.fc_in_bias, X, self.fc_in_weight))
+        x = self.nonlin(torch.baddbmm(self.fc_hidden_bias, x, self.fc_hidden_weight))
+        return self.out_fn(torch.baddbmm(self.fc_out_bias, x, self.fc_out_weight))
+
 if __name__ == '__main__':
   nn = MLPNetwork(1, 1, 128)
   res = nn(torch.tensor([1.0]))
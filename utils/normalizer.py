@@ -0,0 +1,58 @@
+import torch
+import torch.nn as nn
+
+
+class RunningNormalizer(nn.Module):
+    """
+    Standardizes inputs with running mean and variance estimates of the inputs seen by update(). Batches are merged
+    into the statistics at once (parallel variance of Chan et al.), and applying the normalization (forward) never
+    changes them. The statistics are buffers, so they are part of the state dict
+    """
+    def __init__(self, dim, eps=1e-6, clip=10.0):
+        """
+        Inputs:
+            dim (int): Number of input dimensions
+            eps (float): Added to the standard deviation
+            clip (float): Normalized inputs are clipped to [-clip, clip]
+        """
+        super(RunningNormalizer, self).__init__()
+        self.eps = eps
+        self.clip = clip
+        self.register_buffer('count', torch.zeros((), dtype=torch.float64))
+        self.register_buffer('mean', torch.zeros(dim, dtype=torch.float64))
+        self.register_buffer('M2', torch.zeros(dim, dtype=torch.float64))
+
+    @property
+    def variance(self):
+        """Unbiased variance of the inputs seen so far, ones before two inputs have been seen"""
+        if self.count < 2:
+            return torch.ones_like(self.M2)
+        return self.M2 / (self.count - 1)
+
+    @torch.no_grad()
+    def update(self, x):
+        """
+        Merge a batch into the statistics
+        Inputs:
+            x (torch.Tensor): Inputs of shape (..., dim)
+        """
+        x = torch.as_tensor(x).to(self.mean.device, torch.float64).reshape(-1, self.mean.shape[0])
+        n = x.shape[0]
+        if n == 0:
+            return
+        batch_mean = x.mean(0)
+        batch_M2 = ((x - batch_mean) ** 2).sum(0)
+        count = self.count + n
+        delta = batch_mean - self.mean
+        self.mean += delta * (n / count)
+        self.M2 += batch_M2 + delta ** 2 * (self.count * n / count)
+        self.count.copy_(count)
+
+    @torch.no_grad()
+    def forward(self, x):
+        """
+        Normalize inputs of shape (..., dim) with the current statistics, as float32
+        """
+        x = torch.as_tensor(x).to(self.mean.device, torch.float64)
+        x = (x - self.mean) / (self.variance.sqrt() + self.eps)
+        return x.clamp(-self.clip, self.clip).float()